@@ -3,12 +3,14 @@ Health check endpoints for the API.
 """
 
 from fastapi import APIRouter, HTTPException
+from fastapi.responses import JSONResponse
 from datetime import datetime
 import torch
 import logging
 
 from app.models.schemas import HealthResponse
 from app.core.config import settings
+from app.services.inference_worker import inference_worker
 
 router = APIRouter()
 logger = logging.getLogger(__name__)
@@ -22,20 +24,35 @@ async def health_check():
         # Check GPU availability
         gpu_available = torch.cuda.is_available()
         
-        # List of models that are actually available in the current project
-        models_loaded = ["integrated-ai-pipeline"]
+        # Models that are actually loaded in the resident pipeline
+        worker_status = inference_worker.status()
+        models_loaded = [
+            name for name, stats in worker_status["models"].items()
+            if stats.get("status") == "ready"
+        ]
         
         return HealthResponse(
             status="healthy",
             version="1.0.0",
             models_loaded=models_loaded,
-            gpu_available=gpu_available
+            gpu_available=gpu_available,
+            ready=worker_status["ready"],
+            models=worker_status["models"]
         )
     
     except Exception as e:
         logger.error(f"Health check failed: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Health check failed: {str(e)}")
 
+@router.get("/health/ready")
+async def readiness_check():
+    """
+    Readiness probe: 200 once the pipeline models are warm, 503 while loading or failed.
+    """
+    worker_status = inference_worker.status()
+    status_code = 200 if worker_status["ready"] else 503
+    return JSONResponse(status_code=status_code, content=worker_status)
+
 @router.get("/health/detailed")
 async def detailed_health_check():
     """
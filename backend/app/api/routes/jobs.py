@@ -0,0 +1,126 @@
+"""
+Asynchronous estimation job endpoints.
+"""
+
+from fastapi import APIRouter, HTTPException, UploadFile, File, Form, Request
+from fastapi.responses import StreamingResponse
+from typing import List
+import asyncio
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+from app.models.schemas import JobSubmitResponse, JobStatusResponse, JobMetricsResponse
+from app.services.inference_worker import build_class_prompt
+from app.services.job_manager import job_manager
+
+router = APIRouter()
+logger = logging.getLogger(__name__)
+
+
+@router.post("/jobs", response_model=JobSubmitResponse, status_code=202)
+async def submit_job(
+    request: Request,
+    files: List[UploadFile] = File(...),
+    products: str = Form(
+        "potato section,onion,eggplant section,tomato,cucumber")
+):
+    """
+    Submit images (T0, T1, ...) for stock estimation and return immediately with a job id.
+    """
+    if not files or len(files) == 0:
+        raise HTTPException(status_code=400, detail="No files provided")
+
+    if len(files) > 10:  # Limit to 10 images max
+        raise HTTPException(
+            status_code=400, detail="Maximum 10 images allowed")
+
+    product_list = [p.strip().lower() for p in products.split(',')]
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        image_paths = []
+        for i, file in enumerate(files):
+            if not file.filename:
+                continue
+            file_path = os.path.join(work_dir, f"T{i}{os.path.splitext(file.filename)[1]}")
+            with open(file_path, "wb") as buffer:
+                buffer.write(await file.read())
+            image_paths.append(file_path)
+
+        if not image_paths:
+            raise HTTPException(
+                status_code=400, detail="No valid images provided")
+
+        queue_position = job_manager.queue_depth
+        job = job_manager.submit(image_paths, build_class_prompt(product_list), work_dir)
+    except HTTPException:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        raise
+    except RuntimeError as e:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        raise HTTPException(status_code=503, detail=str(e))
+
+    logger.info(f"Queued job {job.id} with {len(image_paths)} images")
+    return JobSubmitResponse(
+        job_id=job.id,
+        status=job.status,
+        queue_position=queue_position,
+        status_url=str(request.url_for("get_job", job_id=job.id)),
+        events_url=str(request.url_for("stream_job_events", job_id=job.id))
+    )
+
+
+@router.get("/jobs/metrics", response_model=JobMetricsResponse)
+async def get_job_metrics():
+    """
+    Queue depth, wait time and service time of the job queue.
+    """
+    return job_manager.metrics()
+
+
+@router.get("/jobs/{job_id}", response_model=JobStatusResponse)
+async def get_job(job_id: str):
+    """
+    Poll the status, current stage and (once finished) results of a job.
+    """
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+    return job.to_dict()
+
+
+@router.get("/jobs/{job_id}/events")
+async def stream_job_events(job_id: str, request: Request):
+    """
+    Server-sent events stream of job status and per-stage progress.
+    """
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+
+    async def event_stream():
+        subscriber = job.subscribe()
+        try:
+            while True:
+                try:
+                    event = await asyncio.wait_for(subscriber.get(), timeout=15)
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        break
+                    # Keep proxies from closing an idle connection
+                    yield ": keep-alive\n\n"
+                    continue
+                yield f"event: {event['type']}\ndata: {json.dumps(event)}\n\n"
+                if event["type"] == "status" and event["status"] in ("completed", "failed"):
+                    break
+        finally:
+            job.unsubscribe(subscriber)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
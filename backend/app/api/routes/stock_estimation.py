@@ -7,7 +7,6 @@ from typing import List, Optional
 import time
 import logging
 import os
-import subprocess
 import json
 from datetime import datetime
 
@@ -16,7 +15,6 @@ from app.models.schemas import (
     StockEstimationResponse, 
     ProductStockInfo, 
     ProductType,
-    StockLevel,
     ModelInfo,
     ErrorResponse,
     StockEstimationMultipleResponse,
@@ -24,6 +22,8 @@ from app.models.schemas import (
 from app.core.config import settings
 from app.services.ai_engine import AIEngine
 from app.services.file_processor import FileProcessor
+from app.services.inference_worker import inference_worker, build_class_prompt, image_result_to_products
+from app.services.result_cache import result_cache
 
 router = APIRouter()
 logger = logging.getLogger(__name__)
@@ -31,117 +31,26 @@ logger = logging.getLogger(__name__)
 
 async def run_main_py_analysis(image_path: str, products: List[str]) -> List[ProductStockInfo]:
     """
-    Run main.py with the uploaded image and capture the results.
+    Run the resident AI pipeline on the uploaded image and return structured results.
     """
     try:
-        # Get the project root directory (go up 4 levels from backend/app/api/routes/stock_estimation.py)
-        # This gives us: backend/app/api/routes -> backend/app/api -> backend/app -> backend -> project_root
-        project_root = os.path.dirname(os.path.dirname(
-            os.path.dirname(os.path.dirname(os.path.dirname(__file__)))))
+        logger.info(f"Running integrated analysis on {image_path}")
 
-        # Copy uploaded image to dataset folder with T0.jpg name (as expected by main.py)
-        dataset_path = os.path.join(project_root, "dataset", "T0.jpg")
-        import shutil
-        shutil.copy2(image_path, dataset_path)
-        logger.info(f"Copied uploaded image to {dataset_path}")
-
-        # Run main.py directly without modifying it
-        main_py_path = os.path.join(project_root, "main.py")
-        
-        logger.info(f"Running main.py analysis on {image_path}")
-        logger.info(f"Project root: {project_root}")
-        logger.info("This may take 2-5 minutes for AI model processing...")
-
-        # Check if main.py exists
-        if not os.path.exists(main_py_path):
-            logger.error(f"Main.py file not found at: {main_py_path}")
-            raise Exception(f"Main.py file not found at: {main_py_path}")
-
-        # Check if dataset directory exists
-        dataset_dir = os.path.join(project_root, "dataset")
-        if not os.path.exists(dataset_dir):
-            logger.error(f"Dataset directory not found at: {dataset_dir}")
-            raise Exception(f"Dataset directory not found at: {dataset_dir}")
-
-        # Run main.py directly
-        result = subprocess.run(
-            ["python", main_py_path],
-            capture_output=True,
-            text=True,
-            cwd=project_root,
-            timeout=600  # 10 minute timeout for AI processing
-        )
-
-        # Log the full output for debugging
-        logger.info(f"Main.py stdout: {result.stdout}")
-        logger.info(f"Main.py stderr: {result.stderr}")
-
-        if result.returncode != 0:
-            logger.error(f"Main.py analysis failed: {result.stderr}")
+        try:
+            image_results = await inference_worker.run([image_path], build_class_prompt(products))
+        except Exception as e:
+            logger.error(f"Integrated analysis failed: {e}")
             logger.info("Falling back to basic analysis...")
             # Fallback to basic analysis
             return await ai_engine.estimate_stock_basic_cv(image_path, products, 0.7)
 
-        # Parse the main.py output from print_result() method
-        try:
-            # Parse the output from print_result() method
-            # Expected format: "class_name - section N: percentage%"
-            import re
-            stock_pattern = r"([^-]+)\s*-\s*section\s*(\d+):\s*([\d.]+)%"
-            matches = re.findall(stock_pattern, result.stdout)
-            
-            logger.info(f"Found {len(matches)} stock matches in output")
-            
-            # Convert to ProductStockInfo format
-            results = []
-            for match in matches:
-                product_name = match[0].strip()
-                section_num = int(match[1])
-                percentage = float(match[2])
-                
-                # Convert percentage to 0-1 range
-                stock_percentage = percentage / 100.0
-                
-                # Determine stock level
-                if stock_percentage < 0.3:
-                    stock_status = StockLevel.LOW
-                elif stock_percentage > 0.8:
-                    stock_status = StockLevel.OVERSTOCKED
-                else:
-                    stock_status = StockLevel.NORMAL
-                
-                # Confidence based on stock level
-                confidence = min(stock_percentage * 1.1, 0.95)
-                
-                results.append(ProductStockInfo(
-                    product=f"{product_name} section {section_num}",
-                    stock_percentage=stock_percentage,
-                    stock_status=stock_status,
-                    confidence=confidence,
-                    reasoning=f"AI model detected {product_name} section {section_num} with {percentage:.1f}% stock level"
-                ))
-            
-            logger.info(f"Parsed {len(results)} products from main.py output")
-            
-        except Exception as e:
-            logger.error(f"Failed to parse main.py output: {e}")
-            logger.error(f"Raw output: {result.stdout}")
-            # Fallback: create results based on requested products
-            results = []
-            for product in products:
-                results.append(ProductStockInfo(
-                    product=f"{product} section 1",
-                    stock_percentage=0.5,  # Default medium stock
-                    stock_status=StockLevel.NORMAL,
-                    confidence=0.5,  # Default medium confidence
-                    reasoning=f"Fallback analysis for {product}"
-                ))
+        results = image_result_to_products(image_results[0])
 
         logger.info(f"AI analysis completed successfully for {len(results)} products")
         return results
 
     except Exception as e:
-        logger.error(f"Error running main.py analysis: {e}")
+        logger.error(f"Error running integrated analysis: {e}")
         raise
 
 # Initialize services
@@ -237,6 +146,17 @@ async def get_available_models():
             status_code=500, detail=f"Failed to get available models: {str(e)}")
 
 
+@router.get("/cache/stats")
+async def get_cache_stats():
+    """
+    Hit/miss counters and size of the content-addressed result cache.
+    """
+    return {
+        "enabled": settings.RESULT_CACHE_ENABLED,
+        **result_cache.stats()
+    }
+
+
 @router.get("/products", response_model=List[str])
 async def get_supported_products():
     """
@@ -322,8 +242,8 @@ async def estimate_stock_integrated(
         # Parse products
         product_list = [p.strip().lower() for p in products.split(',')]
 
-        # Run main.py with the uploaded image to get real AI analysis
-        logger.info("Running main.py with uploaded image...")
+        # Run the resident AI pipeline on the uploaded image
+        logger.info("Running integrated AI pipeline on uploaded image...")
         results = await run_main_py_analysis(file_path, product_list)
 
         processing_time = time.time() - start_time
@@ -372,14 +292,15 @@ async def estimate_stock_multiple(
 
         logger.info(f"Processing {len(files)} images...")
 
-        # Get the project root directory
-        project_root = os.path.dirname(os.path.dirname(
-            os.path.dirname(os.path.dirname(os.path.dirname(__file__)))))
+        # Parse products
+        product_list = [p.strip().lower() for p in products.split(',')]
 
-        # Create a temporary directory for multiple images
+        # Create a per-request directory so concurrent requests never share files
         import tempfile
         import shutil
         temp_dir = tempfile.mkdtemp()
+        # Once inference has the files, it removes the directory when done with them
+        handed_over = False
 
         try:
             # Save all uploaded images
@@ -401,195 +322,50 @@ async def estimate_stock_multiple(
                 raise HTTPException(
                     status_code=400, detail="No valid images provided")
 
-            # Copy images to dataset folder for main.py processing
-            dataset_dir = os.path.join(project_root, "dataset")
-            os.makedirs(dataset_dir, exist_ok=True)
-
-            # Clear existing test images (but keep other images)
-            for file in os.listdir(dataset_dir):
-                if file.startswith("T") and file.endswith(('.jpg', '.jpeg', '.png')):
-                    try:
-                        os.remove(os.path.join(dataset_dir, file))
-                    except:
-                        pass
-
-            # Copy new images with T0, T1, T2... naming convention
-            for i, image_path in enumerate(image_paths):
-                dest_path = os.path.join(dataset_dir, f"T{i}.jpg")
-                shutil.copy2(image_path, dest_path)
-                logger.info(f"Copied image to {dest_path}")
-
-            # Run main.py directly - it now dynamically detects available images
-            main_py_path = os.path.join(project_root, "main.py")
-            
-            logger.info("Running main.py analysis on multiple images...")
+            logger.info("Running integrated analysis on multiple images...")
             logger.info(f"Images to process: {[f'T{i}' for i in range(len(image_paths))]}")
-            logger.info(f"Project root: {project_root}")
             logger.info("This may take 5-10 minutes for multiple AI model processing...")
 
-            result = subprocess.run(
-                ["python", main_py_path],
-                capture_output=True,
-                text=True,
-                cwd=project_root,
-                timeout=1200  # 20 minute timeout for multiple images
-            )
-
-            # Log the output for debugging
-            logger.info(f"Main.py stdout: {result.stdout}")
-            logger.info(f"Main.py stderr: {result.stderr}")
-            logger.info(f"Main.py return code: {result.returncode}")
-
-            if result.returncode != 0:
-                logger.error(f"Main.py analysis failed: {result.stderr}")
+            try:
+                handed_over = True
+                image_results = await inference_worker.run(
+                    image_paths, build_class_prompt(product_list), timeout=1200,
+                    cleanup=lambda: shutil.rmtree(temp_dir, ignore_errors=True))
+            except Exception as e:
+                logger.error(f"Integrated analysis failed: {e}")
                 raise HTTPException(
                     status_code=500, detail="AI analysis failed")
 
-            # Parse the results from main.py output using print_result() format
-            try:
-                # Parse the output from print_result() method
-                # Expected format: "class_name - section N: percentage%"
-                import re
-                stock_pattern = r"([^-]+)\s*-\s*section\s*(\d+):\s*([\d.]+)%"
-                
-                # Split output by "Processing image:" to identify different images
-                output_lines = result.stdout.strip().split('\n')
-                
-                # Find all "Processing image:" lines to determine image boundaries
-                processing_lines = []
-                for i, line in enumerate(output_lines):
-                    if "Processing image:" in line:
-                        processing_lines.append(i)
-                        logger.info(f"Found processing line {i}: {line.strip()}")
-                
-                logger.info(f"Found {len(processing_lines)} processing lines: {processing_lines}")
-                
-                # Group results by image (T0, T1, etc.)
-                grouped_results = {}
-                
-                # If no processing lines found, fallback to even distribution
-                if len(processing_lines) == 0:
-                    logger.warning("No 'Processing image:' lines found, falling back to even distribution")
-                    # Parse all matches and distribute evenly
-                    all_matches = re.findall(stock_pattern, result.stdout)
-                    matches_per_image = len(all_matches) // len(image_paths) if len(image_paths) > 0 else len(all_matches)
-                    
-                    for i, match in enumerate(all_matches):
-                        product_name = match[0].strip()
-                        section_num = int(match[1])
-                        percentage = float(match[2])
-                        
-                        # Convert percentage to 0-1 range
-                        stock_percentage = percentage / 100.0
-                        
-                        # Determine stock level
-                        if stock_percentage < 0.3:
-                            stock_status = StockLevel.LOW
-                        elif stock_percentage > 0.8:
-                            stock_status = StockLevel.OVERSTOCKED
-                        else:
-                            stock_status = StockLevel.NORMAL
-                        
-                        # Confidence based on stock level
-                        confidence = min(stock_percentage * 1.1, 0.95)
-                        
-                        # Determine which image this belongs to
-                        image_index = i // matches_per_image if matches_per_image > 0 else 0
-                        time_key = f"T{image_index}"
-                        
-                        if time_key not in grouped_results:
-                            grouped_results[time_key] = []
-                        
-                        grouped_results[time_key].append(ProductStockInfo(
-                            product=f"{product_name} section {section_num}",
-                            stock_percentage=stock_percentage,
-                            stock_status=stock_status,
-                            confidence=confidence,
-                            reasoning=f"AI model detected {product_name} section {section_num} with {percentage:.1f}% stock level"
-                        ))
-                else:
-                    # Process each image section separately
-                    for img_idx in range(len(processing_lines)):
-                        time_key = f"T{img_idx}"
-                        grouped_results[time_key] = []
-                        
-                        # Determine the range of lines for this image
-                        start_line = processing_lines[img_idx]
-                        end_line = processing_lines[img_idx + 1] if img_idx + 1 < len(processing_lines) else len(output_lines)
-                        
-                        # Extract lines for this image
-                        image_lines = output_lines[start_line:end_line]
-                        image_text = '\n'.join(image_lines)
-                        
-                        logger.info(f"Image {time_key}: Processing lines {start_line} to {end_line}")
-                        logger.info(f"Image {time_key}: Sample lines: {image_lines[:3] if len(image_lines) >= 3 else image_lines}")
-                        
-                        # Find matches in this image's output
-                        matches = re.findall(stock_pattern, image_text)
-                        
-                        logger.info(f"Image {time_key}: Found {len(matches)} matches")
-                        if matches:
-                            logger.info(f"Image {time_key}: First few matches: {matches[:3]}")
-                        
-                        # Process each match for this image
-                        for match in matches:
-                            product_name = match[0].strip()
-                            section_num = int(match[1])
-                            percentage = float(match[2])
-                            
-                            # Convert percentage to 0-1 range
-                            stock_percentage = percentage / 100.0
-                            
-                            # Determine stock level
-                            if stock_percentage < 0.3:
-                                stock_status = StockLevel.LOW
-                            elif stock_percentage > 0.8:
-                                stock_status = StockLevel.OVERSTOCKED
-                            else:
-                                stock_status = StockLevel.NORMAL
-                            
-                            # Confidence based on stock level
-                            confidence = min(stock_percentage * 1.1, 0.95)
-                            
-                            grouped_results[time_key].append(ProductStockInfo(
-                                product=f"{product_name} section {section_num}",
-                                stock_percentage=stock_percentage,
-                                stock_status=stock_status,
-                                confidence=confidence,
-                                reasoning=f"AI model detected {product_name} section {section_num} with {percentage:.1f}% stock level"
-                            ))
-                
-                logger.info(f"Parsed results for {len(grouped_results)} images: {list(grouped_results.keys())}")
-                for time_key, results in grouped_results.items():
-                    logger.info(f"  {time_key}: {len(results)} products")
-                    if results:
-                        logger.info(f"    First product: {results[0].product}")
-                        logger.info(f"    Last product: {results[-1].product}")
-                
-                processing_time = time.time() - start_time
-
-                return StockEstimationMultipleResponse(
-                    success=True,
-                    message=f"Stock estimation completed successfully for {len(image_paths)} images",
-                    processing_time=processing_time,
-                    timestamp=datetime.utcnow().isoformat() + "Z",
-                    results=grouped_results,
-                    model_used="integrated-ai-multiple",
-                    image_metadata={
-                        "image_count": len(image_paths),
-                        "images_processed": [f"T{i}" for i in range(len(image_paths))]
-                    }
-                )
+            # Group results by image (T0, T1, etc.)
+            grouped_results = {
+                f"T{i}": image_result_to_products(image_result)
+                for i, image_result in enumerate(image_results)
+            }
 
-            except Exception as e:
-                logger.error(f"Failed to parse multiple image results: {e}")
-                raise HTTPException(
-                    status_code=500, detail="Failed to parse AI analysis results")
+            logger.info(f"Parsed results for {len(grouped_results)} images: {list(grouped_results.keys())}")
+            for time_key, results in grouped_results.items():
+                logger.info(f"  {time_key}: {len(results)} products")
+
+            processing_time = time.time() - start_time
+
+            return StockEstimationMultipleResponse(
+                success=True,
+                message=f"Stock estimation completed successfully for {len(image_paths)} images",
+                processing_time=processing_time,
+                timestamp=datetime.utcnow().isoformat() + "Z",
+                results=grouped_results,
+                model_used="integrated-ai-multiple",
+                image_metadata={
+                    "image_count": len(image_paths),
+                    "images_processed": [f"T{i}" for i in range(len(image_paths))]
+                }
+            )
 
         finally:
             # Clean up temporary directory
-            shutil.rmtree(temp_dir, ignore_errors=True)
-            logger.info("Cleaned up temporary files")
+            if not handed_over:
+                shutil.rmtree(temp_dir, ignore_errors=True)
+                logger.info("Cleaned up temporary files")
 
     except HTTPException:
         raise
@@ -3,8 +3,8 @@ Configuration management for the AI Stock Level Estimation API.
 """
 
 from pydantic_settings import BaseSettings
-from pydantic import field_validator
-from typing import List, Optional, Union
+from pydantic import field_validator, model_validator
+from typing import Dict, List, Optional, Union
 import os
 
 class Settings(BaseSettings):
@@ -57,10 +57,56 @@ class Settings(BaseSettings):
     
     # Segmentation Model Settings
     SAM_MODEL: str = "sam_vit_h_4b8939.pth"
+    SAM2_MODEL: str = "sam2.1_l.pt"  # tiny, small, base, large or a SAM2.1 checkpoint name
+    SAM2_PRECISION: str = "fp32"  # fp32, bf16 or int8 (int8 runs on CPU)
+    SAM_EMBEDDING_CACHE_SIZE: int = 8  # image embeddings kept for re-prompting the same image
+    SAM_PROMPT_CHUNK: int = 32  # box prompts per mask decoder pass
     
     # Depth Estimation Settings
-    MIDAS_MODEL: str = "MiDaS_small"
+    MIDAS_MODEL: str = "DPT_Hybrid"  # any name in backend_model.depth_backends.DEPTH_BACKENDS
+    MIDAS_NATIVE_TRANSFORM: bool = False  # DPT_Hybrid uses dpt_transform instead of small_transform (changes depth)
     MARIGOLD_MODEL: str = "prs-eth/marigold-v1-0"
+    DEPTH_ROI_UPSAMPLE: bool = True  # upsample depth only inside detected sections
+    DEPTH_CASCADE: bool = True  # skip depth inference for images whose masks decide every section
+    
+    # Shelf Tracking Settings (frames after the first rescore only the sections that changed)
+    SHELF_TRACKING: bool = False
+    SHELF_CHANGE_THRESHOLD: float = 0.05  # fraction of a section's pixels that must change
+    SHELF_PIXEL_THRESHOLD: int = 25  # gray level difference of a changed pixel
+    
+    # ONNX Runtime Settings (graphs from python -m backend_model.onnx_export in MODEL_CACHE_DIR/onnx)
+    ONNX_RUNTIME: bool = False  # run exported detection, SAM encoder and depth graphs on CPU (needs backend_model/requirements-onnx.txt)
+    ONNX_INTRA_OP_THREADS: int = 0  # 0 lets ONNX Runtime choose
+    
+    # Inference Worker Settings
+    MODEL_WARMUP: str = "eager"  # "eager" loads all models at startup, "lazy" on first use
+    MODEL_WARMUP_THREADS: int = 4
+    INFERENCE_WORKERS: int = 1  # concurrent requests sharing the loaded models
+    INFERENCE_QUEUE_SIZE: int = 16
+    INFERENCE_TIMEOUT: int = 600  # seconds per request
+    
+    # Stage Pipeline Settings (detection, segmentation, depth, scoring and refinement overlap across images)
+    PIPELINE_ENABLED: bool = False  # not used with SHELF_TRACKING
+    PIPELINE_QUEUE_SIZE: int = 2  # images waiting in front of each stage
+    PIPELINE_WORKERS: Dict[str, int] = {"detection": 1, "segmentation": 1, "depth": 1, "refinement": 2}
+    PIPELINE_PROCESS_STAGES: List[str] = []  # detection, segmentation, depth; each process loads its own model
+    
+    # Result Cache Settings
+    RESULT_CACHE_ENABLED: bool = True
+    RESULT_CACHE_DIR: Optional[str] = None  # defaults to MODEL_CACHE_DIR/result_cache
+    RESULT_CACHE_MEMORY_ENTRIES: int = 256
+    RESULT_CACHE_MAX_BYTES: int = 512 * 1024 * 1024  # 512MB on disk
+    
+    # Stage Cache Settings (detections, masks and depth maps per image)
+    STAGE_CACHE_ENABLED: bool = False  # opt-in: writes masks and depth maps of every new upload to disk
+    STAGE_CACHE_DIR: Optional[str] = None  # defaults to MODEL_CACHE_DIR/stage_cache
+    STAGE_CACHE_MAX_BYTES: int = 2 * 1024 * 1024 * 1024  # 2GB on disk
+    
+    # Job Queue Settings
+    JOB_WORKERS: int = 1
+    JOB_QUEUE_SIZE: int = 32
+    JOB_TIMEOUT: int = 1200  # seconds per job
+    JOB_RETENTION: int = 3600  # seconds finished jobs stay queryable
     
     # Stock Level Thresholds
     LOW_STOCK_THRESHOLD: float = 0.3
@@ -72,10 +118,35 @@ class Settings(BaseSettings):
         "potato section", "onion", "eggplant section", "tomato", "cucumber"
     ]
     
+    # Gemini Refinement Settings
+    GEMINI_MODEL: str = "gemini-2.5-flash"
+    GEMINI_BASE_URL: Optional[str] = None  # another endpoint, e.g. a local fake Gemini server
+    GEMINI_MAX_CONCURRENCY: int = 4  # calls in flight; the others wait for a pooled client
+    GEMINI_MAX_RETRIES: int = 4  # retries of rate-limited (429) and 5xx responses
+    GEMINI_TIMEOUT: float = 60.0  # seconds per call
+    GEMINI_CACHE_SIZE: int = 256  # responses kept per image and requested positions
+    GEMINI_PAYLOAD: str = "full"  # full image, or "mosaic" of the labelled section crops
+    GEMINI_CROP_MAX_SIDE: int = 512  # pixels, longest side of a mosaic crop
+    GEMINI_ASYNC: bool = False  # refine in the background while the next images run locally
+    GEMINI_DEADLINE: Optional[float] = 30.0  # seconds before an async refinement falls back to depth values
+    GEMINI_COALESCE_WINDOW: float = 0.0  # seconds to gather images into one call (with GEMINI_ASYNC); 0 disables
+    GEMINI_COALESCE_MAX_IMAGES: int = 8
+    GEMINI_COALESCE_MAX_BYTES: int = 15 * 1024 * 1024  # inline image bytes per call
+    GEMINI_COALESCE_MAX_TOKENS: int = 100000  # estimated input tokens per call
+    
     # API Keys (for commercial models)
     OPENAI_API_KEY: Optional[str] = None
     GOOGLE_API_KEY: Optional[str] = None
     
+    @model_validator(mode='after')
+    def anchor_cache_dirs(self):
+        # Keep the caches next to the model weights instead of the working directory
+        if not self.RESULT_CACHE_DIR:
+            self.RESULT_CACHE_DIR = os.path.join(self.MODEL_CACHE_DIR, "result_cache")
+        if not self.STAGE_CACHE_DIR:
+            self.STAGE_CACHE_DIR = os.path.join(self.MODEL_CACHE_DIR, "stage_cache")
+        return self
+    
     class Config:
         env_file = ".env"
         case_sensitive = True
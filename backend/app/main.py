@@ -11,8 +11,10 @@ from typing import List, Optional
 import logging
 
 from app.core.config import settings
-from app.api.routes import stock_estimation, health
+from app.api.routes import stock_estimation, health, jobs
 from app.core.logging_config import setup_logging
+from app.services.inference_worker import inference_worker
+from app.services.job_manager import job_manager
 
 # Setup logging
 setup_logging()
@@ -39,6 +41,7 @@ app.add_middleware(
 # Include routers
 app.include_router(health.router, prefix="/api/v1", tags=["health"])
 app.include_router(stock_estimation.router, prefix="/api/v1", tags=["stock-estimation"])
+app.include_router(jobs.router, prefix="/api/v1", tags=["jobs"])
 
 @app.on_event("startup")
 async def startup_event():
@@ -50,12 +53,18 @@ async def startup_event():
     os.makedirs(settings.OUTPUT_DIR, exist_ok=True)
     os.makedirs(settings.MODEL_CACHE_DIR, exist_ok=True)
     
+    # Load the AI pipeline once and keep it resident for all requests
+    inference_worker.start()
+    job_manager.start()
+    
     logger.info("Application startup completed")
 
 @app.on_event("shutdown")
 async def shutdown_event():
     """Cleanup on application shutdown."""
     logger.info("Shutting down AI Stock Level Estimation API...")
+    await job_manager.stop()
+    inference_worker.stop()
 
 if __name__ == "__main__":
     uvicorn.run(
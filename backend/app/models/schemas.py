@@ -84,6 +84,10 @@ class HealthResponse(BaseModel):
     version: str
     models_loaded: List[str]
     gpu_available: bool
+    ready: bool = Field(
+        default=False, description="Pipeline models are warm and requests can be served")
+    models: Dict[str, Any] = Field(
+        default_factory=dict, description="Per-model load status, load time and memory footprint")
 
 
 class ErrorResponse(BaseModel):
@@ -102,3 +106,63 @@ class ModelInfo(BaseModel):
     supported_products: List[ProductType]
     requires_gpu: bool
     estimated_processing_time: float  # in seconds
+
+
+class JobStatus(str, Enum):
+    """Lifecycle of an asynchronous estimation job."""
+    QUEUED = "queued"
+    RUNNING = "running"
+    COMPLETED = "completed"
+    FAILED = "failed"
+
+
+class JobSubmitResponse(BaseModel):
+    """Response returned when an estimation job is accepted."""
+    job_id: str
+    status: JobStatus
+    queue_position: int = Field(description="Jobs ahead of this one in the queue")
+    status_url: str
+    events_url: str
+
+
+class JobStatusResponse(BaseModel):
+    """Current state of an estimation job."""
+    job_id: str
+    status: JobStatus
+    stage: Optional[str] = Field(
+        default=None, description="Pipeline stage currently running")
+    progress: float = Field(
+        ge=0.0, le=1.0, description="Fraction of images finished")
+    created_at: datetime
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+    wait_time: Optional[float] = Field(
+        default=None, description="Seconds from submission until inference started")
+    service_time: Optional[float] = Field(
+        default=None, description="Seconds spent processing")
+    # results grouped by time key (e.g., "T0", "T1"), set once completed
+    results: Optional[Dict[str, List[ProductStockInfo]]] = None
+    error: Optional[str] = None
+
+
+class TimingStats(BaseModel):
+    """Summary statistics over recent samples, in seconds."""
+    count: int
+    mean: float
+    p50: float
+    p95: float
+    max: float
+
+
+class JobMetricsResponse(BaseModel):
+    """Job queue metrics used to size the worker pool."""
+    workers: int
+    queue_depth: int
+    queue_capacity: int
+    running: int
+    submitted: int
+    completed: int
+    failed: int
+    rejected: int
+    wait_time: TimingStats
+    service_time: TimingStats
@@ -10,6 +10,7 @@ import cv2
 import numpy as np
 from PIL import Image
 import hashlib
+import uuid
 from datetime import datetime
 
 from app.core.config import settings
@@ -28,12 +29,13 @@ class FileProcessor:
         Process uploaded file and extract relevant data.
         """
         try:
-            # Generate unique filename
-            file_id = self._generate_file_id(file.filename)
+            # Generate unique filename from the file content
+            content = await file.read()
+            file_id = self._generate_file_id(content)
             file_ext = os.path.splitext(file.filename)[1].lower()
             
             # Save file temporarily
-            temp_path = await self._save_temp_file(file, file_id, file_ext)
+            temp_path = await self._save_temp_file(content, file_id, file_ext)
             
             # Process based on file type
             if file_ext in self.supported_image_formats:
@@ -61,7 +63,7 @@ class FileProcessor:
             logger.error(f"File processing failed: {str(e)}")
             raise
     
-    async def _save_temp_file(self, file, file_id: str, file_ext: str) -> str:
+    async def _save_temp_file(self, content: bytes, file_id: str, file_ext: str) -> str:
         """Save uploaded file temporarily."""
         temp_filename = f"{file_id}{file_ext}"
         temp_path = os.path.join(settings.UPLOAD_DIR, temp_filename)
@@ -71,7 +73,6 @@ class FileProcessor:
         
         # Save file
         async with aiofiles.open(temp_path, 'wb') as f:
-            content = await file.read()
             await f.write(content)
         
         return temp_path
@@ -234,12 +235,13 @@ class FileProcessor:
             logger.warning(f"Image quality assessment failed: {str(e)}")
             return {"quality_score": 0.5}
     
-    def _generate_file_id(self, filename: str) -> str:
-        """Generate unique file ID."""
+    def _generate_file_id(self, content: bytes) -> str:
+        """Generate unique file ID from the file content."""
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        hash_obj = hashlib.md5(filename.encode())
+        hash_obj = hashlib.sha256(content)
         file_hash = hash_obj.hexdigest()[:8]
-        return f"{timestamp}_{file_hash}"
+        # Identical uploads in the same second would otherwise share an ID
+        return f"{timestamp}_{file_hash}_{uuid.uuid4().hex[:8]}"
     
     async def _cleanup_temp_file(self, file_path: str):
         """Clean up temporary file."""
@@ -268,10 +270,9 @@ class FileProcessor:
             # Create uploads directory if it doesn't exist
             os.makedirs(settings.UPLOAD_DIR, exist_ok=True)
             
-            # Generate unique filename
+            # Generate unique filename (concurrent uploads may share a name and second)
             timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            file_extension = os.path.splitext(file.filename)[1]
-            filename = f"{timestamp}_{file.filename}"
+            filename = f"{timestamp}_{uuid.uuid4().hex[:8]}_{file.filename}"
             file_path = os.path.join(settings.UPLOAD_DIR, filename)
             
             # Save file
@@ -0,0 +1,314 @@
+"""
+Resident inference worker that keeps the integrated AI pipeline loaded in-process.
+"""
+
+import asyncio
+import logging
+import os
+import queue
+import sys
+import threading
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List, Optional
+
+from app.core.config import settings
+from app.models.schemas import ProductStockInfo, StockLevel
+
+# Add the project root to the path so the backend_model package can be imported
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..'))
+if project_root not in sys.path:
+    sys.path.append(project_root)
+
+from app.services.result_cache import result_cache
+
+logger = logging.getLogger(__name__)
+
+
+def build_class_prompt(products: List[str]) -> str:
+    """Build the GroundingDINO text prompt ('potato section . onion . ...') from product names."""
+    return " . ".join(products) + " ."
+
+
+def image_result_to_products(image_result) -> List[ProductStockInfo]:
+    """
+    Convert a PlanningAgent ImageResult into ProductStockInfo entries,
+    one per detected section.
+    """
+    results = []
+    for section in image_result.sections:
+        product_name = section.cls
+        section_num = section.index + 1
+        percentage = float(section.fullness)
+
+        # Convert percentage to 0-1 range
+        stock_percentage = percentage / 100.0
+
+        # Determine stock level
+        if stock_percentage < 0.3:
+            stock_status = StockLevel.LOW
+        elif stock_percentage > 0.8:
+            stock_status = StockLevel.OVERSTOCKED
+        else:
+            stock_status = StockLevel.NORMAL
+
+        # Confidence based on stock level
+        confidence = min(stock_percentage * 1.1, 0.95)
+
+        x1, y1, x2, y2 = section.bbox
+        results.append(ProductStockInfo(
+            product=f"{product_name} section {section_num}",
+            stock_percentage=stock_percentage,
+            stock_status=stock_status,
+            confidence=confidence,
+            bounding_box={"x1": x1, "y1": y1, "x2": x2, "y2": y2},
+            reasoning=f"AI model ({section.source}) detected {product_name} section {section_num} with {percentage:.1f}% stock level"
+        ))
+    return results
+
+
+class InferenceWorker:
+    """
+    Long-lived worker threads that share a single PlanningAgent.
+
+    Models are loaded once when the worker starts; requests are handed over
+    through an in-process queue and results come back as structured objects
+    through futures instead of being parsed from stdout. Every request is its
+    own image sequence, so several threads can serve requests concurrently.
+    """
+
+    def __init__(self, max_queue_size: int = settings.INFERENCE_QUEUE_SIZE,
+                 threads: int = settings.INFERENCE_WORKERS):
+        self._queue: "queue.Queue" = queue.Queue(maxsize=max_queue_size)
+        self._num_threads = max(1, threads)
+        self._threads: List[threading.Thread] = []
+        self._agent = None
+        self._load_error: Optional[Exception] = None
+        self._ready = threading.Event()
+        # Images whose depth map was computed or skipped by the depth cascade
+        self._depth_stats = {"computed": 0, "skipped": 0}
+        # Sections rescored or reused by the shelf-state tracker
+        self._tracking_stats = {"frames": 0, "sections_rescored": 0, "sections_skipped": 0}
+        self._stats_lock = threading.Lock()
+
+    @property
+    def is_ready(self) -> bool:
+        """True once the pipeline models are loaded and the worker accepts work."""
+        return self._ready.is_set() and self._load_error is None
+
+    def status(self) -> Dict[str, Any]:
+        """Readiness plus per-model load status, load time and memory footprint."""
+        models: Dict[str, Any] = {}
+        gemini = None
+        model_cache = sys.modules.get("backend_model.model_cache")
+        if model_cache is not None:
+            models = model_cache.load_stats()
+            gemini = model_cache.loaded("gemini")
+        stage_cache = self._agent.stage_cache if self._agent is not None else None
+        return {
+            "ready": self.is_ready,
+            "warmup": settings.MODEL_WARMUP,
+            "error": str(self._load_error) if self._load_error is not None else None,
+            "models": models,
+            "stage_cache": stage_cache.stats() if stage_cache is not None else None,
+            "depth": dict(self._depth_stats),
+            "tracking": dict(self._tracking_stats) if settings.SHELF_TRACKING else None,
+            "gemini": gemini.stats() if gemini is not None else None,
+            "pipeline": self._agent.stage_stats() if self._agent is not None and settings.PIPELINE_ENABLED else None,
+        }
+
+    def _alive(self) -> bool:
+        return any(thread.is_alive() for thread in self._threads)
+
+    def start(self):
+        """Start the worker threads; models are loaded in the background by the first one."""
+        if self._alive():
+            return
+        self._threads = [
+            threading.Thread(target=self._run, args=(i == 0,), name=f"inference-worker-{i}", daemon=True)
+            for i in range(self._num_threads)
+        ]
+        for thread in self._threads:
+            thread.start()
+        logger.info(f"Inference worker started with {self._num_threads} threads")
+
+    def stop(self, timeout: float = 5.0):
+        """Ask the worker threads to exit after their current request and shut down the agent's pools."""
+        if not self._threads:
+            return
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join(timeout=timeout)
+        if self._agent is not None:
+            # Waiting on the pools could hang behind a request still running
+            self._agent.close(wait=not self._alive())
+        self._threads = []
+        logger.info("Inference worker stopped")
+
+    def submit(self, image_paths: List[str], class_names: str,
+               progress: Optional[Callable[[str, int, int], None]] = None,
+               on_start: Optional[Callable[[], None]] = None) -> Future:
+        """
+        Queue a sequence of images (T0, T1, ...) for processing.
+
+        progress(stage, image_index, total) is called from the worker thread
+        as each pipeline stage starts, and on_start() once a worker thread
+        takes the request off the queue.
+        """
+        if not self._alive():
+            raise RuntimeError("Inference worker is not running")
+        future: Future = Future()
+        try:
+            self._queue.put_nowait((future, list(image_paths), class_names, progress, on_start))
+        except queue.Full:
+            raise RuntimeError("Inference queue is full, try again later")
+        return future
+
+    async def run(self, image_paths: List[str], class_names: str,
+                  timeout: Optional[float] = settings.INFERENCE_TIMEOUT,
+                  progress: Optional[Callable[[str, int, int], None]] = None,
+                  cleanup: Optional[Callable[[], None]] = None,
+                  on_start: Optional[Callable[[], None]] = None) -> List[Any]:
+        """
+        Submit a request and wait for its ImageResults without blocking the event loop.
+
+        Sequences whose image content, prompt and pipeline config were seen
+        before are answered from the result cache without running inference.
+
+        on_start() is called from the worker thread when inference starts;
+        it is not called for a result cache hit.
+        cleanup() is called once the worker no longer reads the image files.
+        After a timeout a request still in the queue is cancelled, and one
+        already running is cleaned up when it finishes.
+        """
+        future: Optional[Future] = None
+        try:
+            key = None
+            loop = asyncio.get_running_loop()
+            if settings.RESULT_CACHE_ENABLED:
+                # Hashing the images and the cache's disk reads and writes run off the event loop
+                key = await loop.run_in_executor(None, result_cache.make_key, image_paths, class_names)
+                cached = await loop.run_in_executor(None, result_cache.get, key)
+                # Entries written before degraded results were skipped are not reused
+                if cached is not None and not any(result.degraded for result in cached):
+                    logger.info(f"Result cache hit for {len(image_paths)} images")
+                    return cached
+
+            future = self.submit(image_paths, class_names, progress, on_start)
+            # On timeout wait_for cancels the wrapper, which cancels a queued request
+            results = await asyncio.wait_for(asyncio.wrap_future(future), timeout=timeout)
+            # A refinement that failed is not cached: the next identical request retries it
+            if key is not None and not any(result.degraded for result in results):
+                await loop.run_in_executor(None, result_cache.put, key, results)
+            return results
+        finally:
+            if cleanup is not None:
+                if future is None:
+                    cleanup()
+                else:
+                    # Runs now if the request is done or cancelled, else when it finishes
+                    future.add_done_callback(lambda _: cleanup())
+
+    def _load_agent(self):
+        try:
+            from backend_model import model_cache
+            from backend_model.planning_agent import PlanningAgent
+            from backend_model.stage_cache import StageCache
+
+            onnx = {}
+            if settings.ONNX_RUNTIME:
+                onnx = {"onnx_dir": os.path.join(settings.MODEL_CACHE_DIR, "onnx"),
+                        "onnx_threads": settings.ONNX_INTRA_OP_THREADS}
+            model_cache.configure("detection", **onnx)
+            model_cache.configure("depth", model_type=settings.MIDAS_MODEL, cache_dir=settings.MODEL_CACHE_DIR,
+                                  native_transform=settings.MIDAS_NATIVE_TRANSFORM, **onnx)
+            model_cache.configure("segmentation", model_name=settings.SAM2_MODEL, precision=settings.SAM2_PRECISION,
+                                  embedding_cache_size=settings.SAM_EMBEDDING_CACHE_SIZE,
+                                  prompt_chunk=settings.SAM_PROMPT_CHUNK, **onnx)
+            model_cache.configure("gemini", model_id=settings.GEMINI_MODEL, base_url=settings.GEMINI_BASE_URL,
+                                  max_concurrency=settings.GEMINI_MAX_CONCURRENCY,
+                                  max_retries=settings.GEMINI_MAX_RETRIES, timeout=settings.GEMINI_TIMEOUT,
+                                  cache_size=settings.GEMINI_CACHE_SIZE, payload=settings.GEMINI_PAYLOAD,
+                                  crop_max_side=settings.GEMINI_CROP_MAX_SIDE,
+                                  coalesce_window=settings.GEMINI_COALESCE_WINDOW,
+                                  coalesce_max_images=settings.GEMINI_COALESCE_MAX_IMAGES,
+                                  coalesce_max_bytes=settings.GEMINI_COALESCE_MAX_BYTES,
+                                  coalesce_max_tokens=settings.GEMINI_COALESCE_MAX_TOKENS)
+
+            stage_cache = None
+            if settings.STAGE_CACHE_ENABLED:
+                stage_cache = StageCache(settings.STAGE_CACHE_DIR, settings.STAGE_CACHE_MAX_BYTES)
+
+            tracker_options = None
+            if settings.SHELF_TRACKING:
+                tracker_options = {"change_threshold": settings.SHELF_CHANGE_THRESHOLD,
+                                   "pixel_threshold": settings.SHELF_PIXEL_THRESHOLD}
+
+            pipeline = None
+            if settings.PIPELINE_ENABLED:
+                pipeline = {stage: {"workers": workers,
+                                    "kind": "process" if stage in settings.PIPELINE_PROCESS_STAGES else "thread"}
+                            for stage, workers in settings.PIPELINE_WORKERS.items()}
+                for stage in settings.PIPELINE_PROCESS_STAGES:
+                    pipeline.setdefault(stage, {"workers": 1, "kind": "process"})
+
+            lazy = settings.MODEL_WARMUP == "lazy"
+            logger.info(f"Loading AI pipeline models ({settings.MODEL_WARMUP})...")
+            self._agent = PlanningAgent(lazy=lazy, warmup_workers=settings.MODEL_WARMUP_THREADS,
+                                        stage_cache=stage_cache, depth_roi=settings.DEPTH_ROI_UPSAMPLE,
+                                        depth_cascade=settings.DEPTH_CASCADE, tracker_options=tracker_options,
+                                        refine_async=settings.GEMINI_ASYNC, refine_deadline=settings.GEMINI_DEADLINE,
+                                        refine_workers=settings.GEMINI_MAX_CONCURRENCY, pipeline=pipeline,
+                                        pipeline_queue_size=settings.PIPELINE_QUEUE_SIZE)
+            logger.info("AI pipeline models loaded")
+        except Exception as e:
+            self._load_error = e
+            logger.error(f"Failed to load AI pipeline models: {e}")
+        finally:
+            self._ready.set()
+
+    def _run(self, load: bool):
+        if load:
+            self._load_agent()
+        else:
+            self._ready.wait()
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            future, image_paths, class_names, progress, on_start = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            if on_start is not None:
+                on_start()
+            try:
+                if self._load_error is not None:
+                    raise RuntimeError(f"AI pipeline unavailable: {self._load_error}")
+                from backend_model.stock_estimation_depth import SequenceState
+
+                # Each request is its own image sequence with its own state
+                logger.info(f"Processing images: {image_paths}")
+                state = SequenceState()
+                results = self._agent.process_batch(
+                    image_paths, class_names, batch_size=settings.BATCH_SIZE, progress=progress, state=state)
+                if settings.DEPTH_CASCADE:
+                    logger.info(f"Depth computed for {state.depth_computed}, "
+                                f"skipped for {state.depth_skipped} of {len(image_paths)} images")
+                    with self._stats_lock:
+                        self._depth_stats["computed"] += state.depth_computed
+                        self._depth_stats["skipped"] += state.depth_skipped
+                if state.tracker is not None:
+                    for frame in state.tracker.frames:
+                        logger.info(f"{frame['image']}: rescored {frame['rescored']}, "
+                                    f"skipped {frame['skipped']} of {frame['sections']} sections")
+                    with self._stats_lock:
+                        for key, value in state.tracker.stats().items():
+                            self._tracking_stats[key] += value
+                future.set_result(results)
+            except Exception as e:
+                logger.error(f"Inference failed: {e}")
+                future.set_exception(e)
+
+
+# Shared worker instance used by the API routes
+inference_worker = InferenceWorker()
@@ -0,0 +1,266 @@
+"""
+Asynchronous job queue for long-running stock estimations.
+"""
+
+import asyncio
+import logging
+import shutil
+import time
+import uuid
+from collections import deque
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from app.core.config import settings
+from app.models.schemas import JobStatus
+from app.services.inference_worker import inference_worker, image_result_to_products
+
+logger = logging.getLogger(__name__)
+
+
+def _timing_stats(samples) -> Dict[str, float]:
+    """Summarize a window of timing samples."""
+    if not samples:
+        return {"count": 0, "mean": 0.0, "p50": 0.0, "p95": 0.0, "max": 0.0}
+    ordered = sorted(samples)
+    n = len(ordered)
+    return {
+        "count": n,
+        "mean": sum(ordered) / n,
+        "p50": ordered[int(0.5 * (n - 1))],
+        "p95": ordered[int(0.95 * (n - 1))],
+        "max": ordered[-1],
+    }
+
+
+class Job:
+    """A single estimation request and its progress events."""
+
+    def __init__(self, image_paths: List[str], class_names: str, work_dir: Optional[str] = None):
+        self.id = uuid.uuid4().hex
+        self.image_paths = image_paths
+        self.class_names = class_names
+        self.work_dir = work_dir
+        self.status = JobStatus.QUEUED
+        self.stage: Optional[str] = None
+        self.images_done = 0
+        self.created_at = datetime.now()
+        self.started_at: Optional[datetime] = None
+        self.finished_at: Optional[datetime] = None
+        self.enqueued = time.monotonic()
+        self.started: Optional[float] = None
+        self.wait_time: Optional[float] = None
+        self.service_time: Optional[float] = None
+        self.results: Optional[Dict[str, List[Any]]] = None
+        self.error: Optional[str] = None
+        self.events: List[Dict[str, Any]] = []
+        self._subscribers: List[asyncio.Queue] = []
+
+    @property
+    def finished(self) -> bool:
+        return self.status in (JobStatus.COMPLETED, JobStatus.FAILED)
+
+    @property
+    def progress(self) -> float:
+        return self.images_done / len(self.image_paths) if self.image_paths else 0.0
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "stage": self.stage,
+            "progress": self.progress,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "wait_time": self.wait_time,
+            "service_time": self.service_time,
+            "results": self.results,
+            "error": self.error,
+        }
+
+    def publish(self, event: Dict[str, Any]):
+        """Record an event and forward it to live subscribers (event loop thread only)."""
+        event = {"job_id": self.id, "timestamp": datetime.now().isoformat(), **event}
+        self.events.append(event)
+        for subscriber in self._subscribers:
+            subscriber.put_nowait(event)
+
+    def subscribe(self) -> asyncio.Queue:
+        """Return a queue that replays past events and then receives new ones."""
+        subscriber: asyncio.Queue = asyncio.Queue()
+        for event in self.events:
+            subscriber.put_nowait(event)
+        self._subscribers.append(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: asyncio.Queue):
+        if subscriber in self._subscribers:
+            self._subscribers.remove(subscriber)
+
+
+class JobManager:
+    """Bounded pool of async workers feeding jobs to the inference worker."""
+
+    def __init__(self, workers: int = settings.JOB_WORKERS,
+                 max_queue_size: int = settings.JOB_QUEUE_SIZE,
+                 window: int = 1000):
+        self.workers = workers
+        self.max_queue_size = max_queue_size
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self.jobs: Dict[str, Job] = {}
+        self.running = 0
+        self.counters = {"submitted": 0, "completed": 0, "failed": 0, "rejected": 0}
+        self.wait_times = deque(maxlen=window)
+        self.service_times = deque(maxlen=window)
+
+    def start(self):
+        """Start the worker tasks on the running event loop."""
+        if self._tasks:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue(maxsize=self.max_queue_size)
+        self._tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+        logger.info(f"Job manager started with {self.workers} workers")
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        logger.info("Job manager stopped")
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def submit(self, image_paths: List[str], class_names: str, work_dir: Optional[str] = None) -> Job:
+        """Queue a job; raises RuntimeError when the queue is full or not running."""
+        if self._queue is None:
+            raise RuntimeError("Job manager is not running")
+        self._prune()
+        job = Job(image_paths, class_names, work_dir)
+        try:
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            self.counters["rejected"] += 1
+            raise RuntimeError("Job queue is full, try again later")
+        self.jobs[job.id] = job
+        self.counters["submitted"] += 1
+        job.publish({"type": "status", "status": job.status})
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        return self.jobs.get(job_id)
+
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            "workers": self.workers,
+            "queue_depth": self.queue_depth,
+            "queue_capacity": self.max_queue_size,
+            "running": self.running,
+            **self.counters,
+            "wait_time": _timing_stats(self.wait_times),
+            "service_time": _timing_stats(self.service_times),
+        }
+
+    def _prune(self):
+        """Forget finished jobs older than the retention period."""
+        now = datetime.now()
+        expired = [
+            job_id for job_id, job in self.jobs.items()
+            if job.finished and (now - job.finished_at).total_seconds() > settings.JOB_RETENTION
+        ]
+        for job_id in expired:
+            del self.jobs[job_id]
+
+    def _mark_started(self, job: Job, started: float):
+        """Record the job's wait time and publish that it is running (event loop thread only)."""
+        if job.started is not None:
+            return
+        job.started = started
+        job.started_at = datetime.now()
+        job.wait_time = started - job.enqueued
+        self.wait_times.append(job.wait_time)
+        if job.status == JobStatus.QUEUED:
+            job.status = JobStatus.RUNNING
+            job.publish({"type": "status", "status": job.status})
+
+    def _start_callback(self, job: Job):
+        """Build a callback that marks the job started, safe to call from the inference thread."""
+        def on_start():
+            # The wait ends when the inference thread takes the request, which
+            # includes the time queued in the inference worker
+            started = time.monotonic()
+            self._loop.call_soon_threadsafe(self._mark_started, job, started)
+        return on_start
+
+    def _progress_callback(self, job: Job):
+        """Build a progress callback that is safe to call from the inference thread."""
+        def on_progress(stage: str, index: int, total: int):
+            def update():
+                job.stage = stage
+                # Images are scored in order, so every image before the one being
+                # scored is done; the other stages start out of order when batched
+                # or pipelined
+                if stage == "scoring":
+                    job.images_done = max(job.images_done, index)
+                job.publish({"type": "progress", "stage": stage, "image": index, "total": total})
+            self._loop.call_soon_threadsafe(update)
+        return on_progress
+
+    async def _worker(self, worker_id: int):
+        while True:
+            job = await self._queue.get()
+            try:
+                await self._run_job(job)
+            finally:
+                self._queue.task_done()
+
+    async def _run_job(self, job: Job):
+        self.running += 1
+        cleanup = None
+        if job.work_dir:
+            work_dir = job.work_dir
+            cleanup = lambda: shutil.rmtree(work_dir, ignore_errors=True)
+        try:
+            # The worker removes the uploads once inference is done with them,
+            # which after a timeout can be later than this job finishing
+            image_results = await inference_worker.run(
+                job.image_paths, job.class_names,
+                timeout=settings.JOB_TIMEOUT,
+                progress=self._progress_callback(job),
+                cleanup=cleanup,
+                on_start=self._start_callback(job))
+            job.results = {
+                f"T{i}": image_result_to_products(image_result)
+                for i, image_result in enumerate(image_results)
+            }
+            job.images_done = len(job.image_paths)
+            job.status = JobStatus.COMPLETED
+            self.counters["completed"] += 1
+        except Exception as e:
+            logger.error(f"Job {job.id} failed: {e}")
+            job.error = str(e) or type(e).__name__
+            job.status = JobStatus.FAILED
+            self.counters["failed"] += 1
+        finally:
+            self.running -= 1
+            # A result cache hit or a job that timed out in the inference
+            # queue never started on a worker; its wait lasted until now
+            self._mark_started(job, time.monotonic())
+            job.service_time = time.monotonic() - job.started
+            self.service_times.append(job.service_time)
+            job.finished_at = datetime.now()
+            job.stage = None
+
+        results = None
+        if job.results is not None:
+            results = {key: [r.model_dump(mode="json") for r in items] for key, items in job.results.items()}
+        job.publish({"type": "status", "status": job.status, "results": results, "error": job.error})
+
+
+# Shared job manager used by the API routes
+job_manager = JobManager()
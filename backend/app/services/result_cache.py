@@ -0,0 +1,164 @@
+"""
+Content-addressed cache of pipeline results.
+
+Keys are a hash of the image bytes, the class prompt and the pipeline
+configuration, so re-uploads of an unchanged shelf frame skip inference.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import sys
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+from app.core.config import settings
+
+# Add the project root to the path so the backend_model package can be imported
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..'))
+if project_root not in sys.path:
+    sys.path.append(project_root)
+
+from backend_model.results import ImageResult, PIPELINE_VERSION
+
+logger = logging.getLogger(__name__)
+
+# Settings that change pipeline output and therefore belong in the cache key.
+# GEMINI_ASYNC, GEMINI_DEADLINE and GEMINI_COALESCE_* are left out: they only
+# decide whether a refinement completes, and degraded results are never stored.
+CONFIG_KEYS = ["BATCH_SIZE", "DEPTH_ROI_UPSAMPLE", "MIDAS_MODEL", "MIDAS_NATIVE_TRANSFORM", "DEPTH_CASCADE",
+              "SAM2_MODEL", "SAM2_PRECISION", "ONNX_RUNTIME", "SHELF_TRACKING", "SHELF_CHANGE_THRESHOLD",
+              "SHELF_PIXEL_THRESHOLD", "GEMINI_MODEL", "GEMINI_PAYLOAD", "GEMINI_CROP_MAX_SIDE"]
+
+
+def config_fingerprint() -> str:
+    """Stable description of the pipeline version and output-affecting settings."""
+    config = {key: getattr(settings, key) for key in CONFIG_KEYS}
+    return json.dumps({"pipeline": PIPELINE_VERSION, **config}, sort_keys=True)
+
+
+def hash_file(path: str) -> str:
+    """SHA-256 of a file's content."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """Two-tier cache: an in-memory LRU in front of a size-bounded directory."""
+
+    def __init__(self, cache_dir: str = settings.RESULT_CACHE_DIR,
+                 max_entries: int = settings.RESULT_CACHE_MEMORY_ENTRIES,
+                 max_disk_bytes: int = settings.RESULT_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.max_disk_bytes = max_disk_bytes
+        self._memory: "OrderedDict[str, List[ImageResult]]" = OrderedDict()
+        # key -> file size, ordered from least to most recently used
+        self._disk: Optional["OrderedDict[str, int]"] = None
+        self._disk_bytes = 0
+        self._lock = threading.Lock()
+        self.counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+
+    def make_key(self, image_paths: List[str], class_names: str) -> str:
+        """Key for an image sequence: content hashes in order, prompt and pipeline config."""
+        digest = hashlib.sha256()
+        digest.update(config_fingerprint().encode())
+        digest.update(class_names.encode())
+        for path in image_paths:
+            digest.update(hash_file(path).encode())
+        return digest.hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def _load_index(self):
+        """Scan the cache directory once, oldest files first."""
+        if self._disk is not None:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".json"):
+                stat = os.stat(os.path.join(self.cache_dir, name))
+                entries.append((stat.st_mtime, name[:-len(".json")], stat.st_size))
+        self._disk = OrderedDict((key, size) for _, key, size in sorted(entries))
+        self._disk_bytes = sum(self._disk.values())
+
+    def _remember(self, key: str, results: List[ImageResult]):
+        self._memory[key] = results
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def get(self, key: str) -> Optional[List[ImageResult]]:
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.counters["memory_hits"] += 1
+                return self._memory[key]
+
+            self._load_index()
+            if key in self._disk:
+                try:
+                    with open(self._path(key), "r", encoding="utf-8") as f:
+                        results = [ImageResult.from_dict(item) for item in json.load(f)]
+                    os.utime(self._path(key))
+                    self._disk.move_to_end(key)
+                    self._remember(key, results)
+                    self.counters["disk_hits"] += 1
+                    return results
+                except (OSError, ValueError, KeyError) as e:
+                    logger.warning(f"Dropping unreadable cache entry {key}: {e}")
+                    self._disk_bytes -= self._disk.pop(key)
+
+            self.counters["misses"] += 1
+            return None
+
+    def put(self, key: str, results: List[ImageResult]):
+        with self._lock:
+            self._remember(key, results)
+            self._load_index()
+            data = json.dumps([r.to_dict() for r in results]).encode("utf-8")
+            try:
+                with open(self._path(key), "wb") as f:
+                    f.write(data)
+            except OSError as e:
+                logger.warning(f"Failed to write cache entry {key}: {e}")
+                return
+            self._disk_bytes += len(data) - self._disk.pop(key, 0)
+            self._disk[key] = len(data)
+            self.counters["stores"] += 1
+            self._evict()
+
+    def _evict(self):
+        """Delete least recently used files until the directory fits its byte budget."""
+        while self._disk_bytes > self.max_disk_bytes and self._disk:
+            key, size = self._disk.popitem(last=False)
+            self._disk_bytes -= size
+            self.counters["evictions"] += 1
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.counters["memory_hits"] + self.counters["disk_hits"] + self.counters["misses"]
+            hits = self.counters["memory_hits"] + self.counters["disk_hits"]
+            return {
+                **self.counters,
+                "hit_rate": hits / lookups if lookups else 0.0,
+                "memory_entries": len(self._memory),
+                "disk_entries": len(self._disk) if self._disk is not None else None,
+                "disk_bytes": self._disk_bytes if self._disk is not None else None,
+                "max_disk_bytes": self.max_disk_bytes,
+            }
+
+
+# Shared cache instance used by the inference worker
+result_cache = ResultCache()
@@ -0,0 +1,994 @@
+"""
+Benchmarks for the stock estimation pipeline.
+
+Usage (from the project root):
+    python -m backend_model.benchmark batch dataset/T0.jpg dataset/T1.jpg ...
+    python -m backend_model.benchmark concurrency dataset/T0.jpg dataset/T1.jpg ... --requests 4
+    python -m backend_model.benchmark rescore dataset/T0.jpg ... --min-diff 0.02
+    python -m backend_model.benchmark nms --sizes 100 500 1000 5000
+    python -m backend_model.benchmark detection dataset/T0.jpg dataset/T1.jpg ...
+    python -m backend_model.benchmark decode dataset/T0.jpg dataset/T1.jpg ...
+    python -m backend_model.benchmark masks --sections 50 --height 3000 --width 4000
+    python -m backend_model.benchmark scoring --sections 10 50 100 500
+    python -m backend_model.benchmark depth-roi --sections 50 --height 3000 --width 4000
+    python -m backend_model.benchmark depth-backends dataset/T0.jpg ... --backends MiDaS_small depth-anything-v2-small
+    python -m backend_model.benchmark depth-backends dataset/T0.jpg ... --backends DPT_Hybrid --native-transform
+    python -m backend_model.benchmark cascade dataset/T0.jpg dataset/T1.jpg ...
+    python -m backend_model.benchmark prompts dataset/T0.jpg --prompts 10 50 200
+    python -m backend_model.benchmark sam-variants front_end/app/assets/sampleImages/*.jpg --precisions fp32 int8
+    python -m backend_model.benchmark onnx dataset/T0.jpg ... --onnx-dir backend/model_cache/onnx --threads 4
+    python -m backend_model.benchmark tracking dataset/T0.jpg dataset/T1.jpg ... --change-threshold 0.05
+    python -m backend_model.benchmark gemini dataset/T0.jpg dataset/T1.jpg ... --requests 32 --rate-limit-every 5
+    python -m backend_model.benchmark gemini dataset/T0.jpg ... --payloads full mosaic --mbps 20 --rate-limit-every 0
+    python -m backend_model.benchmark refinement dataset/T0.jpg ... dataset/T9.jpg --latency 2 --deadline 5
+    python -m backend_model.benchmark gemini dataset/T0.jpg ... dataset/T9.jpg --coalesce-window 0.05 --rate-limit-every 0
+    python -m backend_model.benchmark pipeline dataset/T0.jpg ... dataset/T9.jpg --workers depth=2 --process-stages depth
+"""
+import argparse
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+from backend_model.results import ImageResult, SOURCE_GEMINI
+
+CLASS_NAMES = 'potato section . onion . eggplant section . tomato . cucumber .'
+
+
+def _timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def bench_batch(args):
+    # Images/sec of the per-image loop (as in main.py) against process_batch
+    from backend_model.planning_agent import PlanningAgent
+
+    agent = PlanningAgent()
+    n = len(args.images)
+
+    def loop():
+        agent.reset()
+        return [agent.process_image(path, args.class_names) for path in args.images]
+
+    def batch():
+        agent.reset()
+        return agent.process_batch(args.images, args.class_names, batch_size=args.batch_size)
+
+    # Warm-up so lazy initialisation is not charged to the first variant
+    agent.reset()
+    agent.process_image(args.images[0], args.class_names)
+
+    loop_results, loop_time = _timed(loop)
+    batch_results, batch_time = _timed(batch)
+
+    print(f"\nImages: {n}, batch size: {args.batch_size or n}")
+    print(f"loop          : {loop_time:.2f}s  {n / loop_time:.3f} images/sec")
+    print(f"process_batch : {batch_time:.2f}s  {n / batch_time:.3f} images/sec")
+    print(f"speedup       : {loop_time / batch_time:.2f}x")
+    same = sum(len(a.sections) == len(b.sections) for a, b in zip(loop_results, batch_results))
+    print(f"images with the same section count: {same}/{n}")
+
+
+def bench_concurrency(args):
+    # Serial vs parallel wall time of N image sequences; tests/test_concurrency.py
+    # checks that parallel results match their serial run
+    from backend_model.planning_agent import PlanningAgent
+
+    agent = PlanningAgent()
+    n = len(args.images)
+    # Every request gets a different rotation of the images
+    sequences = [args.images[i % n:] + args.images[:i % n] for i in range(args.requests)]
+
+    _, serial_time = _timed(lambda: [agent.process_batch(seq, args.class_names) for seq in sequences])
+    with ThreadPoolExecutor(max_workers=args.requests) as pool:
+        _, parallel_time = _timed(
+            lambda: list(pool.map(lambda seq: agent.process_batch(seq, args.class_names), sequences)))
+
+    print(f"\nRequests: {args.requests} x {n} images")
+    print(f"serial   : {serial_time:.2f}s")
+    print(f"parallel : {parallel_time:.2f}s")
+
+
+def bench_rescore(args):
+    # Cold run fills the stage cache; re-scoring with new thresholds only reads it
+    import tempfile
+    from backend_model.planning_agent import PlanningAgent
+    from backend_model.stage_cache import StageCache
+
+    cache = StageCache(args.cache_dir or tempfile.mkdtemp())
+    agent = PlanningAgent(stage_cache=cache)
+    score_params = {"min_diff": args.min_diff, "min_obj_pixels": args.min_obj_pixels,
+                    "min_pixels": args.min_pixels}
+
+    # Gemini is a network call, timed separately from the local stages
+    refine = agent.refine
+    agent.refine = lambda image, stock_dict, pos_dic: ImageResult.from_stock_dict(image.name, stock_dict, pos_dic)
+    try:
+        _, cold_time = _timed(agent.process_batch, args.images, args.class_names)
+        _, warm_time = _timed(agent.process_batch, args.images, args.class_names, score_params=score_params)
+    finally:
+        agent.refine = refine
+
+    n = len(args.images)
+    print(f"\nImages: {n}")
+    print(f"cold (models)         : {cold_time * 1000 / n:.1f} ms/image")
+    print(f"re-score (stage cache): {warm_time * 1000 / n:.1f} ms/image")
+    print(f"cache: {cache.stats()}")
+
+
+def _nms_reference(model, xyxy, scores, iou_thr=0.5, contain_thr=0.9):
+    # Previous per-box implementation of DetectionModel.nms_class_agnostic, timed against it
+    xyxy = np.asarray(xyxy, dtype=float)
+    scores = np.asarray(scores, dtype=float)
+    idxs = np.argsort(-scores)
+    keep = []
+    while idxs.size > 0:
+        i = idxs[0]
+        keep.append(i)
+        if idxs.size == 1:
+            break
+        rest = idxs[1:]
+        ious = model.iou_matrix(xyxy[i], xyxy[rest])
+        contain = []
+        for j in rest:
+            inter_x1 = max(xyxy[i][0], xyxy[j][0])
+            inter_y1 = max(xyxy[i][1], xyxy[j][1])
+            inter_x2 = min(xyxy[i][2], xyxy[j][2])
+            inter_y2 = min(xyxy[i][3], xyxy[j][3])
+            inter_area = max(0, inter_x2 - inter_x1) * max(0, inter_y2 - inter_y1)
+            area_j = (xyxy[j][2] - xyxy[j][0]) * (xyxy[j][3] - xyxy[j][1])
+            if area_j > 0 and inter_area / area_j > contain_thr:
+                contain.append(j)
+        mask = (ious <= iou_thr)
+        idxs = rest[mask & (~np.isin(rest, contain))]
+    return sorted(keep)
+
+
+def _synthetic_boxes(rng, n, width=1920, height=1080):
+    # Clustered boxes like a dense shelf: overlapping duplicates plus nested boxes
+    centers = rng.uniform([0, 0], [width, height], size=(max(1, n // 8), 2))
+    c = centers[rng.integers(0, len(centers), n)] + rng.normal(0, 20, size=(n, 2))
+    wh = rng.uniform(20, 300, size=(n, 2))
+    xyxy = np.concatenate([c - wh / 2, c + wh / 2], axis=1)
+    # A few degenerate boxes and exact score ties exercise the edge cases
+    xyxy[: n // 50, 2] = xyxy[: n // 50, 0]
+    scores = np.round(rng.uniform(0.1, 1.0, n), 2)
+    return xyxy.tolist(), scores.tolist()
+
+
+def bench_nms(args):
+    # Vectorized nms_class_agnostic against the per-box reference; tests/test_nms.py
+    # checks that both keep the same boxes
+    from backend_model.detection_model import DetectionModel
+
+    model = DetectionModel()
+    rng = np.random.default_rng(args.seed)
+    print(f"\n{'boxes':>6} {'reference':>12} {'vectorized':>12} {'speedup':>8} {'kept':>6}")
+    for n in args.sizes:
+        xyxy, scores = _synthetic_boxes(rng, n)
+        labels = ["tomato"] * n
+        _, ref_time = _timed(_nms_reference, model, xyxy, scores)
+        keep, vec_time = _timed(model.nms_class_agnostic, xyxy, scores, labels)
+        print(f"{n:>6} {ref_time * 1000:>10.1f}ms {vec_time * 1000:>10.1f}ms "
+              f"{ref_time / vec_time:>7.1f}x {len(keep):>6}")
+
+
+def bench_detection(args):
+    # Per-image GroundingDINO latency with and without the prompt token/feature cache
+    from PIL import Image
+    from backend_model.detection_model import DetectionModel
+
+    model = DetectionModel()
+    model.load_model()
+    images = [Image.open(path) for path in args.images]
+    model.detect(images[0], args.class_names)  # warm-up
+
+    timings = {}
+    for text_cache in (False, True):
+        model.text_cache = text_cache
+        outputs, elapsed = _timed(lambda: [model.detect(image, args.class_names)
+                                           for _ in range(args.repeat) for image in images])
+        timings[text_cache] = (outputs, elapsed / (args.repeat * len(images)))
+
+    (uncached, uncached_time), (cached, cached_time) = timings[False], timings[True]
+    print(f"\nImages: {len(images)} x {args.repeat}")
+    print(f"without cache : {uncached_time * 1000:.1f} ms/image")
+    print(f"with cache    : {cached_time * 1000:.1f} ms/image")
+    print(f"speedup       : {uncached_time / cached_time:.2f}x")
+    same = sum(np.allclose(a[0], b[0]) and a[1] == b[1] for a, b in zip(uncached, cached)
+               if len(a[0]) == len(b[0]))
+    print(f"detections matching the uncached run: {same}/{len(uncached)}")
+
+
+def _ingest_paths(path):
+    # What the stages did with a path before DecodedImage: every stage read and decoded the file itself
+    import hashlib
+    import cv2
+    from PIL import Image
+
+    with open(path, "rb") as f:
+        image_hash = hashlib.sha256(f.read()).hexdigest()          # stage cache key
+    detection = np.asarray(Image.open(path).convert("RGB"))        # GroundingDINO processor
+    segmentation = cv2.imread(path)                                 # ultralytics loader
+    depth = cv2.cvtColor(cv2.imread(path), cv2.COLOR_BGR2RGB)       # MiDaS
+    with open(path, "rb") as f:
+        gemini = f.read()                                           # Gemini request
+    return image_hash, detection, segmentation, depth, gemini
+
+
+def _ingest_decoded(path):
+    from backend_model.decoded_image import DecodedImage
+
+    image = DecodedImage(path)
+    return image.hash, image.rgb, image.bgr, image.rgb, image.data
+
+
+def bench_decode(args):
+    # Per-image ingestion cost of all stages: file reads, decodes, allocations and latency
+    import tracemalloc
+    from backend_model.decoded_image import DecodedImage
+
+    print(f"\nImages: {len(args.images)} x {args.repeat}")
+    print(f"{'variant':<14} {'ms/image':>9} {'reads':>6} {'decodes':>8} {'large allocs':>13} {'MB held':>8}")
+    for name, ingest, reads, decodes in (("paths", _ingest_paths, 5, 3), ("DecodedImage", _ingest_decoded, None, None)):
+        before = dict(DecodedImage.counters)
+        _, elapsed = _timed(lambda: [ingest(path) for _ in range(args.repeat) for path in args.images])
+        n = args.repeat * len(args.images)
+        if reads is None:
+            reads = (DecodedImage.counters["reads"] - before["reads"]) / n
+            decodes = (DecodedImage.counters["decodes"] - before["decodes"]) / n
+
+        # Buffers of 64KB or more still alive once every stage has its input
+        tracemalloc.start()
+        held = ingest(args.images[0])
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        large = [t for t in snapshot.traces if t.size >= 64 * 1024]
+        print(f"{name:<14} {elapsed * 1000 / n:>9.1f} {reads:>6g} {decodes:>8g} {len(large):>13} "
+              f"{sum(t.size for t in large) / 1e6:>8.1f}")
+        del held
+
+
+def _synthetic_segmentation(rng, sections, height, width):
+    # SAM-like Results: one box per section, an irregular blob mask inside each box
+    import torch
+    from ultralytics.engine.results import Results
+
+    xyxy, masks = [], torch.zeros((sections, height, width), dtype=torch.bool)
+    for i in range(sections):
+        w, h = rng.integers(width // 20, width // 6), rng.integers(height // 20, height // 6)
+        x1, y1 = rng.integers(0, width - w), rng.integers(0, height - h)
+        xyxy.append([x1, y1, x1 + w, y1 + h])
+        yy, xx = np.ogrid[:h, :w]
+        blob = ((xx - w / 2) / (w / 2)) ** 2 + ((yy - h / 2) / (h / 2)) ** 2 < rng.uniform(0.3, 1.2)
+        masks[i, y1:y1 + h, x1:x1 + w] = torch.from_numpy(blob)
+    boxes = torch.tensor([[*b, 0.9, i % 5] for i, b in enumerate(xyxy)], dtype=torch.float32)
+    names = dict(enumerate(["potato section", "onion", "eggplant section", "tomato", "cucumber"]))
+    orig_img = np.broadcast_to(np.zeros(1, dtype=np.uint8), (height, width, 3))
+    return [Results(orig_img, path="synthetic.jpg", names=names, boxes=boxes, masks=masks)]
+
+
+def _extract_masks_reference(results):
+    # Previous extract_masks: one full-resolution uint8 array per section
+    names = results[0].names
+    boxes = results[0].boxes.xyxy.cpu().numpy().tolist()
+    return [(names[int(results[0].boxes.cls[i])], boxes[i], m.cpu().numpy().astype(np.uint8))
+            for i, m in enumerate(results[0].masks.data)]
+
+
+def bench_masks(args):
+    # Peak host memory of extracting and scoring section masks: full-size arrays vs
+    # RoiMask; tests/test_masks.py checks that both score the same
+    import tracemalloc
+    from backend_model.stock_estimation_depth import DepthModel
+
+    model = DepthModel()
+    rng = np.random.default_rng(args.seed)
+    results_seg = _synthetic_segmentation(rng, args.sections, args.height, args.width)
+    depth_map = rng.random((args.height, args.width), dtype=np.float32)
+
+    def score(extract):
+        items = extract(results_seg)
+        return [(model.check_has_stock(mask, depth_map, box), model.estimate_fullness(mask, depth_map, box))
+                for _, box, mask in items]
+
+    print(f"\nSections: {args.sections} on {args.width}x{args.height}")
+    for name, extract in (("full masks", _extract_masks_reference), ("RoiMask", model.extract_masks)):
+        tracemalloc.start()
+        _, elapsed = _timed(score, extract)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"{name:<11}: peak {peak / 1e6:8.1f} MB  {elapsed * 1000:8.1f} ms")
+
+
+def _synthetic_items(rng, sections, height, width):
+    # extract_masks output for a synthetic shelf: (class, box, RoiMask) per section
+    from backend_model.roi import RoiMask
+
+    items = []
+    for i in range(sections):
+        w, h = rng.integers(width // 40, width // 8), rng.integers(height // 40, height // 8)
+        x1, y1 = rng.integers(0, width - w), rng.integers(0, height - h)
+        yy, xx = np.ogrid[:h, :w]
+        # Every fourth section is nearly empty, which is where the depth medians decide
+        fill = rng.uniform(0.0, 0.01) if i % 4 == 0 else rng.uniform(0.0, 1.5)
+        blob = ((xx - w / 2) / (w / 2)) ** 2 + ((yy - h / 2) / (h / 2)) ** 2 < fill
+        items.append((f"class{i % 5}", [float(x1), float(y1), float(x1 + w), float(y1 + h)],
+                      RoiMask(blob, (x1, y1, x1 + w, y1 + h))))
+    return items
+
+
+def bench_scoring(args):
+    # Per-section check_has_stock/estimate_fullness loop against DepthModel.score_sections;
+    # tests/test_scoring.py checks that both give the same scores
+    from backend_model.stock_estimation_depth import DepthModel
+
+    model = DepthModel()
+    rng = np.random.default_rng(args.seed)
+    depth_map = rng.random((args.height, args.width), dtype=np.float32)
+    # Flat depth patches make some sections empty, like a bare shelf
+    depth_map[: args.height // 3, : args.width // 3] = 0.5
+
+    def loop(items):
+        scored = []
+        for _, box, mask in items:
+            has_stock, _, _ = model.check_has_stock(mask, depth_map, box)
+            if not has_stock:
+                scored.append((0.0, 0))
+            else:
+                fullness, layers = model.estimate_fullness(mask, depth_map, box)
+                scored.append((float(fullness), int(layers)))
+        return scored
+
+    print(f"\n{'sections':>8} {'loop':>10} {'batched':>10} {'speedup':>8}")
+    for n in args.sections:
+        items = _synthetic_items(rng, n, args.height, args.width)
+        _, loop_time = _timed(loop, items)
+        _, batch_time = _timed(model.score_sections, items, depth_map)
+        print(f"{n:>8} {loop_time * 1000:>8.1f}ms {batch_time * 1000:>8.1f}ms {loop_time / batch_time:>7.2f}x")
+
+
+def bench_depth_roi(args):
+    # Full-resolution bicubic depth map against RoiDepthMap sampled only inside the
+    # sections; tests/test_depth_roi.py checks that they agree
+    import torch
+    import torch.nn.functional as F
+    from backend_model.roi import RoiDepthMap
+    from backend_model.stock_estimation_depth import DepthModel
+
+    model = DepthModel()
+    rng = np.random.default_rng(args.seed)
+    # A smooth network-resolution prediction with some fine detail
+    coarse = rng.random((args.net_height // 16, args.net_width // 16)).astype(np.float32)
+    prediction = F.interpolate(torch.from_numpy(coarse)[None, None], size=(args.net_height, args.net_width),
+                               mode="bilinear", align_corners=False).squeeze().numpy()
+    prediction += 0.05 * rng.random(prediction.shape, dtype=np.float32)
+    items = _synthetic_items(rng, args.sections, args.height, args.width)
+
+    def full_path():
+        # What get_depth does: upsample everything, then normalize
+        with torch.no_grad():
+            depth = F.interpolate(torch.from_numpy(prediction)[None, None], size=(args.height, args.width),
+                                  mode="bicubic", align_corners=False).squeeze().numpy()
+        depth = (depth - depth.min()) / (depth.max() - depth.min())
+        return depth, model.score_sections(items, depth)
+
+    def roi_path():
+        depth = RoiDepthMap(prediction, (args.height, args.width))
+        return depth, model.score_sections(items, depth)
+
+    (full, full_scores), full_time = _timed(full_path)
+    (roi, roi_scores), roi_time = _timed(roi_path)
+
+    errors = []
+    for _, box, _ in items:
+        x1, y1, x2, y2 = map(int, box)
+        errors.append(np.abs(full[y1:y2, x1:x2] - roi[y1:y2, x1:x2]).ravel())
+    errors = np.concatenate(errors)
+    agree = sum((a[0] > 0) == (b[0] > 0) for a, b in zip(full_scores, roi_scores))
+
+    print(f"\nSections: {args.sections} on {args.width}x{args.height}, network {args.net_width}x{args.net_height}")
+    print(f"full-res : {full_time * 1000:8.1f} ms  depth map {full.nbytes / 1e6:6.1f} MB")
+    print(f"ROI      : {roi_time * 1000:8.1f} ms  depth map {roi.nbytes / 1e6:6.1f} MB")
+    print(f"depth error inside sections: max {errors.max():.2e}, mean {errors.mean():.2e}")
+    print(f"has_stock agreement: {agree}/{len(items)}, identical scores: "
+          f"{sum(a == b for a, b in zip(full_scores, roi_scores))}/{len(items)}")
+
+
+def bench_depth_backends(args):
+    # ms/image of each depth backend and agreement of its has_stock decisions with the
+    # reference. The reference keeps the pipeline's transform; --native-transform
+    # applies to the other runs, so --backends DPT_Hybrid --native-transform
+    # compares DPT_Hybrid's two transforms.
+    import gc
+    from backend_model.decoded_image import DecodedImage
+    from backend_model.depth_backends import DEPTH_BACKENDS
+    from backend_model.model_cache import get_model
+    from backend_model.stock_estimation_depth import DepthModel
+
+    images = [DecodedImage(path) for path in args.images]
+    # Sections come from the regular detection + SAM stages, once per image
+    detection, segmentation = get_model("detection"), get_model("segmentation")
+    scorer = DepthModel(args.reference)
+    sections = []
+    for image in images:
+        xyxy, labels, _ = detection.detect(image.rgb, args.class_names)
+        sections.append(scorer.extract_masks(segmentation.segment(image, xyxy, labels)) if xyxy else [])
+
+    backends = args.backends or list(DEPTH_BACKENDS)
+    runs = [(args.reference, False)] + [(b, args.native_transform) for b in backends
+                                        if (b, args.native_transform) != (args.reference, False)]
+    decisions, timings = {}, {}
+    for name, native in runs:
+        label = f"{name} (native)" if native else name
+        model = DepthModel(name, cache_dir=args.cache_dir, native_transform=native)
+        model.load()
+        model.get_depth(images[0])  # warm-up
+        decisions[label] = []
+        for image, items in zip(images, sections):
+            depth_map, elapsed = _timed(model.get_depth, image)
+            timings.setdefault(label, []).append(elapsed)
+            decisions[label].extend(model.check_has_stock(mask, depth_map, box)[0] for _, box, mask in items)
+        del model
+        gc.collect()
+
+    reference = decisions[args.reference]
+    print(f"\nImages: {len(images)}, sections: {len(reference)}, reference: {args.reference}")
+    print(f"{'backend':<26} {'ms/image':>9} {'has_stock agreement':>20}")
+    for name, values in decisions.items():
+        agree = sum(a == b for a, b in zip(values, reference))
+        print(f"{name:<26} {np.mean(timings[name]) * 1000:>9.1f} "
+              f"{agree:>8}/{len(reference)} ({agree / max(len(reference), 1):.1%})")
+
+
+def bench_cascade(args):
+    # Eager depth for every image against the mask-first cascade: time, skip rate, same
+    # results; tests/test_cascade.py checks the results on stand-in models
+    from backend_model.planning_agent import PlanningAgent
+    from backend_model.stock_estimation_depth import SequenceState
+
+    agent = PlanningAgent()
+    # Gemini is a network call and not part of what the cascade changes
+    agent.refine = lambda image, stock_dict, pos_dic: ImageResult.from_stock_dict(image.name, stock_dict, pos_dic)
+    agent.process_batch(args.images[:1], args.class_names)  # warm-up
+
+    runs = {}
+    for cascade in (False, True):
+        agent.depth_cascade = cascade
+        state = SequenceState()
+        results, elapsed = _timed(agent.process_batch, args.images, args.class_names, state=state)
+        runs[cascade] = (results, elapsed, state)
+
+    (eager, eager_time, _), (cascaded, cascade_time, state) = runs[False], runs[True]
+    n = len(args.images)
+    print(f"\nImages: {n}")
+    print(f"eager depth : {eager_time * 1000 / n:.1f} ms/image")
+    print(f"cascade     : {cascade_time * 1000 / n:.1f} ms/image  "
+          f"(depth computed {state.depth_computed}, skipped {state.depth_skipped})")
+    same = sum(a.to_dict() == b.to_dict() for a, b in zip(eager, cascaded))
+    print(f"images with identical results: {same}/{n}")
+
+
+def bench_prompts(args):
+    # SAM.predict (image encoder every call) against decoding prompts on the cached embedding
+    from ultralytics import SAM
+    from backend_model.decoded_image import DecodedImage
+    from backend_model.segmentation_model import SegmentationModel
+
+    image = DecodedImage(args.image)
+    height, width = image.size
+    model = SegmentationModel(args.model, prompt_chunk=args.chunk)
+    model.load()
+    reference = SAM(args.model)
+    rng = np.random.default_rng(args.seed)
+    model.segment(image, *_synthetic_boxes(rng, 1, width, height))  # warm-up
+    reference.predict(image.bgr, bboxes=_synthetic_boxes(rng, 1, width, height)[0], verbose=False)
+
+    print(f"\nImage: {args.image} ({width}x{height}), prompt chunk: {args.chunk}")
+    print(f"{'prompts':>8} {'predict ms':>11} {'cold ms':>9} {'cached ms':>10} {'mask agreement':>15}")
+    for n in args.prompts:
+        xyxy, _ = _synthetic_boxes(rng, n, width, height)
+        labels = [str(i) for i in range(n)]
+        expected, predict_time = _timed(reference.predict, image.bgr, bboxes=xyxy, verbose=False)
+        model._embeddings.clear()
+        _, cold_time = _timed(model.segment, image, xyxy, labels)
+        results, cached_time = _timed(model.segment, image, xyxy, labels)
+        a, b = expected[0].masks, results[0].masks
+        agreement = 1.0 if a is None and b is None else float((a.data == b.data).float().mean())
+        print(f"{n:>8} {predict_time * 1000:>11.1f} {cold_time * 1000:>9.1f} {cached_time * 1000:>10.1f} "
+              f"{agreement:>15.6f}")
+    print(f"embeddings computed: {model.counters['embeddings']}, reused: {model.counters['embedding_hits']}")
+
+
+def _mask_ious(reference, results):
+    # IoU per box prompt; a mask kept by only one of the two models scores 0
+    def by_prompt(r):
+        if r.masks is None:
+            return {}
+        return {int(c): m for c, m in zip(r.boxes.data[:, 5].tolist(), r.masks.data.cpu())}
+
+    a, b = by_prompt(reference), by_prompt(results)
+    ious = []
+    for prompt in set(a) | set(b):
+        if prompt in a and prompt in b:
+            union = (a[prompt] | b[prompt]).sum().item()
+            ious.append((a[prompt] & b[prompt]).sum().item() / union if union else 1.0)
+        else:
+            ious.append(0.0)
+    return ious
+
+
+def bench_sam_variants(args):
+    # ms/image and mask IoU against the large fp32 model for each SAM2.1 size and precision
+    import gc
+    from backend_model.decoded_image import DecodedImage
+    from backend_model.model_cache import get_model
+    from backend_model.segmentation_model import SAM_VARIANTS, SegmentationModel
+
+    images = [DecodedImage(path) for path in args.images]
+    # Box prompts come from the regular detection stage, once per image
+    detection = get_model("detection")
+    prompts = [detection.detect(image.rgb, args.class_names)[:2] for image in images]
+
+    reference, runs = None, {}
+    configs = [(args.reference, "fp32")] + [
+        (variant, precision) for variant in args.variants for precision in args.precisions
+        if (variant, precision) != (args.reference, "fp32")
+    ]
+    for variant, precision in configs:
+        model = SegmentationModel(variant, precision=precision, embedding_cache_size=0)
+        model.load()
+        model.segment(images[0], *prompts[0])  # warm-up
+        results, timings = [], []
+        for image, (xyxy, labels) in zip(images, prompts):
+            result, elapsed = _timed(model.segment, image, xyxy, labels)
+            results.append(result[0])
+            timings.append(elapsed)
+        if reference is None:
+            reference = results
+        ious = [iou for a, b in zip(reference, results) for iou in _mask_ious(a, b)]
+        runs[(variant, precision)] = (np.mean(timings), ious)
+        del model
+        gc.collect()
+
+    print(f"\nImages: {len(images)}, prompts: {sum(len(xyxy) for xyxy, _ in prompts)}, "
+          f"reference: {args.reference} fp32")
+    print(f"{'model':<8} {'precision':<10} {'ms/image':>9} {'mean IoU':>9} {'min IoU':>8}")
+    for (variant, precision), (ms, ious) in runs.items():
+        name = next((k for k, v in SAM_VARIANTS.items() if v == variant), variant)
+        print(f"{name:<8} {precision:<10} {ms * 1000:>9.1f} {np.mean(ious) if ious else 1.0:>9.4f} "
+              f"{min(ious, default=1.0):>8.4f}")
+
+
+def _max_diff(expected, actual):
+    # Largest absolute difference; masked logits are -inf in both outputs
+    import torch
+
+    expected, actual = expected.float().cpu(), actual.float().cpu()
+    if not torch.equal(torch.isinf(expected), torch.isinf(actual)):
+        return float("inf")
+    finite = torch.isfinite(expected)
+    return float((expected[finite] - actual[finite]).abs().max()) if finite.any() else 0.0
+
+
+def bench_onnx(args):
+    # Parity and CPU latency of the exported graphs against PyTorch, same weights and inputs
+    from backend_model.decoded_image import DecodedImage
+    from backend_model.detection_model import DetectionModel
+    from backend_model.segmentation_model import SegmentationModel
+    from backend_model.stock_estimation_depth import DepthModel
+
+    images = [DecodedImage(path) for path in args.images]
+    options = {"onnx_dir": args.onnx_dir, "onnx_threads": args.threads}
+    rows = []
+
+    def compare(kind, model, run, shape):
+        # run() -> output tensors; model.onnx is switched off for the PyTorch pass
+        runner, model.onnx = model.onnx, None
+        run()  # warm-up
+        expected, torch_time = _timed(run)
+        model.onnx = runner
+        if runner.session(shape) is None:
+            return
+        run()
+        actual, onnx_time = _timed(run)
+        diff = max(_max_diff(a, b) for a, b in zip(expected, actual))
+        rows.append((kind, f"{shape[0]}x{shape[1]}", torch_time, onnx_time, diff))
+
+    if "detection" in args.models:
+        model = DetectionModel(args.detection_model, **options)
+        model.load_model()
+        for image in images:
+            inputs = model.prepare_inputs([image.rgb], args.class_names)
+            def outputs(inputs=inputs):
+                result = model.forward(inputs)
+                return [result.logits, result.pred_boxes]
+            compare("detection", model, outputs, inputs["pixel_values"].shape[-2:])
+
+    if "segmentation" in args.models:
+        model = SegmentationModel(args.sam_model, embedding_cache_size=0, **options)
+        model.load()
+        for image in images:
+            def embedding(image=image):
+                features, _ = model.embed(image)
+                return [features["image_embed"], *features["high_res_feats"]]
+            embedding()
+            compare("segmentation", model, embedding, model._predictor().imgsz)
+
+    if "depth" in args.models:
+        model = DepthModel(args.depth_model, cache_dir=args.cache_dir, **options)
+        model.load()
+        for image in images:
+            input_batch = model.transform(image.rgb).to(model.device)
+            compare("depth", model, lambda input_batch=input_batch: [model.predict(input_batch)],
+                    input_batch.shape[-2:])
+
+    print(f"\nONNX Runtime intra-op threads: {args.threads or 'default'}")
+    print(f"{'model':<13} {'input':>10} {'torch ms':>9} {'onnx ms':>9} {'speedup':>8} {'max abs diff':>13}")
+    for kind, size, torch_time, onnx_time, diff in rows:
+        print(f"{kind:<13} {size:>10} {torch_time * 1000:>9.1f} {onnx_time * 1000:>9.1f} "
+              f"{torch_time / onnx_time:>7.2f}x {diff:>13.2e}")
+    if not rows:
+        print("No exported graphs for these images; run python -m backend_model.onnx_export first")
+
+
+def bench_tracking(args):
+    # Every frame processed in full against rescoring only the changed sections
+    from backend_model.planning_agent import PlanningAgent
+    from backend_model.stock_estimation_depth import SequenceState
+
+    agent = PlanningAgent()
+    agent.refine = lambda image, stock_dict, pos_dic: ImageResult.from_stock_dict(image.name, stock_dict, pos_dic)
+    agent.process_batch(args.images[:1], args.class_names)  # warm-up
+
+    runs = {}
+    for options in (None, {"change_threshold": args.change_threshold, "pixel_threshold": args.pixel_threshold}):
+        agent.tracker_options = options
+        state = SequenceState()
+        results, elapsed = _timed(agent.process_batch, args.images, args.class_names, state=state)
+        runs[options is not None] = (results, elapsed, state)
+
+    (full, full_time, _), (tracked, tracked_time, state) = runs[False], runs[True]
+    n = len(args.images)
+    print(f"\nImages: {n}")
+    print(f"full     : {full_time * 1000 / n:.1f} ms/image")
+    print(f"tracking : {tracked_time * 1000 / n:.1f} ms/image")
+    print(f"{'image':<40} {'sections':>8} {'rescored':>8} {'skipped':>8} {'same':>5}")
+    for frame, a, b in zip(state.tracker.frames, full, tracked):
+        print(f"{frame['image'][-40:]:<40} {frame['sections']:>8} {frame['rescored']:>8} {frame['skipped']:>8} "
+              f"{str(a.to_dict()['sections'] == b.to_dict()['sections']):>5}")
+
+
+class _FakeGeminiHandler(BaseHTTPRequestHandler):
+    # generateContent with a fixed latency plus upload time at mbps; every
+    # rate_limit_every-th request is a 429. The answer fits both payloads, and
+    # is given per image id for a call with several images.
+    latency = 0.2
+    mbps = 0
+    rate_limit_every = 0
+    requests = 0
+    lock = threading.Lock()
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        size = len(body)
+        images = sum("inlineData" in part for content in json.loads(body).get("contents", [])
+                     for part in content.get("parts", []))
+        with self.lock:
+            type(self).requests += 1
+            limited = self.rate_limit_every and self.requests % self.rate_limit_every == 0
+        time.sleep(self.latency + (size * 8 / (self.mbps * 1e6) if self.mbps else 0))
+        if limited:
+            body = {"error": {"code": 429, "message": "Resource exhausted", "status": "RESOURCE_EXHAUSTED"}}
+            self._send(429, body, {"Retry-After": "0.1"})
+        else:
+            answer = {"onion": [50, 60], "S1": 50, "S2": 60}
+            if images > 1:
+                answer = {f"I{i + 1}": answer for i in range(images)}
+            text = json.dumps(answer)
+            self._send(200, {"candidates": [{"content": {"role": "model", "parts": [{"text": text}]}}]})
+
+    def _send(self, status, body, headers=None):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+def _fake_gemini(args):
+    # (server, base_url) of a fake Gemini server started in the background, or
+    # (None, args.base_url) when an endpoint is given
+    if args.base_url is not None:
+        return None, args.base_url
+    _FakeGeminiHandler.latency = args.latency
+    _FakeGeminiHandler.mbps = getattr(args, "mbps", 0)
+    _FakeGeminiHandler.rate_limit_every = getattr(args, "rate_limit_every", 0)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _FakeGeminiHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def bench_gemini(args):
+    # Pooled Gemini client against a local fake server: retries, cache hits,
+    # bytes sent and latency histogram per payload
+    from backend_model.decoded_image import DecodedImage
+    from backend_model.gemini_model import Gemini
+
+    server, base_url = _fake_gemini(args)
+
+    images = [DecodedImage(path) for path in args.images]
+    stock_dict = {"onion": [(0.0, 1), (0.0, 1), (50.0, 1)]}
+    pos_dic = {"onion": [0, 1]}
+
+    def sections(image):
+        # Two empty sections to refine and one that is not sent
+        height, width = image.bgr.shape[:2]
+        return {"onion": [[0.1 * width, 0.2 * height, 0.3 * width, 0.5 * height],
+                          [0.4 * width, 0.2 * height, 0.6 * width, 0.5 * height],
+                          [0.7 * width, 0.2 * height, 0.9 * width, 0.5 * height]]}
+
+    total_pos_dics = [sections(image) for image in images]
+    print(f"\nRequests: {args.requests} over {args.threads} threads, {args.concurrency} in flight at most")
+    for payload in args.payloads:
+        model = Gemini(base_url=base_url, max_concurrency=args.concurrency, max_retries=args.retries, backoff=0.1,
+                       payload=payload, crop_max_side=args.crop_max_side, coalesce_window=args.coalesce_window)
+        model.load()
+        model.api_key = model.api_key or "local"
+
+        def call(i):
+            index = i % len(images)
+            return model.stock_estimation(images[index], pos_dic, total_pos_dics[index], stock_dict)
+
+        with ThreadPoolExecutor(max_workers=args.threads) as pool:
+            results, elapsed = _timed(lambda: list(pool.map(call, range(args.requests))))
+
+        stats = model.stats()
+        latency = stats["latency"]
+        print(f"\npayload {payload}")
+        print(f"wall time : {elapsed * 1000:.1f} ms")
+        print(f"refined   : {sum(r is not None for r in results)}/{args.requests}")
+        print(f"calls {stats['calls']}, cache hits {stats['cache_hits']}, in-flight hits {stats['in_flight_hits']}, "
+              f"retries {stats['retries']}, errors {stats['errors']}")
+        if args.coalesce_window > 0:
+            print(f"coalesced calls {stats['coalesced_calls']} for {stats['coalesced_images']} images, "
+                  f"duplicates {stats['coalesced_duplicates']}")
+        print(f"bytes sent per call: {stats['bytes_sent'] / max(stats['calls'], 1):,.0f}")
+        print(f"mean round trip    : {latency['sum'] * 1000 / max(latency['count'], 1):.1f} ms")
+        for bound, count in latency["buckets"].items():
+            print(f"  <= {bound:>5} s  {count}")
+    if server is not None:
+        server.shutdown()
+
+
+def bench_refinement(args):
+    # End-to-end wall time with Gemini refinement inline against overlapped
+    # with the local stages of the next images; Gemini is a fake server
+    import os
+    from backend_model import model_cache
+    from backend_model.planning_agent import PlanningAgent
+    from backend_model.stock_estimation_depth import SequenceState
+
+    server, base_url = _fake_gemini(args)
+    if server is not None:
+        os.environ.setdefault("GEMINI_API_KEY", "local")
+    # No response cache, so both runs make the same calls
+    model_cache.configure("gemini", base_url=base_url, cache_size=0, max_concurrency=args.workers)
+    agent = PlanningAgent(refine_workers=args.workers)
+    agent.process_batch(args.images[:1], args.class_names)  # warm-up
+
+    runs = {}
+    for refine_async in (False, True):
+        agent.refine_async = refine_async
+        agent.refine_deadline = args.deadline if refine_async else None
+        calls = agent.gemini_model.stats()["calls"]
+        results, elapsed = _timed(agent.process_batch, args.images, args.class_names, state=SequenceState())
+        runs[refine_async] = (results, elapsed, agent.gemini_model.stats()["calls"] - calls)
+    if server is not None:
+        server.shutdown()
+
+    n = len(args.images)
+    print(f"\nImages: {n}, Gemini latency {args.latency} s, deadline {args.deadline} s")
+    for refine_async, (results, elapsed, calls) in runs.items():
+        refined = sum(section.source == SOURCE_GEMINI for result in results for section in result.sections)
+        label = "async refinement" if refine_async else "inline refinement"
+        print(f"{label:<18}: {elapsed:.2f} s end to end ({elapsed * 1000 / n:.1f} ms/image), "
+              f"Gemini calls {calls}, refined sections {refined}")
+
+
+def bench_pipeline(args):
+    # Stages in sequence per batch against the stage pipeline: wall time, same
+    # results, and utilization and queue wait per stage
+    from backend_model.planning_agent import PlanningAgent
+    from backend_model.stock_estimation_depth import SequenceState
+
+    workers = dict(item.split("=") for item in args.workers)
+    pipeline = {stage: {"workers": int(count), "kind": "process" if stage in args.process_stages else "thread"}
+                for stage, count in workers.items()}
+    for stage in args.process_stages:
+        pipeline.setdefault(stage, {"workers": 1, "kind": "process"})
+
+    agent = PlanningAgent(pipeline_queue_size=args.queue_size)
+    agent.refine = lambda image, stock_dict, pos_dic: ImageResult.from_stock_dict(image.name, stock_dict, pos_dic)
+    agent.process_batch(args.images[:1], args.class_names)  # warm-up
+
+    sequential, sequential_time = _timed(agent.process_batch, args.images, args.class_names, state=SequenceState())
+    agent.pipeline = pipeline
+    agent.process_batch(args.images[:1], args.class_names)  # starts the process workers
+    agent._stage_stats.clear()
+    pipelined, pipelined_time = _timed(agent.process_batch, args.images, args.class_names, state=SequenceState())
+
+    n = len(args.images)
+    print(f"\nImages: {n}")
+    print(f"sequential : {sequential_time:.2f} s ({sequential_time * 1000 / n:.1f} ms/image)")
+    print(f"pipelined  : {pipelined_time:.2f} s ({pipelined_time * 1000 / n:.1f} ms/image)")
+    same = sum(a.to_dict() == b.to_dict() for a, b in zip(sequential, pipelined))
+    print(f"images with identical results: {same}/{n}")
+    print(f"{'stage':<14} {'kind':<8} {'workers':>7} {'busy s':>8} {'utilization':>11} {'queue wait ms':>14}")
+    for name, stats in agent.stage_stats().items():
+        print(f"{name:<14} {stats['kind']:<8} {stats['workers']:>7} {stats['busy']:>8.2f} "
+              f"{stats['utilization']:>11.1%} {stats['mean_queue_wait'] * 1000:>14.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stock estimation pipeline benchmarks")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    p = subparsers.add_parser("batch", help="process_image loop vs process_batch throughput")
+    p.add_argument("images", nargs="+")
+    p.add_argument("--batch-size", type=int, default=None)
+    p.add_argument("--class-names", default=CLASS_NAMES)
+    p.set_defaults(func=bench_batch)
+
+    p = subparsers.add_parser("concurrency", help="serial vs parallel requests")
+    p.add_argument("images", nargs="+")
+    p.add_argument("--requests", type=int, default=4)
+    p.add_argument("--class-names", default=CLASS_NAMES)
+    p.set_defaults(func=bench_concurrency)
+
+    p = subparsers.add_parser("rescore", help="re-scoring from the stage cache with new thresholds")
+    p.add_argument("images", nargs="+")
+    p.add_argument("--cache-dir", default=None)
+    p.add_argument("--min-diff", type=float, default=0.02)
+    p.add_argument("--min-obj-pixels", type=int, default=200)
+    p.add_argument("--min-pixels", type=int, default=50)
+    p.add_argument("--class-names", default=CLASS_NAMES)
+    p.set_defaults(func=bench_rescore)
+
+    p = subparsers.add_parser("nms", help="vectorized vs per-box NMS speed on synthetic boxes")
+    p.add_argument("--sizes", type=int, nargs="+", default=[100, 500, 1000, 2000, 5000])
+    p.add_argument("--seed", type=int, default=0)
+    p.set_defaults(func=bench_nms)
+
+    p = subparsers.add_parser("detection", help="GroundingDINO latency with and without the prompt cache")
+    p.add_argument("images", nargs="+")
+    p.add_argument("--repeat", type=int, default=3)
+    p.add_argument("--class-names", default=CLASS_NAMES)
+    p.set_defaults(func=bench_detection)
+
+    p = subparsers.add_parser("decode", help="image reads, decodes and allocations per image")
+    p.add_argument("images", nargs="+")
+    p.add_argument("--repeat", type=int, default=5)
+    p.set_defaults(func=bench_decode)
+
+    p = subparsers.add_parser("masks", help="peak memory of full-size vs ROI-cropped section masks")
+    p.add_argument("--sections", type=int, default=50)
+    p.add_argument("--height", type=int, default=3000)
+    p.add_argument("--width", type=int, default=4000)
+    p.add_argument("--seed", type=int, default=0)
+    p.set_defaults(func=bench_masks)
+
+    p = subparsers.add_parser("scoring", help="per-section loop vs batched section scoring")
+    p.add_argument("--sections", type=int, nargs="+", default=[10, 50, 100, 200, 500])
+    p.add_argument("--height", type=int, default=1080)
+    p.add_argument("--width", type=int, default=1920)
+    p.add_argument("--seed", type=int, default=0)
+    p.set_defaults(func=bench_scoring)
+
+    p = subparsers.add_parser("depth-roi", help="full-resolution depth vs ROI-only upsampling")
+    p.add_argument("--sections", type=int, default=50)
+    p.add_argument("--height", type=int, default=3000)
+    p.add_argument("--width", type=int, default=4000)
+    p.add_argument("--net-height", type=int, default=384)
+    p.add_argument("--net-width", type=int, default=512)
+    p.add_argument("--seed", type=int, default=0)
+    p.set_defaults(func=bench_depth_roi)
+
+    p = subparsers.add_parser("depth-backends", help="latency and has_stock agreement of depth backends")
+    p.add_argument("images", nargs="+")
+    p.add_argument("--backends", nargs="+", default=None)
+    p.add_argument("--reference", default="DPT_Hybrid")
+    p.add_argument("--native-transform", action="store_true", help="DPT_Hybrid uses dpt_transform")
+    p.add_argument("--cache-dir", default=None)
+    p.add_argument("--class-names", default=CLASS_NAMES)
+    p.set_defaults(func=bench_depth_backends)
+
+    p = subparsers.add_parser("cascade", help="eager depth vs the mask-first depth cascade")
+    p.add_argument("images", nargs="+")
+    p.add_argument("--class-names", default=CLASS_NAMES)
+    p.set_defaults(func=bench_cascade)
+
+    p = subparsers.add_parser("prompts", help="SAM latency per prompt count with the cached image embedding")
+    p.add_argument("image")
+    p.add_argument("--prompts", type=int, nargs="+", default=[10, 50, 200])
+    p.add_argument("--model", default="sam2.1_l.pt")
+    p.add_argument("--chunk", type=int, default=32)
+    p.add_argument("--seed", type=int, default=0)
+    p.set_defaults(func=bench_prompts)
+
+    p = subparsers.add_parser("sam-variants", help="latency and mask IoU of SAM2.1 sizes and precisions")
+    p.add_argument("images", nargs="+")
+    p.add_argument("--variants", nargs="+", default=["tiny", "small", "base", "large"])
+    p.add_argument("--precisions", nargs="+", default=["fp32", "bf16", "int8"])
+    p.add_argument("--reference", default="large")
+    p.add_argument("--class-names", default=CLASS_NAMES)
+    p.set_defaults(func=bench_sam_variants)
+
+    p = subparsers.add_parser("onnx", help="parity and latency of ONNX Runtime against PyTorch")
+    p.add_argument("images", nargs="+")
+    p.add_argument("--onnx-dir", default="backend/model_cache/onnx")
+    p.add_argument("--threads", type=int, default=0)
+    p.add_argument("--models", nargs="+", default=["detection", "segmentation", "depth"])
+    p.add_argument("--detection-model", default="IDEA-Research/grounding-dino-base")
+    p.add_argument("--sam-model", default="sam2.1_l.pt")
+    p.add_argument("--depth-model", default="DPT_Hybrid")
+    p.add_argument("--cache-dir", default=None)
+    p.add_argument("--class-names", default=CLASS_NAMES)
+    p.set_defaults(func=bench_onnx)
+
+    p = subparsers.add_parser("tracking", help="full sequence processing vs the shelf-state tracker")
+    p.add_argument("images", nargs="+")
+    p.add_argument("--change-threshold", type=float, default=0.05)
+    p.add_argument("--pixel-threshold", type=int, default=25)
+    p.add_argument("--class-names", default=CLASS_NAMES)
+    p.set_defaults(func=bench_tracking)
+
+    p = subparsers.add_parser("gemini", help="pooled Gemini client against a local fake server")
+    p.add_argument("images", nargs="+")
+    p.add_argument("--requests", type=int, default=32)
+    p.add_argument("--threads", type=int, default=8)
+    p.add_argument("--concurrency", type=int, default=4)
+    p.add_argument("--retries", type=int, default=4)
+    p.add_argument("--latency", type=float, default=0.2, help="seconds per fake server response")
+    p.add_argument("--rate-limit-every", type=int, default=5, help="every n-th request is a 429, 0 for none")
+    p.add_argument("--mbps", type=float, default=0, help="upload bandwidth of the fake server, 0 for unlimited")
+    p.add_argument("--payloads", nargs="+", default=["full"], help="full, mosaic")
+    p.add_argument("--crop-max-side", type=int, default=512)
+    p.add_argument("--coalesce-window", type=float, default=0.0, help="seconds, 0 for one call per image")
+    p.add_argument("--base-url", default=None, help="use this endpoint instead of the fake server")
+    p.set_defaults(func=bench_gemini)
+
+    p = subparsers.add_parser("refinement", help="inline vs asynchronous Gemini refinement, end to end")
+    p.add_argument("images", nargs="+")
+    p.add_argument("--latency", type=float, default=2.0, help="seconds per fake Gemini response")
+    p.add_argument("--deadline", type=float, default=None, help="seconds before falling back to depth values")
+    p.add_argument("--workers", type=int, default=4)
+    p.add_argument("--base-url", default=None, help="use this endpoint instead of the fake server")
+    p.add_argument("--class-names", default=CLASS_NAMES)
+    p.set_defaults(func=bench_refinement)
+
+    p = subparsers.add_parser("pipeline", help="sequential stages vs the stage pipeline")
+    p.add_argument("images", nargs="+")
+    p.add_argument("--workers", nargs="*", default=["refinement=2"], help="stage=count")
+    p.add_argument("--process-stages", nargs="*", default=[], help="detection, segmentation, depth")
+    p.add_argument("--queue-size", type=int, default=2)
+    p.add_argument("--class-names", default=CLASS_NAMES)
+    p.set_defaults(func=bench_pipeline)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+from backend_model.imports import *
+import hashlib
+import threading
+
+
+class DecodedImage:
+    # One image shared by every pipeline stage. The file is read once and
+    # decoded once; the BGR/RGB arrays, PIL view, encoded bytes and content
+    # hash are built on first use and kept for the other stages.
+    # counters tracks file reads and decodes across all instances.
+    counters = {"reads": 0, "decodes": 0}
+    _counter_lock = threading.Lock()
+
+    def __init__(self, path=None, data=None, name=None):
+        if path is None and data is None:
+            raise ValueError("DecodedImage needs a path or encoded bytes")
+        self.path = path
+        # Name used in results and logs; in-memory uploads have no path
+        self.name = name or path or "image.jpg"
+        self._data = data
+        self._bgr = None
+        self._rgb = None
+        self._pil = None
+        self._hash = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def of(cls, image):
+        # Stages accept either a path or an already shared DecodedImage
+        return image if isinstance(image, cls) else cls(path=image)
+
+    @classmethod
+    def _count(cls, name):
+        with cls._counter_lock:
+            cls.counters[name] += 1
+
+    @property
+    def data(self):
+        # Encoded file bytes, as sent to Gemini and used for the content hash
+        if self._data is None:
+            with self._lock:
+                if self._data is None:
+                    with open(self.path, "rb") as f:
+                        self._data = f.read()
+                    self._count("reads")
+        return self._data
+
+    @property
+    def bgr(self):
+        # Decoded like cv2.imread, which is what ultralytics does for a path
+        if self._bgr is None:
+            data = self.data
+            with self._lock:
+                if self._bgr is None:
+                    bgr = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+                    if bgr is None:
+                        raise ValueError(f"Could not decode image {self.name}")
+                    self._count("decodes")
+                    self._bgr = bgr
+        return self._bgr
+
+    @property
+    def rgb(self):
+        if self._rgb is None:
+            bgr = self.bgr
+            with self._lock:
+                if self._rgb is None:
+                    self._rgb = cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB)
+        return self._rgb
+
+    @property
+    def pil(self):
+        if self._pil is None:
+            rgb = self.rgb
+            with self._lock:
+                if self._pil is None:
+                    self._pil = Image.fromarray(rgb)
+        return self._pil
+
+    @property
+    def hash(self):
+        if self._hash is None:
+            self._hash = hashlib.sha256(self.data).hexdigest()
+        return self._hash
+
+    @property
+    def mime_type(self):
+        if self.data[:8] == b"\x89PNG\r\n\x1a\n":
+            return "image/png"
+        if self.data[:4] == b"RIFF" and self.data[8:12] == b"WEBP":
+            return "image/webp"
+        return "image/jpeg"
+
+    @property
+    def size(self):
+        # (height, width), as used for target sizes and depth upsampling
+        return tuple(self.bgr.shape[:2])
+
+    def __getstate__(self):
+        # Process workers get the encoded bytes and decode them on their side
+        return {"path": self.path, "data": self.data, "name": self.name, "hash": self._hash}
+
+    def __setstate__(self, state):
+        self.__init__(path=state["path"], data=state["data"], name=state["name"])
+        self._hash = state["hash"]
+
+    def release(self):
+        # Drop the decoded arrays once every stage is done with the image
+        with self._lock:
+            self._bgr = self._rgb = self._pil = None
@@ -0,0 +1,73 @@
+from backend_model.imports import *
+from transformers import AutoImageProcessor, AutoModelForDepthEstimation
+
+# Relative inverse-depth estimators (larger = closer) selectable by name.
+# Each backend loads into (model, transform): transform(rgb) -> 1x3xHxW tensor,
+# model(batch) -> BxHxW prediction at network resolution. MiDaS transforms follow
+# the original pipeline: dpt_transform for DPT_Large, small_transform for the
+# others. With native_transform, DPT_Hybrid gets the transform it was trained
+# with (dpt_transform) instead; that changes its output.
+
+
+class MidasBackend:
+    def __init__(self, hub_name, transform_name, native_transform_name=None):
+        self.hub_name = hub_name
+        self.transform_name = transform_name
+        self.native_transform_name = native_transform_name or transform_name
+
+    def load(self, device, cache_dir=None, native_transform=False):
+        if cache_dir:
+            torch.hub.set_dir(os.path.join(cache_dir, "torch_hub"))
+        # A previously downloaded hub repo is loaded from disk so no network is needed
+        repo_dir = os.path.join(torch.hub.get_dir(), "intel-isl_MiDaS_master")
+        if os.path.isdir(repo_dir):
+            model = torch.hub.load(repo_dir, self.hub_name, source="local")
+            transforms = torch.hub.load(repo_dir, "transforms", source="local")
+        else:
+            model = torch.hub.load("intel-isl/MiDaS", self.hub_name)
+            transforms = torch.hub.load("intel-isl/MiDaS", "transforms")
+        model.eval().to(device)
+        return model, getattr(transforms, self.native_transform_name if native_transform else self.transform_name)
+
+
+class _PredictedDepth(torch.nn.Module):
+    # Hugging Face depth models return an output object; the pipeline wants the tensor
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, pixel_values):
+        return self.model(pixel_values=pixel_values).predicted_depth
+
+
+class DepthAnythingBackend:
+    def __init__(self, repo_id):
+        self.repo_id = repo_id
+
+    def load(self, device, cache_dir=None, native_transform=False):
+        # Always the model's own image processor
+        cache_dir = os.path.join(cache_dir, "huggingface") if cache_dir else None
+        processor = AutoImageProcessor.from_pretrained(self.repo_id, cache_dir=cache_dir)
+        model = AutoModelForDepthEstimation.from_pretrained(self.repo_id, cache_dir=cache_dir)
+        model = _PredictedDepth(model).eval().to(device)
+
+        def transform(img_rgb):
+            return processor(images=img_rgb, return_tensors="pt")["pixel_values"]
+
+        return model, transform
+
+
+DEPTH_BACKENDS = {
+    "MiDaS_small": MidasBackend("MiDaS_small", "small_transform"),
+    "DPT_Hybrid": MidasBackend("DPT_Hybrid", "small_transform", "dpt_transform"),
+    "DPT_Large": MidasBackend("DPT_Large", "dpt_transform"),
+    "depth-anything-v2-small": DepthAnythingBackend("depth-anything/Depth-Anything-V2-Small-hf"),
+    "depth-anything-v2-base": DepthAnythingBackend("depth-anything/Depth-Anything-V2-Base-hf"),
+    "depth-anything-v2-large": DepthAnythingBackend("depth-anything/Depth-Anything-V2-Large-hf"),
+}
+
+
+def get_depth_backend(name):
+    if name not in DEPTH_BACKENDS:
+        raise ValueError(f"Unknown depth model: {name} (available: {', '.join(DEPTH_BACKENDS)})")
+    return DEPTH_BACKENDS[name]
@@ -1,13 +1,33 @@
 from transformers import DataProcessor, AutoModel
 
+from transformers.models.grounding_dino.modeling_grounding_dino import GroundingDinoObjectDetectionOutput
+
 from backend_model.imports import *
+from backend_model.onnx_runtime import OnnxRunner, onnx_name
+import threading
+from collections import OrderedDict
+
+# Inputs of the exported GroundingDINO graph, in order
+ONNX_INPUTS = ["pixel_values", "pixel_mask", "input_ids", "token_type_ids", "attention_mask"]
 
 class DetectionModel:
-    def __init__(self, model_id = "IDEA-Research/grounding-dino-base"):
+    def __init__(self, model_id = "IDEA-Research/grounding-dino-base", text_cache=True, text_cache_size=8,
+                 onnx_dir=None, onnx_threads=0):
         self.model_id = model_id
         self.device = None
         self.processor = None
         self.model_dec = None
+        # The class prompt is the same for every image, so its tokens and
+        # text encoder features are computed once per prompt and reused
+        self.text_cache = text_cache
+        self.text_cache_size = text_cache_size
+        self._text_inputs = OrderedDict()
+        self._text_features = OrderedDict()
+        self._text_lock = threading.Lock()
+        # Exported graphs from backend_model.onnx_export, run with ONNX Runtime when set
+        self.onnx_dir = onnx_dir
+        self.onnx_threads = onnx_threads
+        self.onnx = None
 
     def load_model(self):
         try:
@@ -23,8 +43,62 @@ class DetectionModel:
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
         self.processor = AutoProcessor.from_pretrained(self.model_id)
         self.model_dec = AutoModelForZeroShotObjectDetection.from_pretrained(self.model_id).to(self.device)
+        self._cache_text_features()
+        if self.onnx_dir:
+            self.onnx = OnnxRunner(self.onnx_dir, onnx_name("detection", self.model_id), self.onnx_threads)
         print("Loaded model successfully")
 
+    def _remember(self, cache, key, value):
+        with self._text_lock:
+            cache[key] = value
+            while len(cache) > self.text_cache_size:
+                cache.popitem(last=False)
+        return value
+
+    def _cache_text_features(self):
+        # Memoize the BERT text backbone: its output only depends on the prompt tokens.
+        # Only under no_grad, so fine-tuning still sees a normal forward.
+        backbone = self.model_dec.model.text_backbone
+        forward = backbone.forward
+
+        def cached_forward(input_ids, attention_mask=None, token_type_ids=None, position_ids=None, **kwargs):
+            if not self.text_cache or torch.is_grad_enabled():
+                return forward(input_ids, attention_mask, token_type_ids, position_ids, **kwargs)
+            key = (tuple(input_ids.shape), input_ids.cpu().numpy().tobytes(),
+                   None if token_type_ids is None else token_type_ids.cpu().numpy().tobytes(),
+                   tuple(sorted(kwargs.items())))
+            cached = self._text_features.get(key)
+            if cached is not None:
+                return cached
+            return self._remember(self._text_features, key,
+                                  forward(input_ids, attention_mask, token_type_ids, position_ids, **kwargs))
+
+        backbone.forward = cached_forward
+
+    def prepare_inputs(self, images, class_name):
+        # Same inputs as self.processor(images=..., text=...), with the tokenized
+        # prompt taken from the cache instead of re-tokenizing for every image
+        if not self.text_cache:
+            return self.processor(images=images, text=[class_name] * len(images), return_tensors="pt").to(self.device)
+        key = (class_name, len(images))
+        text_inputs = self._text_inputs.get(key)
+        if text_inputs is None:
+            text_inputs = self._remember(self._text_inputs, key, self.processor.tokenizer(
+                [class_name] * len(images), return_token_type_ids=True, return_tensors="pt").to(self.device))
+        inputs = self.processor.image_processor(images=images, return_tensors="pt").to(self.device)
+        inputs.update(text_inputs)
+        return inputs
+
+    def forward(self, inputs):
+        # Exported graph for this input size if there is one, else the PyTorch model
+        if self.onnx is not None:
+            outputs = self.onnx.run(inputs["pixel_values"].shape[-2:], {name: inputs[name] for name in ONNX_INPUTS})
+            if outputs is not None:
+                logits, pred_boxes = outputs
+                return GroundingDinoObjectDetectionOutput(logits=logits, pred_boxes=pred_boxes)
+        with torch.no_grad():
+            return self.model_dec(**inputs)
+
     def show_gd_results(self ,img, results, score_thr = 0.2):
         if isinstance(img, str):
             img = Image.open(img).convert("RGB")
@@ -55,15 +129,17 @@ class DetectionModel:
         ax.axis("off")
         plt.show()
 
+    def image_size(self, image):
+        # (height, width) of a PIL image or an RGB array from DecodedImage
+        return tuple(image.shape[:2]) if isinstance(image, np.ndarray) else image.size[::-1]
+
     def detect_fruits(self, image, class_name):
-        text = class_name
-        inputs = self.processor(images=image, text=text, return_tensors="pt").to(self.device)
-        with torch.no_grad():
-            outputs = self.model_dec(**inputs)
+        inputs = self.prepare_inputs([image], class_name)
+        outputs = self.forward(inputs)
         results = self.processor.post_process_grounded_object_detection(
             outputs,
             inputs.input_ids,
-            target_sizes=[image.size[::-1]],
+            target_sizes=[self.image_size(image)],
             text_threshold=0.1,
             threshold=0.1
         )
@@ -80,47 +156,68 @@ class DetectionModel:
         area_boxes = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
         union = area_box + area_boxes - inter + 1e-9
         return inter / union
+    def suppression_matrix(self, xyxy, iou_thr=0.5, contain_thr=0.9, block=1024):
+        # S[i, j] is True when box i suppresses box j: IoU above iou_thr, or
+        # j covered more than contain_thr by i (nested box case).
+        # Rows are computed in blocks so thousands of boxes stay within memory.
+        n = len(xyxy)
+        area = (xyxy[:, 2] - xyxy[:, 0]) * (xyxy[:, 3] - xyxy[:, 1])
+        suppress = np.zeros((n, n), dtype=bool)
+        for start in range(0, n, block):
+            rows = xyxy[start:start + block, None, :]
+            x1 = np.maximum(rows[..., 0], xyxy[:, 0])
+            y1 = np.maximum(rows[..., 1], xyxy[:, 1])
+            x2 = np.minimum(rows[..., 2], xyxy[:, 2])
+            y2 = np.minimum(rows[..., 3], xyxy[:, 3])
+            inter = np.maximum(0, x2 - x1) * np.maximum(0, y2 - y1)
+            # Same operation order as iou_matrix so results match bit for bit
+            ious = inter / (area[start:start + block, None] + area - inter + 1e-9)
+            contained = np.zeros_like(inter, dtype=bool)
+            np.greater(inter / np.where(area > 0, area, 1), contain_thr, out=contained, where=area > 0)
+            suppress[start:start + block] = ~(ious <= iou_thr) | contained
+        return suppress
+
 # Update contain_thr = 0 .9 for extra step 2
     def nms_class_agnostic(self,xyxy, scores, labels, iou_thr=0.5, contain_thr=0.9):
-        xyxy = np.asarray(xyxy, dtype=float)
+        xyxy = np.asarray(xyxy, dtype=float).reshape(-1, 4)
         scores = np.asarray(scores, dtype=float)
         idxs = np.argsort(-scores)
+        if idxs.size == 0:
+            return []
 
+        # Pairwise IoU + containment computed once in score order,
+        # then a greedy pass that only touches kept boxes
+        suppress = self.suppression_matrix(xyxy[idxs], iou_thr, contain_thr)
+        removed = np.zeros(idxs.size, dtype=bool)
         keep = []
-        while idxs.size > 0:
-            i = idxs[0]
-            keep.append(i)
-            if idxs.size == 1:
-                break
-            rest = idxs[1:]
-            ious = self.iou_matrix(xyxy[i], xyxy[rest])
-
-            # Step 2: containment filter
-            # If a smaller box j is covered > contain_thr (90%) by box i,
-            # then drop j even if IoU is low (nested box case).
-            contain = []
-            for j in rest:
-                inter_x1 = max(xyxy[i][0], xyxy[j][0])
-                inter_y1 = max(xyxy[i][1], xyxy[j][1])
-                inter_x2 = min(xyxy[i][2], xyxy[j][2])
-                inter_y2 = min(xyxy[i][3], xyxy[j][3])
-                inter_area = max(0, inter_x2 - inter_x1) * max(0, inter_y2 - inter_y1)
-                area_j = (xyxy[j][2] - xyxy[j][0]) * (xyxy[j][3] - xyxy[j][1])
-                if area_j > 0 and inter_area / area_j > contain_thr:
-                    contain.append(j)
-            #Step 1 + 2 combined
-            mask = (ious <= iou_thr)
-            idxs = rest[mask & (~np.isin(rest, contain))]
+        for pos in range(idxs.size):
+            if removed[pos]:
+                continue
+            keep.append(idxs[pos])
+            # A box only suppresses lower scored boxes
+            removed[pos + 1:] |= suppress[pos, pos + 1:]
 
         return sorted(keep)
 
 
-    def detect(self, image, class_name,score_thr=0, max_per_class=20):
-        results_dec = self.detect_fruits(image, class_name)
+    def detect_fruits_batch(self, images, class_name):
+        # One forward pass for all images; the processor pads them to a common size
+        inputs = self.prepare_inputs(images, class_name)
+        outputs = self.forward(inputs)
+        results = self.processor.post_process_grounded_object_detection(
+            outputs,
+            inputs.input_ids,
+            target_sizes=[self.image_size(image) for image in images],
+            text_threshold=0.1,
+            threshold=0.1
+        )
+        return results
+
+    def select_boxes(self, result_dec, score_thr=0):
         dic_ind = {"potato section": [], "onion": [], "eggplant section": [], "tomato": [], 'cucumber': []}
 
-        for idx, label in enumerate(results_dec[0]['text_labels']):
-            score = float(results_dec[0]['scores'][idx])
+        for idx, label in enumerate(result_dec['text_labels']):
+            score = float(result_dec['scores'][idx])
             if label not in dic_ind:
                 continue
             if score >= score_thr:  # lọc score thấp
@@ -130,10 +227,10 @@ class DetectionModel:
 
         for fruit, index_list in dic_ind.items():
             for i in index_list:
-                x1, y1, x2, y2 = results_dec[0]['boxes'][i]
+                x1, y1, x2, y2 = result_dec['boxes'][i]
                 xyxy.append([float(x1), float(y1), float(x2), float(y2)])
                 labels.append(fruit)
-                scores.append(float(results_dec[0]['scores'][i]))
+                scores.append(float(result_dec['scores'][i]))
 
         keep = self.nms_class_agnostic(xyxy, scores, labels, iou_thr=0.5)
 
@@ -142,3 +239,11 @@ class DetectionModel:
         scores_final = [scores[i] for i in keep]
 
         return xyxy_final, labels_final, scores_final
+
+    def detect(self, image, class_name,score_thr=0, max_per_class=20):
+        results_dec = self.detect_fruits(image, class_name)
+        return self.select_boxes(results_dec[0], score_thr)
+
+    def detect_batch(self, images, class_name, score_thr=0):
+        results_dec = self.detect_fruits_batch(images, class_name)
+        return [self.select_boxes(result_dec, score_thr) for result_dec in results_dec]
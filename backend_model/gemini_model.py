@@ -1,14 +1,335 @@
 from backend_model.imports import *
+from backend_model.decoded_image import DecodedImage
+from google.genai.errors import APIError
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import Future
+import hashlib
+import io
+import random
+import threading
+import httpx
+
+# Upper bounds in seconds of the call latency histogram; slower calls go to "inf"
+LATENCY_BUCKETS = [0.25, 0.5, 1, 2, 5, 10, 30, 60]
+# Rate limited or transient server errors; other errors are not retried
+RETRY_STATUS = {408, 429, 500, 502, 503, 504}
+# full: the original image. mosaic: only the crops of the requested sections,
+# downscaled and labelled with section ids (see build_mosaic)
+PAYLOADS = ["full", "mosaic"]
+
+
+def build_mosaic(bgr, boxes, labels, max_side=512, padding=8, label_height=28):
+    # JPEG bytes of the box crops on a grid, each crop downscaled to max_side
+    # with its label on a strip above it
+    height, width = bgr.shape[:2]
+    tiles = []
+    for (x1, y1, x2, y2), label in zip(boxes, labels):
+        x1, y1 = max(int(x1), 0), max(int(y1), 0)
+        x2, y2 = min(int(math.ceil(x2)), width), min(int(math.ceil(y2)), height)
+        crop = bgr[y1:y2, x1:x2] if x2 > x1 and y2 > y1 else np.zeros((1, 1, 3), dtype=np.uint8)
+        scale = min(1.0, max_side / max(crop.shape[:2]))
+        if scale < 1.0:
+            size = (max(1, round(crop.shape[1] * scale)), max(1, round(crop.shape[0] * scale)))
+            crop = cv2.resize(crop, size, interpolation=cv2.INTER_AREA)
+        tiles.append((crop, label))
+
+    columns = math.ceil(math.sqrt(len(tiles)))
+    rows = math.ceil(len(tiles) / columns)
+    cell_h = max(crop.shape[0] for crop, _ in tiles) + label_height
+    cell_w = max(max(crop.shape[1] for crop, _ in tiles), 80)
+    canvas = np.full((rows * (cell_h + padding) + padding, columns * (cell_w + padding) + padding, 3), 255,
+                     dtype=np.uint8)
+    for i, (crop, label) in enumerate(tiles):
+        top = padding + (i // columns) * (cell_h + padding)
+        left = padding + (i % columns) * (cell_w + padding)
+        cv2.putText(canvas, label, (left + 2, top + label_height - 8), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 0, 0), 2)
+        canvas[top + label_height:top + label_height + crop.shape[0], left:left + crop.shape[1]] = crop
+    ok, data = cv2.imencode(".jpg", canvas, [cv2.IMWRITE_JPEG_QUALITY, 90])
+    if not ok:
+        raise ValueError("Could not encode the section mosaic")
+    return data.tobytes()
+
+
+def parse_fullness(value):
+    # A fullness answer as a float in 0-100, or None when it is not a number;
+    # accepts numbers and numeric strings such as "76" or "76%"
+    if isinstance(value, str):
+        value = value.strip().rstrip("%").strip()
+        try:
+            value = float(value)
+        except ValueError:
+            return None
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+        return None
+    return min(max(float(value), 0.0), 100.0)
+
+
+def estimate_tokens(data, prompt):
+    # Input tokens of one image and its prompt: Gemini counts 258 tokens per
+    # 768x768 tile of an image (one tile when both sides are at most 384) and
+    # about 4 characters per text token
+    width, height = Image.open(io.BytesIO(data)).size
+    tiles = 1 if max(width, height) <= 384 else math.ceil(width / 768) * math.ceil(height / 768)
+    return 258 * tiles + len(prompt) // 4
+
+
+class _Coalescer:
+    # Requests from several images that arrive within window seconds of the first
+    # one share one multi-image call. A batch is sent early once adding a request
+    # would pass max_images, max_bytes (inline image bytes) or max_tokens.
+    # Identical requests (same image bytes and prompt) waiting or in progress
+    # share one Future instead of taking another slot in the call.
+    def __init__(self, gemini, window, max_images, max_bytes, max_tokens):
+        self.gemini = gemini
+        self.window = window
+        self.max_images = max_images
+        self.max_bytes = max_bytes
+        self.max_tokens = max_tokens
+        self._batch = []  # (data, mime_type, prompt, tokens, future)
+        self._pending = {}  # (image hash, prompt) -> future, until it is done
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def submit(self, data, mime_type, prompt):
+        # Future of the image's parsed JSON answer
+        key = (hashlib.sha256(data).hexdigest(), prompt)
+        ready = []
+        with self._lock:
+            future = self._pending.get(key)
+            if future is not None:
+                with self.gemini._lock:
+                    self.gemini.counters["coalesced_duplicates"] += 1
+                return future
+            request = (data, mime_type, prompt, estimate_tokens(data, prompt), Future())
+            self._pending[key] = request[-1]
+            request[-1].add_done_callback(lambda _: self._forget(key))
+            if self._batch and not self._fits(request):
+                ready.append(self._take())
+            self._batch.append(request)
+            if len(self._batch) >= self.max_images:
+                ready.append(self._take())
+            elif len(self._batch) == 1:
+                self._timer = threading.Timer(self.window, self._flush, args=(self._batch,))
+                self._timer.daemon = True
+                self._timer.start()
+        for batch in ready:
+            self._send(batch)
+        return request[-1]
+
+    def _forget(self, key):
+        with self._lock:
+            self._pending.pop(key, None)
+
+    def _fits(self, request):
+        return (len(self._batch) < self.max_images
+                and sum(len(r[0]) for r in self._batch) + len(request[0]) <= self.max_bytes
+                and sum(r[3] for r in self._batch) + request[3] <= self.max_tokens)
+
+    def _take(self):
+        batch, self._batch = self._batch, []
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        return batch
+
+    def _flush(self, batch):
+        # Timer: send the batch unless it was already sent because it filled up
+        with self._lock:
+            if batch is not self._batch:
+                return
+            batch = self._take()
+        self._send(batch)
+
+    def _send(self, batch):
+        try:
+            if len(batch) == 1:
+                data, mime_type, prompt, _, future = batch[0]
+                future.set_result(self.gemini._ask(data, mime_type, prompt))
+                return
+            answers = self.gemini._ask_many([request[:3] for request in batch])
+            with self.gemini._lock:
+                self.gemini.counters["coalesced_calls"] += 1
+                self.gemini.counters["coalesced_images"] += len(batch)
+            for answer, request in zip(answers, batch):
+                if isinstance(answer, dict):
+                    request[-1].set_result(answer)
+                else:
+                    request[-1].set_exception(ValueError(f"No answer for the image in the coalesced call: {answer}"))
+        except Exception as e:
+            for request in batch:
+                if not request[-1].done():
+                    request[-1].set_exception(e)
 
 
 class Gemini:
-    def __init__(self, model_id = "gemini-2.5-flash"):
+    def __init__(self, model_id = "gemini-2.5-flash", base_url=None, max_concurrency=4, max_retries=4,
+                 backoff=1.0, max_backoff=30.0, timeout=60.0, cache_size=256, payload="full", crop_max_side=512,
+                 coalesce_window=0.0, coalesce_max_images=8, coalesce_max_bytes=15 * 1024 * 1024,
+                 coalesce_max_tokens=100000):
+        if payload not in PAYLOADS:
+            raise ValueError(f"Unknown Gemini payload: {payload} (available: {', '.join(PAYLOADS)})")
         self.model_id = model_id
         self.api_key = None
+        # Another endpoint than the Gemini API, e.g. a local fake server
+        self.base_url = base_url
+        self.timeout = timeout
+        # Clients are reused across calls so their HTTP connections stay open;
+        # at most max_concurrency calls are in flight, the others wait
+        self.max_concurrency = max_concurrency
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._idle_clients = []
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        # Parsed responses per image hash and requested positions
+        self.cache_size = cache_size
+        self._responses = OrderedDict()
+        # Future per key of a call in progress; concurrent requests for the same
+        # key wait for it instead of calling again
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self.payload = payload
+        self.crop_max_side = crop_max_side
+        # Requests of several images within coalesce_window seconds share one call;
+        # 0 sends every request on its own
+        self._coalescer = None
+        if coalesce_window > 0:
+            self._coalescer = _Coalescer(self, coalesce_window, coalesce_max_images, coalesce_max_bytes,
+                                         coalesce_max_tokens)
+        # bytes_sent: image and prompt bytes of every call, retries included
+        # invalid_answers: fullness values that are not numbers, left at the depth value
+        self.counters = {"calls": 0, "cache_hits": 0, "in_flight_hits": 0, "retries": 0, "errors": 0, "bytes_sent": 0,
+                         "invalid_answers": 0, "coalesced_calls": 0, "coalesced_images": 0, "coalesced_duplicates": 0}
+        self._latency = {"count": 0, "sum": 0.0, "buckets": [0] * (len(LATENCY_BUCKETS) + 1)}
+
     def load(self):
         self.api_key = os.getenv('GEMINI_API_KEY')
         print("Gemini model loaded")
 
+    @contextmanager
+    def _client(self):
+        with self._slots:
+            with self._lock:
+                client = self._idle_clients.pop() if self._idle_clients else None
+            if client is None:
+                http_options = types.HttpOptions(base_url=self.base_url, timeout=int(self.timeout * 1000))
+                client = genai.Client(api_key=self.api_key, http_options=http_options)
+            try:
+                yield client
+            finally:
+                with self._lock:
+                    self._idle_clients.append(client)
+
+    def _observe(self, seconds):
+        with self._lock:
+            self._latency["count"] += 1
+            self._latency["sum"] += seconds
+            bucket = next((i for i, bound in enumerate(LATENCY_BUCKETS) if seconds <= bound), len(LATENCY_BUCKETS))
+            self._latency["buckets"][bucket] += 1
+
+    def _count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def _retry_delay(self, error, attempt):
+        # The server's hint when it sends one (Retry-After, or RetryInfo in a
+        # 429 body), else exponential backoff with jitter; capped at max_backoff
+        delay = None
+        response = getattr(error, "response", None)
+        headers = getattr(response, "headers", None) or {}
+        if headers.get("retry-after"):
+            try:
+                delay = float(headers["retry-after"])
+            except ValueError:
+                pass
+        details = getattr(error, "details", None)
+        if delay is None and isinstance(details, dict):
+            for detail in details.get("error", {}).get("details", []):
+                if str(detail.get("@type", "")).endswith("RetryInfo") and detail.get("retryDelay"):
+                    delay = float(str(detail["retryDelay"]).rstrip("s"))
+        if delay is None:
+            delay = self.backoff * 2 ** attempt * random.uniform(0.5, 1.0)
+        return min(max(delay, 0.0), self.max_backoff)
+
+    def _generate(self, contents, config, size):
+        for attempt in range(self.max_retries + 1):
+            try:
+                with self._client() as client:
+                    with self._lock:
+                        self.counters["calls"] += 1
+                        self.counters["bytes_sent"] += size
+                    start = time.perf_counter()
+                    try:
+                        return client.models.generate_content(model=self.model_id, contents=contents, config=config)
+                    finally:
+                        self._observe(time.perf_counter() - start)
+            except (APIError, httpx.TransportError) as e:
+                retryable = isinstance(e, httpx.TransportError) or getattr(e, "code", None) in RETRY_STATUS
+                if not retryable or attempt == self.max_retries:
+                    raise
+                self._count("retries")
+                # Back off outside the client slot so other calls can use it
+                time.sleep(self._retry_delay(e, attempt))
+
+    def _ask(self, data, mime_type, prompt):
+        # Parsed JSON answer of one image and its prompt
+        config = types.GenerateContentConfig(response_mime_type="application/json")
+        response = self._generate([
+            types.Part.from_bytes(
+                data=data,
+                mime_type=mime_type
+            ),
+            prompt
+        ], config, len(data) + len(prompt.encode()))
+        answer = json.loads(response.text or "")
+        if not isinstance(answer, dict):
+            raise ValueError(f"Expected a JSON object, got {response.text}")
+        return answer
+
+    def _ask_many(self, requests):
+        # One call for several (data, mime_type, prompt); the answer of each
+        # image, in order, from the object keyed by image id
+        ids = [f"I{i + 1}" for i in range(len(requests))]
+        contents = []
+        for image_id, (data, mime_type, _) in zip(ids, requests):
+            contents += [f"Image {image_id}:", types.Part.from_bytes(data=data, mime_type=mime_type)]
+        instructions = "\n".join(f"Instructions for image {image_id}:\n{prompt}"
+                                  for image_id, (_, _, prompt) in zip(ids, requests))
+        prompt = f"""
+        You are a STRICT JSON generator.
+        You are given {len(requests)} images, each introduced by its id ({", ".join(ids)}). Answer the instructions of each image below about that image only.
+        {instructions}
+
+        Return one JSON object with the answer of each image, in the JSON format its instructions ask for, under its id: for example
+        {{
+            "I1": {{...}},
+            "I2": {{...}},
+            ...
+        }}
+        """
+        config = types.GenerateContentConfig(response_mime_type="application/json")
+        size = sum(len(data) + len(text.encode()) for data, _, text in requests) + len(prompt.encode())
+        response = self._generate(contents + [prompt], config, size)
+        answer = json.loads(response.text or "")
+        if not isinstance(answer, dict):
+            raise ValueError(f"Expected a JSON object, got {response.text}")
+        return [answer.get(image_id) for image_id in ids]
+
+    def stats(self):
+        with self._lock:
+            buckets = [str(bound) for bound in LATENCY_BUCKETS] + ["inf"]
+            return {
+                **self.counters,
+                "payload": self.payload,
+                "latency": {
+                    "count": self._latency["count"],
+                    "sum": self._latency["sum"],
+                    # Calls per bucket, keyed by the bucket's upper bound in seconds
+                    "buckets": dict(zip(buckets, self._latency["buckets"])),
+                },
+            }
+
     def show_result(self, image):
         plt.figure(figsize=(12, 8))
         plt.imshow(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
@@ -19,20 +340,23 @@ class Gemini:
         plt.imsave(os.path.join("../Captone_AI/result_images", "annotated_rgb.png"), annotated_rgb)
     
 
-    def stock_estimation(self, image_path, pos_dic, total_pos_dic, stock_dict):
-        with open(image_path, "rb") as f:
-            image_bytes = f.read()
-        config = types.GenerateContentConfig(response_mime_type="application/json")
-        fruit_dic = {}
+    # The request builders return (build, answers): build() makes the
+    # (data, mime_type, prompt) to send and only runs on a cache miss;
+    # answers(stock_estimation) yields (fruit, position, fullness).
 
-        for fruit, position in pos_dic.items():
-            if fruit not in fruit_dic:
-                fruit_dic[fruit] = []
-            for pos in position:
-                box = total_pos_dic[fruit][pos]
-                fruit_dic[fruit].append(box)
-        
-        prompt = f"""
+    def _full_request(self, image, pos_dic, total_pos_dic):
+        # The original image; the answer lists fullness per fruit in pos_dic order
+        def build():
+            fruit_dic = {}
+
+            for fruit, position in pos_dic.items():
+                if fruit not in fruit_dic:
+                    fruit_dic[fruit] = []
+                for pos in position:
+                    box = total_pos_dic[fruit][pos]
+                    fruit_dic[fruit].append(box)
+
+            prompt = f"""
         You are a STRICT JSON generator.
         Given the image and the positions of fruits in the image, estimate the stock level for each fruit based on the fullness of the fruits at the given positions.
         {fruit_dic}
@@ -47,27 +371,119 @@ class Gemini:
             ...
         }}
         """
-        try:
-            client = genai.Client()
-            response =client.models.generate_content(
-                model=self.model_id,
-                contents=[
-                    types.Part.from_bytes(
-                        data=image_bytes,
-                        mime_type="image/jpeg"
-                    ),
-                    prompt
-                ], config = config
-            )
-            stock_estimation = json.loads(response.text)
+            return image.data, image.mime_type, prompt
+
+        def answers(stock_estimation):
             for fruit, fullness_list in stock_estimation.items():
-                for index in range(len(fullness_list)):
-                    fullness = fullness_list[index]
-                    if fruit in stock_dict and index < len(stock_dict[fruit]):
-                        temp = list(stock_dict[fruit][pos_dic[fruit][index]])
-                        temp[0] = fullness
-                        stock_dict[fruit][pos_dic[fruit][index]] = tuple(temp)
-            return stock_dict
-        except ClientError as e:
+                if fruit in pos_dic and isinstance(fullness_list, list):
+                    for index, fullness in enumerate(fullness_list[:len(pos_dic[fruit])]):
+                        yield fruit, pos_dic[fruit][index], fullness
+
+        return build, answers
+
+    def _mosaic_request(self, image, pos_dic, total_pos_dic):
+        # Only the requested sections, cropped and labelled S1, S2, ...; the
+        # answer maps section ids to fullness
+        sections = {}
+        for fruit, position in pos_dic.items():
+            for pos in position:
+                sections[f"S{len(sections) + 1}"] = (fruit, pos)
+
+        def build():
+            boxes = [total_pos_dic[fruit][pos] for fruit, pos in sections.values()]
+            data = build_mosaic(image.bgr, boxes, list(sections), self.crop_max_side)
+            section_dic = {section_id: fruit for section_id, (fruit, _) in sections.items()}
+
+            prompt = f"""
+        You are a STRICT JSON generator.
+        The image is a mosaic of shelf sections cropped from one photo. Each crop is labelled with its section id above it.
+        The product in each section: {section_dic}
+
+        Estimate the stock level of each section based on the fullness of the product in its crop, as a percentage (0-100), where 0 means empty and 100 means full.
+        Return the result in the following JSON format: for example
+        {{
+            "S1": 76,
+            "S2": 78,
+            ...
+        }}
+        """
+            return data, "image/jpeg", prompt
+
+        def answers(stock_estimation):
+            for section_id, fullness in stock_estimation.items():
+                if section_id in sections:
+                    if isinstance(fullness, list):
+                        fullness = fullness[0] if fullness else None
+                    if fullness is not None:
+                        yield (*sections[section_id], fullness)
+
+        return build, answers
+
+    def _cached_or_ask(self, key, build):
+        # Parsed answer for key from the cache, from a call already in progress,
+        # or from a new call with the (data, mime_type, prompt) of build()
+        with self._lock:
+            answer = self._responses.get(key)
+            if answer is not None:
+                self._responses.move_to_end(key)
+                self.counters["cache_hits"] += 1
+                return answer
+            future = self._in_flight.get(key)
+            owner = future is None
+            if owner:
+                future = self._in_flight[key] = Future()
+            else:
+                self.counters["in_flight_hits"] += 1
+        if not owner:
+            # Raises the error of the call when it failed
+            return future.result()
+
+        try:
+            data, mime_type, prompt = build()
+            if self._coalescer is not None:
+                answer = self._coalescer.submit(data, mime_type, prompt).result()
+            else:
+                answer = self._ask(data, mime_type, prompt)
+        except Exception as e:
+            with self._lock:
+                del self._in_flight[key]
+            future.set_exception(e)
+            raise
+        with self._lock:
+            del self._in_flight[key]
+            if self.cache_size > 0:
+                self._responses[key] = answer
+                while len(self._responses) > self.cache_size:
+                    self._responses.popitem(last=False)
+        future.set_result(answer)
+        return answer
+
+    def stock_estimation(self, image_path, pos_dic, total_pos_dic, stock_dict):
+        # stock_dict with Gemini's fullness at the positions in pos_dic, or None
+        # when the call fails; the stock_dict passed in is left unchanged
+        image = DecodedImage.of(image_path)
+        request = self._mosaic_request if self.payload == "mosaic" else self._full_request
+        try:
+            # The key only needs the image hash and the requested boxes, so a
+            # cache hit skips building the payload
+            positions = {fruit: [total_pos_dic[fruit][pos] for pos in position] for fruit, position in pos_dic.items()}
+            key = (image.hash, self.model_id, self.payload, self.crop_max_side,
+                   json.dumps(positions, sort_keys=True, default=str))
+            build, answers = request(image, pos_dic, total_pos_dic)
+            stock_estimation = self._cached_or_ask(key, build)
+        except (APIError, httpx.HTTPError, ValueError) as e:
+            self._count("errors")
             print(f"An error occurred: {e}")
-            return None
\ No newline at end of file
+            return None
+
+        stock_dict = {fruit: list(values) for fruit, values in stock_dict.items()}
+        for fruit, pos, fullness in answers(stock_estimation):
+            fullness = parse_fullness(fullness)
+            if fullness is None:
+                self._count("invalid_answers")
+                continue
+            if fruit in stock_dict and pos < len(stock_dict[fruit]):
+                temp = list(stock_dict[fruit][pos])
+                temp[0] = fullness
+                stock_dict[fruit][pos] = tuple(temp)
+        return stock_dict
@@ -1,27 +1,97 @@
-
 from backend_model.detection_model import *
 from backend_model.segmentation_model import *
 from backend_model.gemini_model import *
-from backend_model.prob_calculation import *
 from backend_model.stock_estimation_depth import *
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+MODEL_NAMES = ["detection", "segmentation", "depth", "gemini"]
 
 _models = {}
+_load_stats = {}
+_locks = {name: threading.Lock() for name in MODEL_NAMES}
+# Constructor arguments per model, set with configure() before the model loads
+_options = {name: {} for name in MODEL_NAMES}
+
+def configure(name, **options):
+    if name not in _options:
+        raise ValueError(f"Unknown model: {name}")
+    merged = {**_options[name], **options}
+    if name in _models and merged != _options[name]:
+        raise RuntimeError(f"Model {name} is already loaded with other options")
+    _options[name] = merged
+
+def options():
+    return {name: dict(values) for name, values in _options.items()}
+
+def configure_all(options):
+    # Process workers: load models with the same options as the parent process
+    for name, values in options.items():
+        configure(name, **values)
+
+def _create_model(name):
+    if name == "detection":
+        model = DetectionModel(**_options[name])
+        model.load_model()
+    elif name == "segmentation":
+        model = SegmentationModel(**{"model_name": "sam2.1_l.pt", **_options[name]})
+        model.load()
+    elif name == "depth":
+        model = DepthModel(**_options[name])
+        model.load()
+    elif name == "gemini":
+        model = Gemini(**_options[name])
+        model.load()
+    return model
+
+def _memory_footprint(model):
+    # Bytes held by the parameters and buffers of every torch module on the wrapper
+    total = 0
+    for value in vars(model).values():
+        if isinstance(value, torch.nn.Module):
+            for tensor in list(value.parameters()) + list(value.buffers()):
+                total += tensor.numel() * tensor.element_size()
+    return total
 
 def get_model(name):
-    if name not in _models:
-        if name == "detection":
-            model = DetectionModel()
-            model.load_model()
-        elif name == "segmentation":
-            model = SegmentationModel("sam2.1_l.pt")
-            model.load()
-        elif name == "depth":
-            model = DepthModel()
-            model.load()
-        elif name == "gemini":
-            model = Gemini()
-            model.load()
-        else:
-            raise ValueError(f"Unknown model: {name}")
-        _models[name] = model
-    return _models[name]
\ No newline at end of file
+    if name in _models:
+        return _models[name]
+    if name not in _locks:
+        raise ValueError(f"Unknown model: {name}")
+    # One lock per model so different models can load at the same time
+    with _locks[name]:
+        if name not in _models:
+            _load_stats[name] = {"status": "loading"}
+            start = time.perf_counter()
+            try:
+                model = _create_model(name)
+            except Exception as e:
+                _load_stats[name] = {"status": "failed", "error": str(e)}
+                raise
+            _load_stats[name] = {
+                "status": "ready",
+                "load_time": time.perf_counter() - start,
+                "memory_bytes": _memory_footprint(model),
+            }
+            _models[name] = model
+    return _models[name]
+
+def loaded(name):
+    # The model if it is already loaded, without loading it
+    return _models.get(name)
+
+def warm_up(names=None, max_workers=None):
+    # Load models concurrently; cold start becomes the slowest load instead of the sum
+    names = names or MODEL_NAMES
+    with ThreadPoolExecutor(max_workers=max_workers or len(names), thread_name_prefix="model-warmup") as pool:
+        futures = [pool.submit(get_model, name) for name in names]
+        errors = [f.exception() for f in futures if f.exception() is not None]
+    if errors:
+        raise errors[0]
+    return load_stats()
+
+def is_ready(names=None):
+    return all(name in _models for name in (names or MODEL_NAMES))
+
+def load_stats():
+    return {name: dict(stats) for name, stats in _load_stats.items()}
@@ -0,0 +1,186 @@
+"""
+Export the vision models to ONNX for CPU inference with ONNX Runtime.
+
+Needs the optional ONNX packages: pip install -r backend_model/requirements-onnx.txt
+
+Usage (from the project root):
+    python -m backend_model.onnx_export dataset/T0.jpg dataset/T1.jpg ... --out-dir backend/model_cache/onnx
+    python -m backend_model.onnx_export dataset/T0.jpg --models depth --depth-model MiDaS_small
+
+The images set the network input sizes to export (one artifact per size, see
+backend_model.onnx_runtime); images of other sizes keep running in PyTorch.
+Exported graphs:
+    detection     GroundingDINO, image and prompt in, logits and boxes out
+    segmentation  SAM2 image encoder; the prompt decoder stays in PyTorch
+    depth         the selected depth backend, BxHxW prediction out
+"""
+import argparse
+import os
+from contextlib import contextmanager
+
+import torch
+import transformers.models.grounding_dino.modeling_grounding_dino as grounding_dino
+
+from backend_model.decoded_image import DecodedImage
+from backend_model.detection_model import DetectionModel, ONNX_INPUTS
+from backend_model.onnx_runtime import onnx_name
+from backend_model.segmentation_model import SegmentationModel, SAM_VARIANTS
+from backend_model.stock_estimation_depth import DepthModel
+
+CLASS_NAMES = 'potato section . onion . eggplant section . tomato . cucumber .'
+OPSET = 17
+
+
+def _text_masks(input_ids):
+    # generate_masks_with_special_tokens_and_transfer_map without torch.isin,
+    # cummax/cummin and eye, which have no ONNX export: the running max/min
+    # become reductions over masked token pairs (prompts are short)
+    batch_size, seq_len = input_ids.shape
+    device = input_ids.device
+    special = (input_ids[..., None] == torch.tensor(grounding_dino.SPECIAL_TOKENS, device=device)).any(-1)
+    indices = torch.arange(seq_len, device=device)
+    before = indices[None, :] <= indices[:, None]  # [i, j]: token j is at or before token i
+    after = indices[None, :] >= indices[:, None]
+    prev_special = torch.where(special[:, None, :] & before, indices, -1).amax(-1)
+    next_special = torch.where(special[:, None, :] & after, indices, seq_len).amin(-1)
+
+    valid_block = (next_special != 0) & (next_special != seq_len - 1) & (next_special != seq_len)
+    attention_mask = (next_special[:, :, None] == next_special[:, None, :]) & valid_block[:, None, :]
+    attention_mask = (indices[None, :] == indices[:, None]) | attention_mask
+
+    position_ids = indices - prev_special - 1
+    position_ids = torch.where(valid_block, position_ids, torch.zeros_like(position_ids))
+    position_ids = torch.clamp(position_ids, min=0).to(torch.long)
+    return attention_mask, position_ids
+
+
+@contextmanager
+def _exportable_text_masks():
+    original = grounding_dino.generate_masks_with_special_tokens_and_transfer_map
+    grounding_dino.generate_masks_with_special_tokens_and_transfer_map = _text_masks
+    try:
+        yield
+    finally:
+        grounding_dino.generate_masks_with_special_tokens_and_transfer_map = original
+
+
+class _DetectionGraph(torch.nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, pixel_values, pixel_mask, input_ids, token_type_ids, attention_mask):
+        outputs = self.model(pixel_values=pixel_values, pixel_mask=pixel_mask, input_ids=input_ids,
+                             token_type_ids=token_type_ids, attention_mask=attention_mask)
+        return outputs.logits, outputs.pred_boxes
+
+
+class _EncoderGraph(torch.nn.Module):
+    def __init__(self, predictor):
+        super().__init__()
+        self.model = predictor.model
+        self.predictor = predictor
+
+    def forward(self, image):
+        features = self.predictor.get_im_features(image)
+        return (features["image_embed"], *features["high_res_feats"])
+
+
+def _export(module, inputs, path, input_names, output_names, dynamic_axes):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with torch.no_grad():
+        # The TorchScript exporter: torch.export cannot keep GroundingDINO's batch dynamic
+        torch.onnx.export(module.eval(), inputs, path, input_names=input_names, output_names=output_names,
+                          dynamic_axes=dynamic_axes, opset_version=OPSET, dynamo=False)
+    print(f"Exported {path}")
+    return path
+
+
+def export_detection(model, images, out_dir, class_names=CLASS_NAMES):
+    # model: a loaded DetectionModel. Batch size and prompt length stay dynamic.
+    name = onnx_name("detection", model.model_id)
+    dynamic_axes = {
+        "pixel_values": {0: "batch"},
+        "pixel_mask": {0: "batch"},
+        "input_ids": {0: "batch", 1: "tokens"},
+        "token_type_ids": {0: "batch", 1: "tokens"},
+        "attention_mask": {0: "batch", 1: "tokens"},
+        "logits": {0: "batch", 2: "tokens"},
+        "pred_boxes": {0: "batch"},
+    }
+    # The memoized text backbone would bake the prompt features into the graph
+    text_cache, model.text_cache = model.text_cache, False
+    paths = {}
+    try:
+        with _exportable_text_masks():
+            for image in images:
+                inputs = model.prepare_inputs([image.rgb], class_names)
+                shape = tuple(inputs["pixel_values"].shape[-2:])
+                if shape not in paths:
+                    height, width = shape
+                    paths[shape] = _export(
+                        _DetectionGraph(model.model_dec), tuple(inputs[key] for key in ONNX_INPUTS),
+                        os.path.join(out_dir, f"{name}_{height}x{width}.onnx"),
+                        ONNX_INPUTS, ["logits", "pred_boxes"], dynamic_axes)
+    finally:
+        model.text_cache = text_cache
+    return list(paths.values())
+
+
+def export_segmentation(model, images, out_dir):
+    # model: a loaded SegmentationModel. SAM letterboxes every image to the same
+    # square input, so one artifact covers all image sizes.
+    predictor = model._predictor()
+    predictor.setup_source(images[0].bgr)
+    image = predictor.preprocess([images[0].bgr])
+    height, width = image.shape[-2:]
+    path = os.path.join(out_dir, f"{onnx_name('segmentation', model.model_name)}_{height}x{width}.onnx")
+    return [_export(_EncoderGraph(predictor), (image,), path, ["image"],
+                    ["image_embed", "high_res_feats_0", "high_res_feats_1"], {})]
+
+
+def export_depth(model, images, out_dir):
+    # model: a loaded DepthModel
+    name = onnx_name("depth", model.model_id)
+    paths = {}
+    for image in images:
+        input_batch = model.transform(image.rgb).to(model.device)
+        shape = tuple(input_batch.shape[-2:])
+        if shape not in paths:
+            height, width = shape
+            paths[shape] = _export(
+                model.model_depth, (input_batch,), os.path.join(out_dir, f"{name}_{height}x{width}.onnx"),
+                ["image"], ["depth"], {"image": {0: "batch"}, "depth": {0: "batch"}})
+    return list(paths.values())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the vision models to ONNX")
+    parser.add_argument("images", nargs="+", help="images with the resolutions to export for")
+    parser.add_argument("--models", nargs="+", default=["detection", "segmentation", "depth"])
+    parser.add_argument("--out-dir", default=os.path.join("backend", "model_cache", "onnx"))
+    parser.add_argument("--detection-model", default="IDEA-Research/grounding-dino-base")
+    parser.add_argument("--sam-model", default="sam2.1_l.pt", help=f"{', '.join(SAM_VARIANTS)} or a checkpoint")
+    parser.add_argument("--depth-model", default="DPT_Hybrid")
+    parser.add_argument("--native-transform", action="store_true", help="as MIDAS_NATIVE_TRANSFORM")
+    parser.add_argument("--cache-dir", default=None, help="weights cache of the depth backend")
+    parser.add_argument("--class-names", default=CLASS_NAMES)
+    args = parser.parse_args()
+
+    images = [DecodedImage(path) for path in args.images]
+    if "detection" in args.models:
+        model = DetectionModel(args.detection_model)
+        model.load_model()
+        export_detection(model, images, args.out_dir, args.class_names)
+    if "segmentation" in args.models:
+        model = SegmentationModel(args.sam_model)
+        model.load()
+        export_segmentation(model, images, args.out_dir)
+    if "depth" in args.models:
+        model = DepthModel(args.depth_model, cache_dir=args.cache_dir, native_transform=args.native_transform)
+        model.load()
+        export_depth(model, images, args.out_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+from backend_model.imports import *
+import threading
+
+# Exported vision graphs run under ONNX Runtime on CPU. Shape-dependent code in
+# the models (Swin window padding, ViT position embeddings) is fixed at export
+# time, so there is one artifact per network input size; inputs of any other
+# size fall back to the PyTorch model. Batch and prompt length stay dynamic.
+# onnxruntime is only imported when a model is configured to use it, and is an
+# optional dependency (backend_model/requirements-onnx.txt).
+
+
+def onnx_name(kind, model_id):
+    # File name prefix of a model's artifacts, e.g. "depth-DPT_Hybrid"
+    return f"{kind}-{os.path.splitext(os.path.basename(model_id))[0]}"
+
+
+class OnnxRunner:
+    def __init__(self, onnx_dir, name, intra_op_threads=0):
+        import onnxruntime
+
+        self._ort = onnxruntime
+        self.onnx_dir = onnx_dir
+        self.name = name
+        self.intra_op_threads = intra_op_threads
+        self._sessions = {}  # (height, width) -> InferenceSession, or None when not exported
+        self._lock = threading.Lock()
+
+    def path(self, shape):
+        height, width = shape
+        return os.path.join(self.onnx_dir, f"{self.name}_{height}x{width}.onnx")
+
+    def available(self):
+        # Network input sizes with an exported artifact
+        if not os.path.isdir(self.onnx_dir):
+            return []
+        prefix = f"{self.name}_"
+        sizes = []
+        for file_name in os.listdir(self.onnx_dir):
+            if file_name.startswith(prefix) and file_name.endswith(".onnx"):
+                height, width = file_name[len(prefix):-len(".onnx")].split("x")
+                sizes.append((int(height), int(width)))
+        return sorted(sizes)
+
+    def session(self, shape):
+        shape = tuple(int(v) for v in shape)
+        with self._lock:
+            if shape not in self._sessions:
+                path = self.path(shape)
+                session = None
+                if os.path.exists(path):
+                    options = self._ort.SessionOptions()
+                    if self.intra_op_threads:
+                        options.intra_op_num_threads = self.intra_op_threads
+                    session = self._ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+                else:
+                    print(f"No ONNX export of {self.name} for input size {shape}, using PyTorch")
+                self._sessions[shape] = session
+            return self._sessions[shape]
+
+    def run(self, shape, inputs):
+        # inputs: name -> torch tensor. Returns the outputs as torch tensors on the
+        # device of the inputs, or None when there is no artifact for this size.
+        session = self.session(shape)
+        if session is None:
+            return None
+        device = next(iter(inputs.values())).device
+        feeds = {name: tensor.detach().cpu().numpy() for name, tensor in inputs.items()}
+        return [torch.from_numpy(output).to(device) for output in session.run(None, feeds)]
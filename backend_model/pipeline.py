@@ -0,0 +1,119 @@
+import queue
+import threading
+import time
+
+# Stages of a StagePipeline. Each stage has worker threads that take items
+# from a bounded input queue, so a slow stage holds back the stages before it
+# instead of buffering every image. A full queue blocks the stage feeding it.
+STAGE_KINDS = ["thread", "process"]
+
+
+class Stage:
+    # func(item) runs on one of the stage's worker threads and returns the item
+    # for the next stage. ordered: items are handled one at a time in input
+    # order (for stages that keep state across images). kind is only recorded
+    # here; a "process" stage's func sends its work to a process pool itself.
+    def __init__(self, name, func, workers=1, kind="thread", ordered=False):
+        if kind not in STAGE_KINDS:
+            raise ValueError(f"Unknown stage kind: {kind} (available: {', '.join(STAGE_KINDS)})")
+        self.name = name
+        self.func = func
+        self.workers = 1 if ordered else max(1, workers)
+        self.kind = kind
+        self.ordered = ordered
+
+
+class StagePipeline:
+    def __init__(self, stages, queue_size=2):
+        self.stages = stages
+        self.queue_size = queue_size
+        self._stats = {stage.name: {"kind": stage.kind, "workers": stage.workers, "items": 0, "busy": 0.0,
+                                    "queue_wait": 0.0} for stage in stages}
+        self._lock = threading.Lock()
+        self.elapsed = 0.0
+
+    def run(self, items):
+        # Outputs of the last stage, in input order. The first error of any
+        # stage is raised once every item has left the pipeline; the failed
+        # item skips the stages after the one that failed.
+        items = list(items)
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in self.stages]
+        outputs = [None] * len(items)
+        errors = []
+        threads = []
+        for position, stage in enumerate(self.stages):
+            source = queues[position]
+            target = queues[position + 1] if position + 1 < len(queues) else None
+            if stage.ordered:
+                args = (stage, source, target, outputs, errors, {"next": 0, "held": {}})
+            else:
+                args = (stage, source, target, outputs, errors, None)
+            for i in range(stage.workers):
+                thread = threading.Thread(target=self._work, args=args, name=f"stage-{stage.name}-{i}", daemon=True)
+                thread.start()
+                threads.append(thread)
+
+        start = time.perf_counter()
+        for index, item in enumerate(items):
+            queues[0].put((index, item, time.perf_counter(), None))
+        for position, stage in enumerate(self.stages):
+            # Workers of a stage stop once everything before them has stopped
+            for _ in range(stage.workers):
+                queues[position].put(None)
+            for thread in threads[:stage.workers]:
+                thread.join()
+            threads = threads[stage.workers:]
+        self.elapsed = time.perf_counter() - start
+        if errors:
+            raise errors[0]
+        return outputs
+
+    def _work(self, stage, source, target, outputs, errors, order):
+        while True:
+            entry = source.get()
+            if entry is None:
+                break
+            waited = time.perf_counter() - entry[2]
+            with self._lock:
+                self._stats[stage.name]["queue_wait"] += waited
+            if order is None:
+                self._handle(stage, entry, target, outputs, errors)
+                continue
+            # Hold items that arrive early until the ones before them are done
+            order["held"][entry[0]] = entry
+            while order["next"] in order["held"]:
+                self._handle(stage, order["held"].pop(order["next"]), target, outputs, errors)
+                order["next"] += 1
+
+    def _handle(self, stage, entry, target, outputs, errors):
+        index, item, _, error = entry
+        if error is None:
+            start = time.perf_counter()
+            try:
+                item = stage.func(item)
+            except Exception as e:
+                error = e
+                with self._lock:
+                    errors.append(e)
+            busy = time.perf_counter() - start
+            with self._lock:
+                self._stats[stage.name]["items"] += 1
+                self._stats[stage.name]["busy"] += busy
+        if target is not None:
+            target.put((index, item, time.perf_counter(), error))
+        else:
+            outputs[index] = item
+
+    def stats(self):
+        # Per stage: items handled, busy seconds, utilization of its workers over
+        # the run and mean seconds an item waited in the stage's input queue
+        with self._lock:
+            stats = {}
+            for name, values in self._stats.items():
+                capacity = values["workers"] * self.elapsed
+                stats[name] = {
+                    **values,
+                    "utilization": values["busy"] / capacity if capacity else 0.0,
+                    "mean_queue_wait": values["queue_wait"] / values["items"] if values["items"] else 0.0,
+                }
+            return stats
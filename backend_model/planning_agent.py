@@ -1,25 +1,386 @@
 from backend_model.imports import *
-from backend_model.model_cache import get_model
+from backend_model import model_cache
+from backend_model.model_cache import get_model, warm_up
+from backend_model.results import ImageResult
+from backend_model.decoded_image import DecodedImage
+from backend_model.stock_estimation_depth import SequenceState
+from backend_model.shelf_tracker import ShelfStateTracker
+from backend_model.pipeline import Stage, StagePipeline
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import multiprocessing
+import threading
+
+PIPELINE_STAGES = ["detection", "segmentation", "depth", "scoring", "refinement"]
+# Stages whose model call can run in a process pool; scoring keeps the sequence
+# state and refinement is network bound, so both stay on threads
+PROCESS_STAGES = ["detection", "segmentation", "depth"]
+
+
+# Model calls of the stages, at module level so process workers can run them
+def _detect_arrays(arrays, class_names):
+    return get_model("detection").detect_batch(arrays, class_names)
+
+
+def _segment_image(image, xyxy, labels):
+    return get_model("segmentation").segment(image, xyxy, labels)
+
+
+def _depth_images(images, roi):
+    return get_model("depth").get_depth_batch(images, roi=roi)
+
+
+class _PendingResult:
+    # Result of an image whose refinement may still be running; resolve() is
+    # called once, on first use
+    def __init__(self, resolve):
+        self._resolve = resolve
+        self._result = None
+
+    def result(self):
+        if self._result is None:
+            self._result = self._resolve()
+        return self._result
+
 
 class PlanningAgent:
-    def __init__(self):
-        self.detection_model = get_model("detection")
-        self.segmentation_model = get_model("segmentation")
-        self.depth_model = get_model("depth")
-        self.gemini_model = get_model("gemini")
+    def __init__(self, lazy=False, warmup_workers=None, stage_cache=None, depth_roi=False, depth_cascade=False,
+                 tracker_options=None, refine_async=False, refine_deadline=None, refine_workers=4, pipeline=None,
+                 pipeline_queue_size=2):
+        # Eager: load all models concurrently now. Lazy: each model loads on first use.
+        if not lazy:
+            warm_up(max_workers=warmup_workers)
+        # Optional StageCache of detections, masks and depth maps per image
+        self.stage_cache = stage_cache
+        # Keep depth at network resolution and upsample only the section boxes
+        self.depth_roi = depth_roi
+        # Score sections from their masks first; run depth only for images that need it
+        self.depth_cascade = depth_cascade
+        # ShelfStateTracker arguments; when set, frames after the first only rerun
+        # the models for sections whose content changed
+        self.tracker_options = tracker_options
+        # Refine in background threads while the next images run the local stages.
+        # Results are collected at the end of the batch; a refinement still running
+        # refine_deadline seconds after it was submitted then falls back to the
+        # depth-based values (None waits for it).
+        self.refine_async = refine_async
+        self.refine_deadline = refine_deadline
+        self.refine_workers = refine_workers
+        self._refiner = None
+        self._executor_lock = threading.Lock()  # refinement and process pools, stage stats
+        # Stage pipelining: {stage: {"workers": n, "kind": "thread" or "process"}}
+        # for the stages in PIPELINE_STAGES. Each stage works on its own images,
+        # handed over through queues of pipeline_queue_size. Process workers load
+        # their own copy of the stage's model.
+        for stage, options in (pipeline or {}).items():
+            if stage not in PIPELINE_STAGES:
+                raise ValueError(f"Unknown pipeline stage: {stage} (available: {', '.join(PIPELINE_STAGES)})")
+            if options.get("kind", "thread") == "process" and stage not in PROCESS_STAGES:
+                raise ValueError(f"The {stage} stage cannot run in processes (only {', '.join(PROCESS_STAGES)})")
+        self.pipeline = pipeline
+        self.pipeline_queue_size = pipeline_queue_size
+        self._process_pools = {}
+        self._stage_stats = {}
+
+    @property
+    def detection_model(self):
+        return get_model("detection")
+
+    @property
+    def segmentation_model(self):
+        return get_model("segmentation")
+
+    @property
+    def depth_model(self):
+        return get_model("depth")
+
+    @property
+    def gemini_model(self):
+        return get_model("gemini")
+
+    def reset(self):
+        # Forget the reference segmentation kept from the previous image sequence
+        self.depth_model.result_root_seg = None
+        self.depth_model.tracker = None
+
+    def process_image(self, image_path, class_names, state=None, score_params=None):
+        # Without a state the depth model keeps the reference between calls (main.py loop)
+        state = self.depth_model if state is None else state
+        return self.process_batch([image_path], class_names, state=state, score_params=score_params)[0]
+
+    def process_batch(self, image_paths, class_names, batch_size=None, progress=None, state=None,
+                      score_params=None):
+        # Detection and depth run as one forward pass per chunk of images (depth per
+        # image, and only when needed, in cascade mode); segmentation stays per image
+        # because every image has its own box prompts.
+        # progress(stage, image_index, total) is called as each stage starts.
+        # The batch is one image sequence with its own state unless one is given.
+        # score_params overrides the compute_stock thresholds (min_diff, min_obj_pixels, min_pixels).
+        # Images may be paths or DecodedImage objects; each is read and decoded once for all stages.
+        # With section tracking every stage runs per image, after the tracker has
+        # decided which sections changed since they were last scored.
+        # With refine_async the Gemini refinement of an image overlaps the local
+        # stages of the next ones; the results are collected at the end.
+        # With a pipeline (and no tracking) the stages run per image on their own
+        # workers, see _process_pipelined.
+        report = progress or (lambda stage, index, total: None)
+        state = state or SequenceState()
+        score_params = score_params or {}
+        if self.tracker_options is not None and state.tracker is None:
+            state.tracker = ShelfStateTracker(**self.tracker_options)
+        tracker = state.tracker
+        if self.pipeline is not None and tracker is None:
+            return self._process_pipelined(image_paths, class_names, report, state, score_params)
+        total = len(image_paths)
+        batch_size = batch_size or total
+        results = []
+        for start in range(0, total, batch_size):
+            chunk = [DecodedImage.of(image) for image in image_paths[start:start + batch_size]]
+            hashes = [image.hash for image in chunk] if self.stage_cache else None
+
+            # Detection and depth, batched up front unless decided per image
+            detections = [None] * len(chunk)
+            depth_maps = [None] * len(chunk)
+            if tracker is None:
+                report("detection", start, total)
+                detections = self._detect(chunk, hashes, class_names)
+                if not self.depth_cascade:
+                    report("depth", start, total)
+                    depth_maps = self._depth(chunk, hashes)
+
+            for offset, (image, detection, depth_map) in enumerate(zip(chunk, detections, depth_maps)):
+                index = start + offset
+                image_hash = hashes[offset] if hashes else None
+                image_hashes = [image_hash] if image_hash else None
+
+                changed = None
+                if tracker is not None and tracker.has_reference:
+                    report("tracking", index, total)
+                    changed = tracker.changed(image)
+                    if not changed.any():
+                        tracker.record(image, changed)
+                        previous = tracker.last_result
+                        if isinstance(previous, _PendingResult):
+                            # The previous frame is still being refined
+                            tracker.last_result = _PendingResult(lambda previous=previous, name=image.name: ImageResult(
+                                image=name, sections=list(previous.result().sections)))
+                            results.append(tracker.last_result)
+                        else:
+                            results.append(tracker.reuse(image))
+                        image.release()
+                        continue
+
+                if detection is None:
+                    report("detection", index, total)
+                    detection = self._detect([image], image_hashes, class_names)[0]
+                xyxy, labels, scores = detection
+                if changed is not None:
+                    xyxy, labels = tracker.prompts(xyxy, labels, changed)
+
+                # Segmentation
+                report("segmentation", index, total)
+                results_seg = self._segment(image, image_hash, xyxy, labels)
+
+                if self.depth_cascade:
+                    def depth_map(image=image, image_hashes=image_hashes, index=index):
+                        report("depth", index, total)
+                        return self._depth([image], image_hashes)[0]
+                elif depth_map is None:
+                    report("depth", index, total)
+                    depth_map = self._depth([image], image_hashes)[0]
+
+                # Compute stock in order, the first image of the sequence is the reference
+                report("scoring", index, total)
+                stock_dict, total_pos_dic = self.depth_model.compute_stock(
+                    results_seg, image, depth_map, state, changed=changed, **score_params)
+
+                report("refinement", index, total)
+                if self.refine_async:
+                    result = self._refine_async(image, stock_dict, total_pos_dic)
+                else:
+                    result = self.refine(image, stock_dict, total_pos_dic)
+                    image.release()
+                if tracker is not None:
+                    tracker.record(image, changed)
+                    tracker.last_result = result
+                results.append(result)
+        results = [result.result() if isinstance(result, _PendingResult) else result for result in results]
+        if tracker is not None:
+            tracker.last_result = results[-1] if results else tracker.last_result
+        return results
+
+    def _process_pipelined(self, image_paths, class_names, report, state, score_params):
+        # Image N+1 is segmented while image N is in depth; scoring takes the images
+        # one at a time in sequence order, since the first one is the reference.
+        # Section tracking decides per image from the previous one, so it is not
+        # pipelined.
+        total = len(image_paths)
+
+        def detection(item):
+            report("detection", item["index"], total)
+            item["detection"] = self._detect([item["image"]], item["hashes"], class_names)[0]
+            return item
+
+        def segmentation(item):
+            report("segmentation", item["index"], total)
+            xyxy, labels, scores = item["detection"]
+            item["segmentation"] = self._segment(item["image"], item["hash"], xyxy, labels)
+            return item
+
+        def depth(item):
+            if self.depth_cascade:
+                def depth_map(image=item["image"], hashes=item["hashes"], index=item["index"]):
+                    report("depth", index, total)
+                    return self._depth([image], hashes)[0]
+                item["depth"] = depth_map
+            else:
+                report("depth", item["index"], total)
+                item["depth"] = self._depth([item["image"]], item["hashes"])[0]
+            return item
+
+        def scoring(item):
+            report("scoring", item["index"], total)
+            item["stock"] = self.depth_model.compute_stock(
+                item["segmentation"], item["image"], item["depth"], state, **score_params)
+            return item
+
+        def refinement(item):
+            report("refinement", item["index"], total)
+            image, (stock_dict, total_pos_dic) = item["image"], item["stock"]
+            if self.refine_async:
+                return self._refine_async(image, stock_dict, total_pos_dic)
+            result = self.refine(image, stock_dict, total_pos_dic)
+            image.release()
+            return result
+
+        functions = {"detection": detection, "segmentation": segmentation, "depth": depth, "scoring": scoring,
+                     "refinement": refinement}
+        pipeline = StagePipeline([Stage(name, functions[name], ordered=name == "scoring", **self.pipeline.get(name, {}))
+                                  for name in PIPELINE_STAGES], self.pipeline_queue_size)
+        items = []
+        for index, image in enumerate(image_paths):
+            image = DecodedImage.of(image)
+            image_hash = image.hash if self.stage_cache else None
+            items.append({"index": index, "image": image, "hash": image_hash,
+                          "hashes": [image_hash] if image_hash else None})
+        results = pipeline.run(items)
+        self._record_stage_stats(pipeline)
+        return [result.result() if isinstance(result, _PendingResult) else result for result in results]
+
+    def _record_stage_stats(self, pipeline):
+        with self._executor_lock:
+            for name, values in pipeline.stats().items():
+                total = self._stage_stats.setdefault(name, {"items": 0, "busy": 0.0, "queue_wait": 0.0,
+                                                            "capacity": 0.0})
+                total.update(kind=values["kind"], workers=values["workers"])
+                total["items"] += values["items"]
+                total["busy"] += values["busy"]
+                total["queue_wait"] += values["queue_wait"]
+                total["capacity"] += values["workers"] * pipeline.elapsed
+
+    def stage_stats(self):
+        # Per pipeline stage over all pipelined batches: utilization of its workers
+        # and mean seconds an image waited in its input queue
+        with self._executor_lock:
+            return {name: {
+                "kind": values["kind"],
+                "workers": values["workers"],
+                "items": values["items"],
+                "busy": values["busy"],
+                "utilization": values["busy"] / values["capacity"] if values["capacity"] else 0.0,
+                "mean_queue_wait": values["queue_wait"] / values["items"] if values["items"] else 0.0,
+            } for name, values in self._stage_stats.items()}
+
+    def close(self, wait=True):
+        # Shut down the refinement threads and the stage process pools; they are
+        # created again if the agent is used afterwards
+        with self._executor_lock:
+            executors = list(self._process_pools.values())
+            if self._refiner is not None:
+                executors.append(self._refiner)
+            self._process_pools = {}
+            self._refiner = None
+        for executor in executors:
+            executor.shutdown(wait=wait, cancel_futures=True)
+
+    def _compute(self, stage, func, *args):
+        # A stage's model call, here or in the stage's process pool
+        options = (self.pipeline or {}).get(stage, {})
+        if options.get("kind", "thread") != "process":
+            return func(*args)
+        with self._executor_lock:
+            pool = self._process_pools.get(stage)
+            if pool is None:
+                # spawn: forked torch and OpenMP state is not safe to reuse
+                pool = ProcessPoolExecutor(max_workers=options.get("workers", 1),
+                                           mp_context=multiprocessing.get_context("spawn"),
+                                           initializer=model_cache.configure_all, initargs=(model_cache.options(),))
+                self._process_pools[stage] = pool
+        return pool.submit(func, *args).result()
+
+    def _refine_async(self, image, stock_dict, total_pos_dic):
+        with self._executor_lock:
+            if self._refiner is None:
+                self._refiner = ThreadPoolExecutor(max_workers=self.refine_workers,
+                                                   thread_name_prefix="gemini-refine")
+        future = self._refiner.submit(self.refine, image, stock_dict, total_pos_dic)
+        # The mosaic payload crops the decoded image, so it is released afterwards
+        future.add_done_callback(lambda _: image.release())
+        deadline = None if self.refine_deadline is None else time.monotonic() + self.refine_deadline
+
+        def resolve():
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                return future.result(timeout=timeout)
+            except Exception as e:
+                future.cancel()
+                reason = "missed the deadline" if not future.done() or future.cancelled() else f"failed: {e}"
+                print(f"Refinement of {image.name} {reason}, keeping the depth-based values")
+                return ImageResult.from_stock_dict(image.name, stock_dict, total_pos_dic)
 
-    def process_image(self, image_path, class_names):
-        image = Image.open(image_path)
+        return _PendingResult(resolve)
 
-        # Detection
-        xyxy, labels, scores = self.detection_model.detect(image, class_names)
+    def _detect(self, images, hashes, class_names):
+        params = (class_names, self.detection_model.model_id)
+        detections = [None] * len(images)
+        if self.stage_cache:
+            for i, image_hash in enumerate(hashes):
+                detections[i] = self.stage_cache.get_detection(image_hash, *params)
+        missing = [i for i, detection in enumerate(detections) if detection is None]
+        if missing:
+            arrays = [images[i].rgb for i in missing]
+            for i, detection in zip(missing, self._compute("detection", _detect_arrays, arrays, class_names)):
+                detections[i] = detection
+                if self.stage_cache:
+                    self.stage_cache.put_detection(hashes[i], detection, *params)
+        return detections
 
-        # Segmentation
-        results_seg = self.segmentation_model.segment(image_path, xyxy, labels)
+    def _depth(self, images, hashes):
+        params = (self.depth_model.model_id, self.depth_roi)
+        depth_maps = [None] * len(images)
+        if self.stage_cache:
+            for i, image_hash in enumerate(hashes):
+                depth_maps[i] = self.stage_cache.get_depth(image_hash, *params)
+        missing = [i for i, depth_map in enumerate(depth_maps) if depth_map is None]
+        if missing:
+            batch = self._compute("depth", _depth_images, [images[i] for i in missing], self.depth_roi)
+            for i, depth_map in zip(missing, batch):
+                depth_maps[i] = depth_map
+                if self.stage_cache:
+                    self.stage_cache.put_depth(hashes[i], depth_map, *params)
+        return depth_maps
 
-        # Depth and compute stock
-        stock_dict, total_pos_dic = self.depth_model.compute_stock(results_seg, image_path)
+    def _segment(self, image, image_hash, xyxy, labels):
+        params = (self.segmentation_model.model_name, self.segmentation_model.precision, xyxy, labels)
+        if self.stage_cache:
+            results_seg = self.stage_cache.get_segmentation(image_hash, image.name, *params)
+            if results_seg is not None:
+                return results_seg
+        results_seg = self._compute("segmentation", _segment_image, image, xyxy, labels)
+        if self.stage_cache:
+            self.stage_cache.put_segmentation(image_hash, results_seg, *params)
+        return results_seg
 
+    def refine(self, image, stock_dict, total_pos_dic):
         pos_dic = {}
         for cls, values in stock_dict.items():
             index = 0
@@ -30,7 +391,14 @@ class PlanningAgent:
                     pos_dic[cls].append(index)
                 index += 1
 
+        refined_pos = {}
         if pos_dic:
-            stock_dict = self.gemini_model.stock_estimation(image_path, pos_dic, total_pos_dic, stock_dict)
+            refined = self.gemini_model.stock_estimation(image, pos_dic, total_pos_dic, stock_dict)
+            # Keep the depth-based values when the refinement call fails
+            if refined is not None:
+                stock_dict = refined
+                refined_pos = pos_dic
 
-        self.depth_model.print_result(stock_dict)
\ No newline at end of file
+        self.depth_model.print_result(stock_dict)
+        image = DecodedImage.of(image)
+        return ImageResult.from_stock_dict(image.name, stock_dict, total_pos_dic, refined_pos)
@@ -0,0 +1,121 @@
+import json
+import struct
+from dataclasses import dataclass, field, asdict
+from typing import List, Tuple
+
+# Bump whenever a change to the models or thresholds alters pipeline output
+PIPELINE_VERSION = "3"
+
+SOURCE_DEPTH = "depth"
+SOURCE_GEMINI = "gemini"
+_SOURCES = [SOURCE_DEPTH, SOURCE_GEMINI]
+
+# Binary layout: magic, then length-prefixed image name and class table,
+# then one fixed-size record per section.
+_MAGIC = b"FSR1"
+_SECTION = struct.Struct("<HH4ffBB")
+
+
+@dataclass
+class SectionResult:
+    cls: str
+    index: int  # position of the section within its class, 0-based
+    bbox: Tuple[float, float, float, float]
+    fullness: float  # percentage 0-100
+    layers: int
+    source: str = SOURCE_DEPTH
+
+
+@dataclass
+class ImageResult:
+    image: str
+    sections: List[SectionResult] = field(default_factory=list)
+
+    @classmethod
+    def from_stock_dict(cls, image, stock_dict, pos_dic, refined_pos=None):
+        # stock_dict: {cls: [(fullness, layers), ...]}, pos_dic: {cls: [box, ...]}
+        # refined_pos: {cls: [index, ...]} of sections whose value came from Gemini
+        refined_pos = refined_pos or {}
+        sections = []
+        for name, values in stock_dict.items():
+            for index, (fullness, layers) in enumerate(values):
+                box = pos_dic[name][index]
+                source = SOURCE_GEMINI if index in refined_pos.get(name, []) else SOURCE_DEPTH
+                sections.append(SectionResult(
+                    cls=name,
+                    index=index,
+                    bbox=tuple(float(v) for v in box),
+                    fullness=float(fullness),
+                    layers=int(layers),
+                    source=source,
+                ))
+        return cls(image=image, sections=sections)
+
+    @property
+    def degraded(self):
+        # True when a section that goes to Gemini (depth fullness 0, see
+        # PlanningAgent.refine) kept its depth value: the call failed or missed
+        # its deadline
+        return any(s.source == SOURCE_DEPTH and s.fullness == 0 for s in self.sections)
+
+    def to_stock_dict(self):
+        stock_dict = {}
+        for section in self.sections:
+            stock_dict.setdefault(section.cls, []).append((section.fullness, section.layers))
+        return stock_dict
+
+    def to_dict(self):
+        return asdict(self)
+
+    @classmethod
+    def from_dict(cls, data):
+        sections = [SectionResult(**{**s, "bbox": tuple(s["bbox"])}) for s in data["sections"]]
+        return cls(image=data["image"], sections=sections)
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), separators=(",", ":"))
+
+    @classmethod
+    def from_json(cls, text):
+        return cls.from_dict(json.loads(text))
+
+    def to_bytes(self):
+        classes = list(dict.fromkeys(s.cls for s in self.sections))
+        image = self.image.encode("utf-8")
+        parts = [_MAGIC, struct.pack("<I", len(image)), image, struct.pack("<H", len(classes))]
+        for name in classes:
+            encoded = name.encode("utf-8")
+            parts.append(struct.pack("<H", len(encoded)))
+            parts.append(encoded)
+        parts.append(struct.pack("<I", len(self.sections)))
+        for s in self.sections:
+            parts.append(_SECTION.pack(classes.index(s.cls), s.index, *s.bbox,
+                                       s.fullness, s.layers, _SOURCES.index(s.source)))
+        return b"".join(parts)
+
+    @classmethod
+    def from_bytes(cls, data):
+        if data[:4] != _MAGIC:
+            raise ValueError("Not a serialized ImageResult")
+        offset = 4
+        (length,) = struct.unpack_from("<I", data, offset)
+        offset += 4
+        image = data[offset:offset + length].decode("utf-8")
+        offset += length
+        (n_classes,) = struct.unpack_from("<H", data, offset)
+        offset += 2
+        classes = []
+        for _ in range(n_classes):
+            (length,) = struct.unpack_from("<H", data, offset)
+            offset += 2
+            classes.append(data[offset:offset + length].decode("utf-8"))
+            offset += length
+        (n_sections,) = struct.unpack_from("<I", data, offset)
+        offset += 4
+        sections = []
+        for _ in range(n_sections):
+            cls_id, index, x1, y1, x2, y2, fullness, layers, source = _SECTION.unpack_from(data, offset)
+            offset += _SECTION.size
+            sections.append(SectionResult(classes[cls_id], index, (x1, y1, x2, y2),
+                                          fullness, layers, _SOURCES[source]))
+        return cls(image=image, sections=sections)
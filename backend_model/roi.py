@@ -0,0 +1,126 @@
+from backend_model.imports import *
+
+
+class RoiMask:
+    # Section mask kept only inside its bounding box, bit-packed.
+    # Memory is bounded by the box area / 8 instead of the full image size.
+    __slots__ = ("box", "shape", "bits", "count")
+
+    def __init__(self, roi, box):
+        self.box = box  # (x1, y1, x2, y2) integer slice of the full mask
+        self.shape = roi.shape
+        self.bits = np.packbits(roi, axis=None)
+        self.count = int(np.count_nonzero(roi))  # object pixels, read without unpacking
+
+    @classmethod
+    def from_tensor(cls, mask_tensor, bbox):
+        # Slice on the device first so only the box region is copied to host
+        x1, y1, x2, y2 = map(int, bbox)
+        roi = mask_tensor[y1:y2, x1:x2].cpu().numpy().astype(np.uint8) > 0
+        return cls(roi, (x1, y1, x2, y2))
+
+    def roi(self):
+        # Boolean mask of the box region, same as full_mask[y1:y2, x1:x2] > 0
+        count = int(np.prod(self.shape))
+        return np.unpackbits(self.bits, count=count).reshape(self.shape).view(bool)
+
+    def full(self, image_shape):
+        mask = np.zeros(image_shape, dtype=np.uint8)
+        x1, y1, x2, y2 = self.box
+        mask[y1:y2, x1:x2] = self.roi()
+        return mask
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    @property
+    def nbytes(self):
+        return self.bits.nbytes
+
+
+def _cubic_weights(in_size, out_size, indices):
+    # Rows of the bicubic resampling matrix F.interpolate(mode="bicubic",
+    # align_corners=False) applies along one axis, for the given output indices.
+    # Only the input range the rows touch is returned: (weights, first input index).
+    a = -0.75
+    scale = in_size / out_size
+    real = scale * (indices + 0.5) - 0.5
+    start = np.floor(real)
+    t = real - start
+    taps = [
+        ((a * (t + 1) - 5 * a) * (t + 1) + 8 * a) * (t + 1) - 4 * a,
+        ((a + 2) * t - (a + 3)) * t * t + 1,
+        ((a + 2) * (1 - t) - (a + 3)) * (1 - t) * (1 - t) + 1,
+        ((a * (2 - t) - 5 * a) * (2 - t) + 8 * a) * (2 - t) - 4 * a,
+    ]
+    start = start.astype(np.int64)
+    if len(indices) == 0:
+        return np.zeros((0, 0)), 0
+    first = max(int(start.min()) - 1, 0)
+    last = min(int(start.max()) + 2, in_size - 1)
+    weights = np.zeros((len(indices), last - first + 1))
+    rows = np.arange(len(indices))
+    for k, w in enumerate(taps):
+        # Border taps are clamped, as the torch kernel does
+        np.add.at(weights, (rows, np.clip(start - 1 + k, 0, in_size - 1) - first), w)
+    return weights, first
+
+
+class RoiDepthMap:
+    # Depth prediction kept at network resolution. Indexing with a region of the
+    # full image, depth[y1:y2, x1:x2], upsamples only that region with the same
+    # bicubic kernel as the full-size map; full() builds the whole map for display.
+    def __init__(self, prediction, shape, normalize=True, strip=256):
+        self.prediction = np.asarray(prediction, dtype=np.float32)
+        self.shape = tuple(shape)
+        self.dtype = self.prediction.dtype
+        if normalize:
+            # Bicubic weights sum to one, so normalizing the prediction with the
+            # min/max of the full-size map gives the same values as normalizing
+            # the full-size map
+            lo, hi = self._upsampled_range(strip)
+            self.prediction = ((self.prediction - lo) / (hi - lo)).astype(np.float32)
+
+    def _region(self, y, x):
+        wy, y0 = _cubic_weights(self.prediction.shape[0], self.shape[0], y)
+        wx, x0 = _cubic_weights(self.prediction.shape[1], self.shape[1], x)
+        support = self.prediction[y0:y0 + wy.shape[1], x0:x0 + wx.shape[1]]
+        return wy @ support @ wx.T
+
+    def _upsampled_range(self, strip):
+        # Exact min/max of the full-size map. Bicubic overshoot can put them
+        # anywhere, so every output pixel is computed, strip rows at a time and
+        # only the running min/max kept: memory stays at strip x width.
+        height, width = self.shape
+        wx, x0 = _cubic_weights(self.prediction.shape[1], width, np.arange(width))
+        # Columns first: network rows x full width
+        columns = self.prediction[:, x0:x0 + wx.shape[1]] @ wx.T
+        lo, hi = np.inf, -np.inf
+        for top in range(0, height, strip):
+            wy, y0 = _cubic_weights(self.prediction.shape[0], height, np.arange(top, min(top + strip, height)))
+            rows = wy @ columns[y0:y0 + wy.shape[1]]
+            lo, hi = min(lo, float(rows.min())), max(hi, float(rows.max()))
+        return lo, hi
+
+    def __getitem__(self, key):
+        rows, cols = key
+        height, width = self.shape
+        y = np.arange(*rows.indices(height))
+        x = np.arange(*cols.indices(width))
+        if len(y) == 0 or len(x) == 0:
+            return np.zeros((len(y), len(x)), dtype=self.dtype)
+        return self._region(y, x).astype(self.dtype)
+
+    def has_nan(self):
+        return bool(np.isnan(self.prediction).any())
+
+    def full(self):
+        with torch.no_grad():
+            depth = F.interpolate(torch.from_numpy(self.prediction)[None, None], size=self.shape,
+                                  mode="bicubic", align_corners=False).squeeze()
+        return depth.numpy()
+
+    @property
+    def nbytes(self):
+        return self.prediction.nbytes
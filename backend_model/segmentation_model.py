@@ -1,21 +1,139 @@
 from backend_model.imports import *
+from backend_model.decoded_image import DecodedImage
+from backend_model.onnx_runtime import OnnxRunner, onnx_name
+from ultralytics.engine.results import Results
+from collections import OrderedDict
+import threading
+from contextlib import nullcontext
+
+# SAM2.1 checkpoints by size; any other .pt name is passed to ultralytics as is
+SAM_VARIANTS = {
+    "tiny": "sam2.1_t.pt",
+    "small": "sam2.1_s.pt",
+    "base": "sam2.1_b.pt",
+    "large": "sam2.1_l.pt",
+}
+# fp32: as trained. bf16: autocast on CPU or GPU. int8: dynamic int8 Linear
+# weights, CPU only.
+SAM_PRECISIONS = ["fp32", "bf16", "int8"]
 
 
 class SegmentationModel:
-    def __init__(self, model_name = "sam2.1_l.pt"):
-        self.model_name = model_name
+    def __init__(self, model_name = "sam2.1_l.pt", precision="fp32", embedding_cache_size=8, prompt_chunk=32,
+                 onnx_dir=None, onnx_threads=0):
+        if precision not in SAM_PRECISIONS:
+            raise ValueError(f"Unknown SAM precision: {precision} (available: {', '.join(SAM_PRECISIONS)})")
+        if onnx_dir and precision != "fp32":
+            raise ValueError("The ONNX image encoder is exported in fp32; use precision='fp32' with onnx_dir")
+        self.model_name = SAM_VARIANTS.get(model_name, model_name)
+        self.precision = precision
         self.model_seg = None
+        # The ultralytics predictor keeps per-call state, so calls are serialized
+        self._lock = threading.Lock()
+        # Image embeddings per image hash, so the same frame can be prompted again
+        # with other boxes without running the image encoder
+        self.embedding_cache_size = embedding_cache_size
+        self._embeddings = OrderedDict()
+        # Box prompts decoded per mask decoder pass; bounds the full-size mask memory
+        self.prompt_chunk = prompt_chunk
+        self.counters = {"embeddings": 0, "embedding_hits": 0}
+        # Exported image encoder from backend_model.onnx_export; the prompt
+        # decoder is small and stays in PyTorch
+        self.onnx_dir = onnx_dir
+        self.onnx_threads = onnx_threads
+        self.onnx = None
 
     def load(self):
         self.model_seg = SAM(self.model_name)
-        print("Segmentation model loaded")
+        if self.precision == "int8":
+            # Activations are quantized on the fly, so no calibration data is needed
+            self.model_seg.model = torch.ao.quantization.quantize_dynamic(
+                self.model_seg.model, {torch.nn.Linear}, dtype=torch.qint8)
+        if self.onnx_dir:
+            self.onnx = OnnxRunner(self.onnx_dir, onnx_name("segmentation", self.model_name), self.onnx_threads)
+        print(f"Segmentation model loaded ({self.model_name}, {self.precision})")
+
+    def _predictor(self):
+        # Set up the predictor with the arguments SAM.predict would use
+        if self.model_seg.predictor is None:
+            args = {**self.model_seg.overrides, "conf": 0.25, "batch": 1, "save": False, "mode": "predict",
+                    "task": "segment", "imgsz": 1024, "retina_masks": True}
+            if self.precision == "int8":
+                # Quantized Linear layers only have CPU kernels
+                args["device"] = "cpu"
+            predictor = self.model_seg._smart_load("predictor")(overrides=args, _callbacks=self.model_seg.callbacks)
+            predictor.setup_model(model=self.model_seg.model, verbose=False)
+            if self.onnx is not None:
+                self._encode_with_onnx(predictor)
+            self.model_seg.predictor = predictor
+        return self.model_seg.predictor
+
+    def _encode_with_onnx(self, predictor):
+        # set_image calls get_im_features on the preprocessed 1x3xSxS image
+        encode = predictor.get_im_features
+
+        def get_im_features(im):
+            outputs = self.onnx.run(im.shape[-2:], {"image": im}) if self.onnx is not None else None
+            if outputs is None:
+                return encode(im)
+            image_embed, *high_res_feats = outputs
+            return {"image_embed": image_embed, "high_res_feats": high_res_feats}
+
+        predictor.get_im_features = get_im_features
 
-    def segment(self, image_path, xyxy,labels):
-        results = self.model_seg.predict(image_path, bboxes = xyxy)
-        for index, names in results[0].names.items():
-            results[0].names[index] = f"{labels[index]}"
+    def _autocast(self, predictor):
+        if self.precision != "bf16":
+            return nullcontext()
+        return torch.autocast(predictor.device.type, dtype=torch.bfloat16)
+
+    def embed(self, image):
+        # Image encoder output for the image, computed once per image hash
+        image = DecodedImage.of(image)
+        with self._lock:
+            embedding = self._embeddings.get(image.hash)
+            if embedding is not None:
+                self._embeddings.move_to_end(image.hash)
+                self.counters["embedding_hits"] += 1
+                return embedding
+            predictor = self._predictor()
+            with self._autocast(predictor):
+                predictor.set_image(image.bgr)
+            embedding = (predictor.features, image.size)
+            predictor.reset_image()
+            self.counters["embeddings"] += 1
+            if self.embedding_cache_size > 0:
+                self._embeddings[image.hash] = embedding
+                while len(self._embeddings) > self.embedding_cache_size:
+                    self._embeddings.popitem(last=False)
+        return embedding
+
+    def decode_prompts(self, image, xyxy, chunk_size=None):
+        # Masks and boxes [x1, y1, x2, y2, score, prompt index] for the box prompts,
+        # filtered by score as SAM.predict does
+        if len(xyxy) == 0:
+            return None, torch.zeros((0, 6))
+        features, src_shape = self.embed(image)
+        chunk_size = chunk_size or self.prompt_chunk
+        masks, boxes = [], []
+        with self._lock:
+            predictor = self._predictor()
+            for start in range(0, len(xyxy), chunk_size):
+                with self._autocast(predictor):
+                    chunk_masks, chunk_boxes = predictor.inference_features(
+                        features, src_shape, bboxes=xyxy[start:start + chunk_size])
+                chunk_boxes = chunk_boxes.float()
+                keep = chunk_boxes[:, 4] > predictor.args.conf
+                # Shift the class column from the index in the chunk to the prompt index
+                offset = torch.tensor([0, 0, 0, 0, 0, start], dtype=chunk_boxes.dtype, device=chunk_boxes.device)
+                masks.append(chunk_masks[keep])
+                boxes.append(chunk_boxes[keep] + offset)
+        return torch.cat(masks), torch.cat(boxes)
+
+    def segment(self, image, xyxy,labels):
+        image = DecodedImage.of(image)
+        masks, boxes = self.decode_prompts(image, xyxy)
+        names = {index: f"{label}" for index, label in enumerate(labels)}
+        results = [Results(image.bgr, path=image.name, names=names, boxes=boxes, masks=masks)]
         #results[0].show()
         #results[0].save("../Captone_AI/result_images/result_segmentation_image.jpg")
         return results
-
-
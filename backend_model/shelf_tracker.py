@@ -0,0 +1,92 @@
+from backend_model.imports import *
+from backend_model.decoded_image import DecodedImage
+from backend_model.results import ImageResult
+
+
+class ShelfStateTracker:
+    # Section state of one image sequence (T0..Tn). The sections are the
+    # reference frame's boxes, as compute_stock scores them. For each section
+    # the tracker keeps a small grayscale thumbnail of its box from the frame it
+    # was last scored on, plus that score. A new frame only rescores sections
+    # whose box content changed; when none did, the frame reuses the previous
+    # result and no model runs at all.
+    def __init__(self, change_threshold=0.05, pixel_threshold=25, thumbnail_size=64):
+        self.change_threshold = change_threshold  # fraction of changed thumbnail pixels
+        self.pixel_threshold = pixel_threshold  # gray level difference of a changed pixel
+        self.thumbnail_size = thumbnail_size
+        self.sections = []  # (cls, box) per reference section, in compute_stock order
+        self.scores = []  # (fullness, layers) per section
+        self._thumbnails = []
+        self.last_result = None  # ImageResult of the last frame, after refinement
+        self.frames = []  # per frame: image, sections, rescored, skipped
+
+    @property
+    def has_reference(self):
+        return self.last_result is not None
+
+    def _thumbnail(self, gray, box):
+        x1, y1, x2, y2 = map(int, box)
+        roi = gray[max(y1, 0):max(y2, 0), max(x1, 0):max(x2, 0)]
+        if roi.size == 0:
+            return np.zeros((1, 1), dtype=np.int16)
+        scale = min(1.0, self.thumbnail_size / max(roi.shape))
+        size = (max(1, round(roi.shape[1] * scale)), max(1, round(roi.shape[0] * scale)))
+        # Area averaging also smooths sensor noise before the comparison
+        return cv2.resize(roi, size, interpolation=cv2.INTER_AREA).astype(np.int16)
+
+    def changed(self, image):
+        # Bool per section: does its box differ from the frame it was scored on
+        gray = cv2.cvtColor(DecodedImage.of(image).bgr, cv2.COLOR_BGR2GRAY)
+        changed = np.zeros(len(self.sections), dtype=bool)
+        for i, ((_, box), thumbnail) in enumerate(zip(self.sections, self._thumbnails)):
+            current = self._thumbnail(gray, box)
+            if current.shape != thumbnail.shape:
+                changed[i] = True
+                continue
+            moved = np.abs(current - thumbnail) > self.pixel_threshold
+            changed[i] = moved.mean() > self.change_threshold
+        return changed
+
+    def prompts(self, xyxy, labels, changed):
+        # Detections overlapping a changed section; only those are segmented again
+        if not changed.any() or not xyxy:
+            return [], []
+        boxes = np.asarray(xyxy, dtype=float).reshape(-1, 4)
+        targets = np.asarray([box for (_, box), c in zip(self.sections, changed) if c], dtype=float)
+        overlap_w = np.minimum(boxes[:, None, 2], targets[:, 2]) - np.maximum(boxes[:, None, 0], targets[:, 0])
+        overlap_h = np.minimum(boxes[:, None, 3], targets[:, 3]) - np.maximum(boxes[:, None, 1], targets[:, 1])
+        keep = ((overlap_w > 0) & (overlap_h > 0)).any(axis=1)
+        return [xyxy[i] for i in np.flatnonzero(keep)], [labels[i] for i in np.flatnonzero(keep)]
+
+    def update(self, image, items, scored, changed=None):
+        # Record the scores of a frame; changed=None is the reference frame (all sections)
+        gray = cv2.cvtColor(DecodedImage.of(image).bgr, cv2.COLOR_BGR2GRAY)
+        if changed is None:
+            self.sections = [(cls, box) for cls, box, _ in items]
+            self.scores = list(scored)
+            self._thumbnails = [self._thumbnail(gray, box) for _, box in self.sections]
+            return
+        for i in np.flatnonzero(changed):
+            self.scores[i] = scored[i]
+            self._thumbnails[i] = self._thumbnail(gray, self.sections[i][1])
+
+    def reuse(self, image):
+        # Result of a frame in which no section changed
+        result = ImageResult(image=DecodedImage.of(image).name, sections=list(self.last_result.sections))
+        self.last_result = result
+        return result
+
+    def record(self, image, changed=None):
+        n = len(self.sections)
+        rescored = n if changed is None else int(np.count_nonzero(changed))
+        frame = {"image": DecodedImage.of(image).name, "sections": n, "rescored": rescored,
+                 "skipped": n - rescored}
+        self.frames.append(frame)
+        return frame
+
+    def stats(self):
+        return {
+            "frames": len(self.frames),
+            "sections_rescored": sum(f["rescored"] for f in self.frames),
+            "sections_skipped": sum(f["skipped"] for f in self.frames),
+        }
@@ -0,0 +1,165 @@
+from backend_model.imports import *
+import hashlib
+import threading
+import zipfile
+from collections import OrderedDict
+from ultralytics.engine.results import Results
+from backend_model.decoded_image import DecodedImage
+from backend_model.roi import RoiDepthMap
+
+
+def hash_image(image):
+    # Hash of the encoded bytes; a DecodedImage reuses the bytes it already read
+    return DecodedImage.of(image).hash
+
+
+def _key(*parts):
+    return hashlib.sha256("|".join(str(p) for p in parts).encode()).hexdigest()[:32]
+
+
+class StageCache:
+    # On-disk memo of detection boxes, SAM masks and depth maps per image hash,
+    # so changing only the scoring thresholds does not rerun the models.
+    # Masks are bit-packed, depth is stored as float16. Oldest files are
+    # evicted once the directory grows past max_bytes.
+    def __init__(self, cache_dir="stage_cache", max_bytes=2 * 1024 ** 3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._index = None  # file name -> size, least recently used first
+        self._total = 0
+        self._lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def _load_index(self):
+        if self._index is not None:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith((".npz", ".npy")):
+                stat = os.stat(os.path.join(self.cache_dir, name))
+                entries.append((stat.st_mtime, name, stat.st_size))
+        self._index = OrderedDict((name, size) for _, name, size in sorted(entries))
+        self._total = sum(self._index.values())
+
+    def _lookup(self, name):
+        with self._lock:
+            self._load_index()
+            if name not in self._index:
+                return None
+            self._index.move_to_end(name)
+            path = os.path.join(self.cache_dir, name)
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return path
+
+    def _load(self, name, read):
+        # read(npz) for a cached file, or None on a miss. A file evicted by another
+        # worker after the lookup, or a truncated or corrupt one, is a miss too.
+        path = self._lookup(name)
+        if path is not None:
+            try:
+                with np.load(path) as data:
+                    value = read(data)
+                with self._lock:
+                    self.counters["hits"] += 1
+                return value
+            except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile) as e:
+                print(f"Dropping unreadable stage cache entry {name}: {e}")
+                with self._lock:
+                    self._total -= self._index.pop(name, 0)
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+        with self._lock:
+            self.counters["misses"] += 1
+        return None
+
+    def _store(self, name, write):
+        path = os.path.join(self.cache_dir, name)
+        with self._lock:
+            self._load_index()
+        # Write to a temporary file first so readers never see a partial file
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            write(f)
+        os.replace(tmp_path, path)
+        size = os.path.getsize(path)
+        with self._lock:
+            self._total += size - self._index.pop(name, 0)
+            self._index[name] = size
+            while self._total > self.max_bytes and len(self._index) > 1:
+                old, old_size = self._index.popitem(last=False)
+                self._total -= old_size
+                self.counters["evictions"] += 1
+                try:
+                    os.remove(os.path.join(self.cache_dir, old))
+                except OSError:
+                    pass
+
+    def stats(self):
+        with self._lock:
+            return {**self.counters, "files": len(self._index or {}), "bytes": self._total,
+                    "max_bytes": self.max_bytes}
+
+    # Detection: boxes, labels and scores after NMS
+    def get_detection(self, image_hash, *params):
+        return self._load(f"det_{_key(image_hash, *params)}.npz", lambda data: (
+            data["xyxy"].tolist(), data["labels"].tolist(), data["scores"].tolist()))
+
+    def put_detection(self, image_hash, detection, *params):
+        xyxy, labels, scores = detection
+        self._store(f"det_{_key(image_hash, *params)}.npz", lambda f: np.savez(
+            f,
+            xyxy=np.asarray(xyxy, dtype=np.float64).reshape(-1, 4),
+            labels=np.asarray(labels, dtype=str),
+            scores=np.asarray(scores, dtype=np.float64),
+        ))
+
+    # Segmentation: SAM boxes and bit-packed masks, rebuilt as ultralytics Results
+    def get_segmentation(self, image_hash, img_path, *params):
+        def read(data):
+            shape = tuple(data["mask_shape"])
+            masks = np.unpackbits(data["masks"], count=int(np.prod(shape))).reshape(shape).astype(bool)
+            names = dict(enumerate(data["names"].tolist()))
+            # Results only reads the image shape, so a zero-stride view avoids allocating it
+            orig_img = np.broadcast_to(np.zeros(1, dtype=np.uint8), (*shape[1:], 3))
+            return [Results(orig_img, path=img_path, names=names,
+                            boxes=torch.from_numpy(data["boxes"]), masks=torch.from_numpy(masks))]
+
+        return self._load(f"seg_{_key(image_hash, *params)}.npz", read)
+
+    def put_segmentation(self, image_hash, results_seg, *params):
+        r = results_seg[0]
+        if r.masks is None:
+            return
+        masks = r.masks.data.cpu().numpy() > 0.5
+        names = [r.names[i] for i in range(len(r.names))]
+        self._store(f"seg_{_key(image_hash, *params)}.npz", lambda f: np.savez(
+            f,
+            boxes=r.boxes.data.cpu().numpy(),
+            names=np.asarray(names, dtype=str),
+            mask_shape=np.asarray(masks.shape),
+            masks=np.packbits(masks, axis=None),
+        ))
+
+    # Depth: normalized depth map as float16, or the network-resolution
+    # prediction and image shape of an RoiDepthMap
+    def get_depth(self, image_hash, *params):
+        def read(data):
+            depth = data["depth"].astype(np.float32)
+            if "shape" in data:
+                return RoiDepthMap(depth, tuple(int(v) for v in data["shape"]), normalize=False)
+            return depth
+
+        return self._load(f"depth_{_key(image_hash, *params)}.npz", read)
+
+    def put_depth(self, image_hash, depth_map, *params):
+        if isinstance(depth_map, RoiDepthMap):
+            arrays = {"depth": depth_map.prediction.astype(np.float16), "shape": np.asarray(depth_map.shape)}
+        else:
+            arrays = {"depth": depth_map.astype(np.float16)}
+        self._store(f"depth_{_key(image_hash, *params)}.npz", lambda f: np.savez(f, **arrays))
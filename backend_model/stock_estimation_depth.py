@@ -1,26 +1,66 @@
 from backend_model.imports import *
+from backend_model.decoded_image import DecodedImage
+from backend_model.roi import RoiMask, RoiDepthMap
+from backend_model.depth_backends import get_depth_backend
+from backend_model.onnx_runtime import OnnxRunner, onnx_name
 CLASSES = ["potato section", "onion", "eggplant section", "tomato", "cucumber"]
+
+class SequenceState:
+    # Reference segmentation of one image sequence (T0..Tn), kept per request
+    # so concurrent sequences never merge masks into each other
+    def __init__(self):
+        self.result_root_seg = None
+        # Images whose depth map the cascade had to compute, or could skip
+        self.depth_computed = 0
+        self.depth_skipped = 0
+        # Optional ShelfStateTracker: only sections that changed are scored again
+        self.tracker = None
+
 class DepthModel:
-    def __init__(self, model_type="DPT_Hybrid"):
+    def __init__(self, model_type="DPT_Hybrid", cache_dir=None, onnx_dir=None, onnx_threads=0,
+                 native_transform=False):
+        # model_type is any name in DEPTH_BACKENDS; cache_dir holds downloaded weights.
+        # With onnx_dir, exported graphs from backend_model.onnx_export run under ONNX Runtime.
+        # native_transform: see backend_model.depth_backends.
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
         self.model_id = model_type
+        self.backend = get_depth_backend(model_type)
+        self.cache_dir = cache_dir
+        self.native_transform = native_transform
         self.model_depth = None
         self.transform = None
+        self.onnx_dir = onnx_dir
+        self.onnx_threads = onnx_threads
+        self.onnx = None
         self.result_root_seg = None
+        self.depth_computed = 0
+        self.depth_skipped = 0
+        self.tracker = None
     def load(self):
-        self.model_depth = torch.hub.load("intel-isl/MiDaS", self.model_id)
-        self.model_depth.eval().to(self.device)
-        self.transforms = torch.hub.load("intel-isl/MiDaS", "transforms")
-        self.transform = self.transforms.dpt_transform if "large" in self.model_id.lower() else self.transforms.small_transform
-        print("Loaded depth model sucessfully")
-    def get_depth(self, img_path, normalize=True):
-        img = cv2.imread(img_path)
-        img_rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+        self.model_depth, self.transform = self.backend.load(self.device, self.cache_dir, self.native_transform)
+        if self.onnx_dir:
+            self.onnx = OnnxRunner(self.onnx_dir, onnx_name("depth", self.model_id), self.onnx_threads)
+        print(f"Loaded depth model {self.model_id} sucessfully")
+
+    def predict(self, input_batch):
+        # BxHxW prediction from the exported graph for this input size, else the PyTorch model
+        if self.onnx is not None:
+            outputs = self.onnx.run(input_batch.shape[-2:], {"image": input_batch})
+            if outputs is not None:
+                return outputs[0]
+        with torch.no_grad():
+            return self.model_depth(input_batch)
+    def get_depth(self, img_path, normalize=True, roi=False):
+        # roi=True returns an RoiDepthMap at network resolution instead of
+        # upsampling the whole map; only the regions that are read get upsampled
+        img_rgb = DecodedImage.of(img_path).rgb
 
         input_batch = self.transform(img_rgb).to(self.device)
 
+        prediction = self.predict(input_batch)
         with torch.no_grad():
-            prediction = self.model_depth(input_batch)
+            if roi:
+                return RoiDepthMap(prediction.squeeze().cpu().numpy(), img_rgb.shape[:2], normalize)
             prediction = torch.nn.functional.interpolate(
                 prediction.unsqueeze(1),
                 size=img_rgb.shape[:2],
@@ -35,9 +75,51 @@ class DepthModel:
 
         return depth
 
+    def get_depth_batch(self, img_paths, normalize=True, roi=False):
+        imgs_rgb = [DecodedImage.of(p).rgb for p in img_paths]
+        inputs = [self.transform(img_rgb) for img_rgb in imgs_rgb]
+
+        # Pad every input to the largest network size so they stack into one batch
+        sizes = [tuple(x.shape[-2:]) for x in inputs]
+        max_h = max(h for h, _ in sizes)
+        max_w = max(w for _, w in sizes)
+        input_batch = torch.cat([
+            F.pad(x, (0, max_w - x.shape[-1], 0, max_h - x.shape[-2]), mode="replicate")
+            for x in inputs
+        ]).to(self.device)
+
+        predictions = self.predict(input_batch)
+
+        depths = []
+        for prediction, (h, w), img_rgb in zip(predictions, sizes, imgs_rgb):
+            # The network output may be at a different scale than its input
+            out_h = round(h * prediction.shape[-2] / max_h)
+            out_w = round(w * prediction.shape[-1] / max_w)
+            if roi:
+                depths.append(RoiDepthMap(prediction[:out_h, :out_w].cpu().numpy(), img_rgb.shape[:2], normalize))
+                continue
+            with torch.no_grad():
+                prediction = torch.nn.functional.interpolate(
+                    prediction[:out_h, :out_w][None, None],
+                    size=img_rgb.shape[:2],
+                    mode="bicubic",
+                    align_corners=False,
+                ).squeeze()
+            depth = prediction.cpu().numpy()
+
+            if normalize:
+                depth = (depth - depth.min()) / (depth.max() - depth.min())
+            depths.append(depth)
+
+        return depths
+
+    def _submask(self, mask, x1, y1, x2, y2):
+        # Scorers take either a full-size mask or an RoiMask already cropped to the box
+        return mask.roi() if isinstance(mask, RoiMask) else mask[y1:y2, x1:x2]
+
     def check_has_stock(self,mask, depth_map, bbox, min_diff=0.01, min_obj_pixels=200):
         x1, y1, x2, y2 = map(int, bbox)
-        submask = mask[y1:y2, x1:x2]
+        submask = self._submask(mask, x1, y1, x2, y2)
         subdepth = depth_map[y1:y2, x1:x2]
 
         obj_depths = subdepth[submask > 0]
@@ -73,8 +155,9 @@ class DepthModel:
         for i, mask_tensor in enumerate(results[0].masks.data):
             class_id = int(results[0].boxes.cls[i])
             class_name = names[class_id]
-            mask = mask_tensor.cpu().numpy().astype(np.uint8)
             box = boxes[i]
+            # Only the box region is scored, so only that region is kept (bit-packed)
+            mask = RoiMask.from_tensor(mask_tensor, box)
             out.append((class_name, box, mask))
         return out
 
@@ -83,7 +166,7 @@ class DepthModel:
         # Tính fullness theo pixel ratio, tạm thời layers chỉ 0/1.
 
         x1, y1, x2, y2 = map(int, bbox)
-        submask = mask[y1:y2, x1:x2]
+        submask = self._submask(mask, x1, y1, x2, y2)
 
         mask_pixels = submask.sum()
         bbox_area = submask.size
@@ -99,6 +182,106 @@ class DepthModel:
         return fullness_pct, layers
 
 
+    def _has_nan(self, depth_map):
+        return depth_map.has_nan() if isinstance(depth_map, RoiDepthMap) else np.isnan(depth_map).any()
+
+    def _mask_counts(self, mask, x1, y1, x2, y2):
+        # (object pixels, box pixels) of a section mask
+        if isinstance(mask, RoiMask):
+            return mask.count, mask.size
+        submask = mask[y1:y2, x1:x2]
+        return int(np.count_nonzero(submask)), submask.size
+
+    def score_sections(self, items, depth_map, min_diff=0.01, min_obj_pixels=200, min_pixels=50):
+        # check_has_stock + estimate_fullness for every section in one pass.
+        # Counts and fill ratios come from the masks alone. The depth medians only
+        # change the result when min_pixels <= object pixels <= min_obj_pixels and
+        # there is background (or the depth map has nan), so only those sections are
+        # gathered; their values are tagged with a segment id per
+        # (section, object/background), sorted together once, and each median is
+        # read at its segment's middle, exactly as np.median would.
+        # depth_map may be a callable: it is then only called if some section needs
+        # depth (cascade mode), and the depth map is assumed to be free of nan.
+        n = len(items)
+        if n == 0:
+            return []
+        boxes = [tuple(map(int, box)) for _, box, _ in items]
+        counts = np.array([self._mask_counts(mask, *box) for (_, _, mask), box in zip(items, boxes)],
+                          dtype=np.int64).reshape(n, 2)
+        obj_counts, areas = counts[:, 0], counts[:, 1]
+        bg_counts = areas - obj_counts
+
+        # Below min_pixels (or without object pixels) a section scores 0 whatever the depth
+        needs_depth = (obj_counts >= max(min_pixels, 1)) & (bg_counts > 0)
+        if callable(depth_map) or not self._has_nan(depth_map):
+            needs_depth &= obj_counts <= min_obj_pixels
+        diff = np.zeros(n)
+        if needs_depth.any():
+            if callable(depth_map):
+                depth_map = depth_map()
+            medians = self._segment_medians(
+                [(self._submask(items[i][2], *boxes[i]) > 0, depth_map[boxes[i][1]:boxes[i][3], boxes[i][0]:boxes[i][2]])
+                 for i in np.flatnonzero(needs_depth)], depth_map.dtype)
+            diff = np.zeros(n, dtype=depth_map.dtype)
+            diff[needs_depth] = np.abs(medians[1::2] - medians[0::2])
+        has_stock = (obj_counts > 0) & (
+            ~needs_depth | ((diff < min_diff) & (obj_counts > min_obj_pixels)) | (diff >= min_diff))
+
+        fullness_pct = obj_counts / np.maximum(areas, 1) * 100
+        scored = []
+        for i in range(n):
+            if not has_stock[i] or obj_counts[i] < min_pixels:
+                scored.append((0.0, 0))
+            else:
+                scored.append((float(fullness_pct[i]), 1 if fullness_pct[i] > 1 else 0))
+        return scored
+
+    def _sort_keys(self, values, segments):
+        # uint64 keys that sort by segment, then by float32 value:
+        # the segment id in the high 32 bits, the value's bits made order-preserving in the low 32
+        bits = values.view(np.uint32)
+        ordered = np.where(bits >> 31, ~bits, bits | np.uint32(0x80000000))
+        return (segments.astype(np.uint64) << np.uint64(32)) | ordered
+
+    def _from_sort_keys(self, keys):
+        ordered = (keys & np.uint64(0xFFFFFFFF)).astype(np.uint32)
+        bits = np.where(ordered >> 31, ordered & np.uint32(0x7FFFFFFF), ~ordered)
+        return bits.view(np.float32)
+
+    def _segment_medians(self, sections, dtype):
+        # [object median, background median] per (submask, subdepth), flattened;
+        # one sort over all sections instead of two np.median calls each
+        n = len(sections)
+        if n == 0:
+            return np.zeros(0, dtype=dtype)
+        counts = np.zeros(2 * n, dtype=np.int64)
+        keys, values, segments = [], [], []
+        for i, (submask, subdepth) in enumerate(sections):
+            submask = submask.ravel()
+            subdepth = np.ascontiguousarray(subdepth).ravel()
+            # Segment 2i holds the object pixels of section i, 2i + 1 its background
+            segment = 2 * i + 1 - submask
+            counts[2 * i] = np.count_nonzero(submask)
+            counts[2 * i + 1] = submask.size - counts[2 * i]
+            if dtype == np.float32:
+                keys.append(self._sort_keys(subdepth, segment))
+            else:
+                values.append(subdepth)
+                segments.append(segment)
+        if dtype == np.float32:
+            sorted_values = self._from_sort_keys(np.sort(np.concatenate(keys)))
+        else:
+            values, segments = np.concatenate(values), np.concatenate(segments)
+            sorted_values = values[np.lexsort((values, segments))]
+
+        # Every segment is non-empty: sections without object or background pixels never need depth
+        ends = np.cumsum(counts)
+        starts = ends - counts
+        medians = (sorted_values[starts + (counts - 1) // 2] + sorted_values[starts + counts // 2]) / 2
+        # np.median returns nan for a segment containing nan; nan sorts to either end
+        medians[np.isnan(sorted_values[starts]) | np.isnan(sorted_values[ends - 1])] = np.nan
+        return medians
+
     def _boxes_iou(self,b1, b2):
         N, M = b1.size(0), b2.size(0)
         b1 = b1[:, None, :]
@@ -202,16 +385,21 @@ class DepthModel:
 
         r1.masks.data = new_masks.detach().clone()
         return results
-    def compute_stock(self, results_seg,img_path):
-        if self.result_root_seg is None:
-            self.result_root_seg = results_seg
+    def compute_stock(self, results_seg,img_path, depth_map=None, state=None,
+                      min_diff=0.01, min_obj_pixels=200, min_pixels=50, changed=None):
+        # Without an explicit state the model keeps the reference itself (main.py loop).
+        # changed: bool per reference section from state.tracker; only those are
+        # scored, the others keep the tracker's score.
+        state = self if state is None else state
+        if state.result_root_seg is None:
+            state.result_root_seg = results_seg
 
         else:
-            mask = torch.zeros(self.result_root_seg[0].masks.data.shape, dtype=torch.bool)
-            self.result_root_seg[0].masks.data = mask
+            mask = torch.zeros(state.result_root_seg[0].masks.data.shape, dtype=torch.bool)
+            state.result_root_seg[0].masks.data = mask
 
-            self.result_root_seg = self.replace_masks_robust(
-                self.result_root_seg, results_seg,
+            state.result_root_seg = self.replace_masks_robust(
+                state.result_root_seg, results_seg,
                 iou_thr=0.15,   
                 center_rel=0.20,     
                 src_thresh=0.4,     
@@ -219,19 +407,36 @@ class DepthModel:
                 dilate_ks=3,        
                 close_ks=3
             )
-            # self.result_root_seg[0].show()
-
-        items = self.extract_masks(self.result_root_seg)
-        depth_map = self.get_depth(img_path)
+            # state.result_root_seg[0].show()
+
+        items = self.extract_masks(state.result_root_seg)
+        if depth_map is None:
+            depth_map = self.get_depth(img_path)
+        elif callable(depth_map):
+            # Cascade: the depth map is only computed when a section needs it
+            compute_depth, computed = depth_map, []
+
+            def depth_map():
+                computed.append(True)
+                return compute_depth()
         stock_dict = {}
         pos_dic = {}
-        for cls, box, mask in items:
-            has_stock, d_obj, d_bg = self.check_has_stock(mask, depth_map, box)
-            if not has_stock:
-                val = (0.0, 0)
+        if changed is None:
+            scored = self.score_sections(items, depth_map, min_diff, min_obj_pixels, min_pixels)
+        else:
+            rescore = np.flatnonzero(changed)
+            scored = list(state.tracker.scores)
+            for i, value in zip(rescore, self.score_sections(
+                    [items[i] for i in rescore], depth_map, min_diff, min_obj_pixels, min_pixels)):
+                scored[i] = value
+        if state.tracker is not None:
+            state.tracker.update(img_path, items, scored, changed)
+        if callable(depth_map):
+            if computed:
+                state.depth_computed += 1
             else:
-                fullness, layers = self.estimate_fullness(mask, depth_map, box)
-                val = (float(fullness), int(layers))
+                state.depth_skipped += 1
+        for (cls, box, mask), val in zip(items, scored):
             pos_dic.setdefault(cls, []).append(box)
             stock_dict.setdefault(cls, []).append(val)
         # self.visualize_stock(img_path, self.result_root_seg, stock_dict, save_path=f"{img_path}_depth_estimation_overlay.jpg")
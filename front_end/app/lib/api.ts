@@ -12,11 +12,15 @@ export const API_ENDPOINTS = {
   ESTIMATE_STOCK_BATCH: `${API_BASE_URL}/api/v1/estimate-stock-batch`,
   ESTIMATE_STOCK_INTEGRATED: `${API_BASE_URL}/api/v1/estimate-stock-integrated`,
   ESTIMATE_STOCK_MULTIPLE: `${API_BASE_URL}/api/v1/estimate-stock-multiple`,
+  JOBS: `${API_BASE_URL}/api/v1/jobs`,
+  JOB_STATUS: (jobId: string) => `${API_BASE_URL}/api/v1/jobs/${jobId}`,
+  JOB_EVENTS: (jobId: string) => `${API_BASE_URL}/api/v1/jobs/${jobId}/events`,
 } as const;
 
 export const API_CONFIG = {
   BASE_URL: API_BASE_URL,
-  TIMEOUT: 300000, // 5 minutes for AI processing
+  UPLOAD_TIMEOUT: 60000, // submitting a job only uploads the images
+  POLL_INTERVAL: 2000, // job status polling when the event stream drops
   HEADERS: {
     "Content-Type": "multipart/form-data",
   },
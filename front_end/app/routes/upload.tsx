@@ -10,6 +10,8 @@ import sample1 from "../assets/sampleImages/sample1.jpg";
 import sample2 from "../assets/sampleImages/sample2.jpg";
 import sample3 from "../assets/sampleImages/sample3.jpg";
 
+class JobFailedError extends Error {}
+
 export default function Upload() {
   const navigate = useNavigate();
 
@@ -85,6 +87,58 @@ export default function Upload() {
     setPreviewUrls(newUrls);
   };
 
+  // Follow a job's event stream until it finishes and return its results
+  // grouped by time (T0, T1, ...). If the stream drops, the job status is
+  // polled instead.
+  const followJob = (jobId: string) =>
+    new Promise<Record<string, unknown[]>>((resolve, reject) => {
+      const events = new EventSource(API_ENDPOINTS.JOB_EVENTS(jobId));
+      let poll: ReturnType<typeof setInterval> | null = null;
+
+      const finish = (job: { status: string; results?: any; error?: string }) => {
+        if (job.status === "completed") {
+          resolve(job.results ?? {});
+        } else {
+          reject(new JobFailedError(job.error || "unknown error"));
+        }
+      };
+
+      events.addEventListener("progress", (e) => {
+        const event = JSON.parse((e as MessageEvent).data);
+        if (event.stage === "scoring" && event.total > 0) {
+          // Images are scored in order; keep the last 10% for the refinement
+          setProgress((prev) =>
+            Math.max(prev, Math.round((event.image / event.total) * 90))
+          );
+        }
+      });
+
+      events.addEventListener("status", (e) => {
+        const event = JSON.parse((e as MessageEvent).data);
+        if (event.status === "completed" || event.status === "failed") {
+          events.close();
+          finish(event);
+        }
+      });
+
+      events.onerror = () => {
+        if (poll !== null) return;
+        events.close();
+        poll = setInterval(async () => {
+          try {
+            const { data } = await axios.get(API_ENDPOINTS.JOB_STATUS(jobId));
+            if (data.status === "completed" || data.status === "failed") {
+              clearInterval(poll!);
+              finish(data);
+            }
+          } catch (error) {
+            clearInterval(poll!);
+            reject(error);
+          }
+        }, API_CONFIG.POLL_INTERVAL);
+      };
+    });
+
   const handleUpload = async () => {
     console.log("handleupload");
     console.log("Uploading files:", files);
@@ -106,34 +160,37 @@ export default function Upload() {
         );
         formData.append("confidence_threshold", "0.7");
 
-        console.log(
-          `Uploading ${files.length} image(s) to multiple AI endpoint...`
-        );
+        console.log(`Submitting ${files.length} image(s) as an analysis job...`);
 
-        // Simulate progress updates
-        const step = files.length > 1 ? 5 : 10;
-        const intervalMs = files.length > 1 ? 3000 : 2000;
-        const progressInterval = setInterval(() => {
-          setProgress((prev) => Math.min(prev + step, 90));
-        }, intervalMs);
-
-        const response = await axios.post(
-          API_ENDPOINTS.ESTIMATE_STOCK_MULTIPLE,
-          formData,
-          {
-            headers: API_CONFIG.HEADERS,
-            timeout:
-              files.length > 1 ? API_CONFIG.TIMEOUT * 2 : API_CONFIG.TIMEOUT,
-          }
-        );
+        // The job endpoint returns right away; progress and results arrive
+        // as server-sent events, so no request has to stay open for minutes
+        const submitted = await axios.post(API_ENDPOINTS.JOBS, formData, {
+          headers: API_CONFIG.HEADERS,
+          timeout: API_CONFIG.UPLOAD_TIMEOUT,
+        });
+        const jobId: string = submitted.data.job_id;
+        const startedAt = Date.now();
 
-        clearInterval(progressInterval);
+        const results = await followJob(jobId);
         setProgress(100);
 
-        console.log("AI Analysis Response:", response.data);
+        const analysis = {
+          success: true,
+          message: `Stock estimation completed successfully for ${files.length} images`,
+          processing_time: (Date.now() - startedAt) / 1000,
+          timestamp: new Date().toISOString(),
+          results,
+          model_used: "integrated-ai-multiple",
+          image_metadata: {
+            image_count: files.length,
+            images_processed: Object.keys(results),
+            job_id: jobId,
+          },
+        };
+        console.log("AI Analysis Response:", analysis);
 
         // Store the analysis results in localStorage for the dashboard
-        localStorage.setItem("latestAnalysis", JSON.stringify(response.data));
+        localStorage.setItem("latestAnalysis", JSON.stringify(analysis));
 
         // Navigate to dashboard
         navigate("/dashboard");
@@ -141,9 +198,11 @@ export default function Upload() {
         console.error("Upload failed:", error);
 
         if (error.code === "ECONNABORTED") {
-          setError(
-            "AI analysis is taking longer than expected. Please try again with a smaller image or wait a bit longer."
-          );
+          setError("Uploading the images timed out. Please try again.");
+        } else if (error.response?.status === 503) {
+          setError("The analysis queue is full. Please try again shortly.");
+        } else if (error instanceof JobFailedError) {
+          setError(`AI analysis failed: ${error.message}`);
         } else if (error.response?.status === 500) {
           setError("Server error during analysis. Please try again.");
         } else {
@@ -0,0 +1,82 @@
+import os
+import sys
+
+import cv2
+import numpy as np
+import pytest
+import torch
+
+# backend_model is imported from the project root, as in python -m backend_model.benchmark
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from backend_model import model_cache
+from backend_model.decoded_image import DecodedImage
+from backend_model.stock_estimation_depth import DepthModel
+from helpers import SECTIONS, FakeGeminiServer
+
+
+class FakeDetection:
+    # Every section that is not blank, labelled onion
+    model_id = "fake"
+
+    def detect_batch(self, arrays, class_names):
+        detections = []
+        for rgb in arrays:
+            keep = [box for box in SECTIONS if (rgb[box[1]:box[3], box[0]:box[2]] < 250).mean() > 0.3]
+            detections.append((keep, ["onion"] * len(keep), [0.9] * len(keep)))
+        return detections
+
+
+class FakeSegmentation:
+    # The dark pixels of each box are the product
+    model_name, precision = "fake", "fp32"
+
+    def segment(self, image, xyxy, labels):
+        from ultralytics.engine.results import Results
+
+        bgr = image.bgr
+        masks = torch.zeros((len(xyxy), *bgr.shape[:2]), dtype=torch.bool)
+        for i, (x1, y1, x2, y2) in enumerate(xyxy):
+            masks[i, y1:y2, x1:x2] = torch.from_numpy(bgr[y1:y2, x1:x2].mean(-1) < 120)
+        boxes = torch.tensor([[*box, 0.9, i] for i, box in enumerate(xyxy)], dtype=torch.float32).reshape(-1, 6)
+        return [Results(bgr, path=image.name, names=dict(enumerate(labels)), boxes=boxes,
+                        masks=masks if len(xyxy) else None)]
+
+
+@pytest.fixture
+def fake_models():
+    # Deterministic stand-ins for the vision models, installed in model_cache;
+    # depth is the image brightness
+    depth = DepthModel("MiDaS_small")
+    depth.get_depth_batch = lambda images, normalize=True, roi=False: [
+        DecodedImage.of(image).rgb.mean(-1).astype(np.float32) / 255 for image in images]
+    saved = dict(model_cache._models)
+    model_cache._models.update(detection=FakeDetection(), segmentation=FakeSegmentation(), depth=depth)
+    yield model_cache._models
+    model_cache._models.clear()
+    model_cache._models.update(saved)
+
+
+@pytest.fixture
+def shelf_images(tmp_path):
+    # Four shelf photos with a different stock level per image and section
+    rng = np.random.default_rng(0)
+    paths = []
+    for n in range(4):
+        image = np.full((1000, 1600, 3), 255, dtype=np.uint8)
+        for i, (x1, y1, x2, y2) in enumerate(SECTIONS):
+            fill = y2 - int((y2 - y1) * ((n + i) % 5 + 1) / 5)
+            image[y1:y2, x1:x2] = 200
+            image[fill:y2, x1:x2] = rng.integers(20, 100, size=(y2 - fill, x2 - x1, 3))
+        path = str(tmp_path / f"T{n}.jpg")
+        cv2.imwrite(path, image, [cv2.IMWRITE_JPEG_QUALITY, 95])
+        paths.append(path)
+    return paths
+
+
+@pytest.fixture
+def fake_server():
+    # A fake Gemini endpoint of its own per test; set its attributes to change its behaviour
+    server = FakeGeminiServer()
+    yield server
+    server.close()
@@ -0,0 +1,167 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import torch
+
+# Ten shelf sections in two rows, in pixels of the 1600x1000 shelf_images
+SECTIONS = ([[50 + 300 * i, 100, 300 + 300 * i, 400] for i in range(5)]
+            + [[50 + 300 * i, 550, 300 + 300 * i, 850] for i in range(5)])
+
+
+def nms_reference(model, xyxy, scores, iou_thr=0.5, contain_thr=0.9):
+    # The per-box implementation of DetectionModel.nms_class_agnostic before it
+    # was vectorized, kept as the oracle
+    xyxy = np.asarray(xyxy, dtype=float)
+    scores = np.asarray(scores, dtype=float)
+    idxs = np.argsort(-scores)
+    keep = []
+    while idxs.size > 0:
+        i = idxs[0]
+        keep.append(i)
+        if idxs.size == 1:
+            break
+        rest = idxs[1:]
+        ious = model.iou_matrix(xyxy[i], xyxy[rest])
+        contain = []
+        for j in rest:
+            inter_x1 = max(xyxy[i][0], xyxy[j][0])
+            inter_y1 = max(xyxy[i][1], xyxy[j][1])
+            inter_x2 = min(xyxy[i][2], xyxy[j][2])
+            inter_y2 = min(xyxy[i][3], xyxy[j][3])
+            inter_area = max(0, inter_x2 - inter_x1) * max(0, inter_y2 - inter_y1)
+            area_j = (xyxy[j][2] - xyxy[j][0]) * (xyxy[j][3] - xyxy[j][1])
+            if area_j > 0 and inter_area / area_j > contain_thr:
+                contain.append(j)
+        mask = (ious <= iou_thr)
+        idxs = rest[mask & (~np.isin(rest, contain))]
+    return sorted(keep)
+
+
+def synthetic_boxes(rng, n, width=1920, height=1080):
+    # Clustered boxes like a dense shelf: overlapping duplicates plus nested
+    # boxes, a few degenerate boxes and exact score ties
+    centers = rng.uniform([0, 0], [width, height], size=(max(1, n // 8), 2))
+    c = centers[rng.integers(0, len(centers), n)] + rng.normal(0, 20, size=(n, 2))
+    wh = rng.uniform(20, 300, size=(n, 2))
+    xyxy = np.concatenate([c - wh / 2, c + wh / 2], axis=1)
+    xyxy[: n // 50, 2] = xyxy[: n // 50, 0]
+    scores = np.round(rng.uniform(0.1, 1.0, n), 2)
+    return xyxy.tolist(), scores.tolist()
+
+
+def synthetic_segmentation(rng, sections, height, width):
+    # SAM-like Results: one box per section, an irregular blob mask inside each box
+    from ultralytics.engine.results import Results
+
+    xyxy, masks = [], torch.zeros((sections, height, width), dtype=torch.bool)
+    for i in range(sections):
+        w, h = rng.integers(width // 20, width // 6), rng.integers(height // 20, height // 6)
+        x1, y1 = rng.integers(0, width - w), rng.integers(0, height - h)
+        xyxy.append([x1, y1, x1 + w, y1 + h])
+        yy, xx = np.ogrid[:h, :w]
+        blob = ((xx - w / 2) / (w / 2)) ** 2 + ((yy - h / 2) / (h / 2)) ** 2 < rng.uniform(0.3, 1.2)
+        masks[i, y1:y1 + h, x1:x1 + w] = torch.from_numpy(blob)
+    boxes = torch.tensor([[*b, 0.9, i % 5] for i, b in enumerate(xyxy)], dtype=torch.float32)
+    names = dict(enumerate(["potato section", "onion", "eggplant section", "tomato", "cucumber"]))
+    orig_img = np.zeros((height, width, 3), dtype=np.uint8)
+    return [Results(orig_img, path="synthetic.jpg", names=names, boxes=boxes, masks=masks)]
+
+
+def extract_masks_reference(results):
+    # extract_masks before RoiMask: one full-resolution uint8 array per section
+    names = results[0].names
+    boxes = results[0].boxes.xyxy.cpu().numpy().tolist()
+    return [(names[int(results[0].boxes.cls[i])], boxes[i], m.cpu().numpy().astype(np.uint8))
+            for i, m in enumerate(results[0].masks.data)]
+
+
+def synthetic_items(rng, sections, height, width):
+    # extract_masks output for a synthetic shelf: (class, box, RoiMask) per section.
+    # Every fourth section is nearly empty, which is where the depth medians decide.
+    from backend_model.roi import RoiMask
+
+    items = []
+    for i in range(sections):
+        w, h = rng.integers(width // 40, width // 8), rng.integers(height // 40, height // 8)
+        x1, y1 = rng.integers(0, width - w), rng.integers(0, height - h)
+        yy, xx = np.ogrid[:h, :w]
+        fill = rng.uniform(0.0, 0.01) if i % 4 == 0 else rng.uniform(0.0, 1.5)
+        blob = ((xx - w / 2) / (w / 2)) ** 2 + ((yy - h / 2) / (h / 2)) ** 2 < fill
+        items.append((f"class{i % 5}", [float(x1), float(y1), float(x1 + w), float(y1 + h)],
+                      RoiMask(blob, (x1, y1, x1 + w, y1 + h))))
+    return items
+
+
+def synthetic_depth(rng, height, width):
+    # Random depth with a flat patch, which makes the sections over it empty like a bare shelf
+    depth_map = rng.random((height, width), dtype=np.float32)
+    depth_map[: height // 3, : width // 3] = 0.5
+    return depth_map
+
+
+def max_diff(expected, actual):
+    # Largest absolute difference of two tensors; -inf (masked logits) must match exactly
+    expected, actual = expected.float().cpu(), actual.float().cpu()
+    if not torch.equal(torch.isinf(expected), torch.isinf(actual)):
+        return float("inf")
+    finite = torch.isfinite(expected)
+    return float((expected[finite] - actual[finite]).abs().max()) if finite.any() else 0.0
+
+
+class _FakeGeminiHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        server = self.server
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        images = sum("inlineData" in part for content in body.get("contents", []) for part in content.get("parts", []))
+        with server.lock:
+            server.requests += 1
+            limited = server.rate_limit_every and server.requests % server.rate_limit_every == 0
+        time.sleep(server.latency)
+        if limited:
+            error = {"error": {"code": 429, "message": "Resource exhausted", "status": "RESOURCE_EXHAUSTED"}}
+            self._send(429, error, {"Retry-After": "0.01"})
+            return
+        answer = server.answer
+        if images > 1:
+            answer = {f"I{i + 1}": answer for i in range(images)}
+        text = json.dumps(answer)
+        self._send(200, {"candidates": [{"content": {"role": "model", "parts": [{"text": text}]}}]})
+
+    def _send(self, status, body, headers=None):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeGeminiServer(ThreadingHTTPServer):
+    # generateContent on a local port with a fixed latency; every
+    # rate_limit_every-th request is a 429. answer is returned as the model's
+    # JSON text (per image id for a call with several images). The attributes
+    # can be changed while the server runs.
+    daemon_threads = True
+
+    def __init__(self, latency=0.05, rate_limit_every=0, answer=None):
+        super().__init__(("127.0.0.1", 0), _FakeGeminiHandler)
+        self.latency = latency
+        self.rate_limit_every = rate_limit_every
+        # Fits both payloads: fullness per fruit, or per mosaic section id
+        self.answer = answer if answer is not None else {"onion": [50, 60], "S1": 50, "S2": 60}
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.base_url = f"http://127.0.0.1:{self.server_address[1]}"
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,29 @@
+import cv2
+
+from backend_model.planning_agent import PlanningAgent
+from backend_model.results import ImageResult
+from backend_model.stock_estimation_depth import SequenceState
+from helpers import SECTIONS
+
+
+def test_cascade_matches_eager_depth(fake_models, shelf_images, tmp_path):
+    # One more image with a section of about 100 product pixels, which only the
+    # depth map can decide, so the cascade runs depth for it and skips the others
+    image = cv2.imread(shelf_images[0])
+    x1, y1, x2, y2 = SECTIONS[0]
+    image[y1:y2, x1:x2] = 200
+    image[y2 - 10:y2, x1:x1 + 10] = 40
+    path = str(tmp_path / "sparse.png")
+    cv2.imwrite(path, image)
+    images = shelf_images + [path]
+
+    runs = {}
+    for cascade in (False, True):
+        agent = PlanningAgent(lazy=True, depth_cascade=cascade)
+        agent.refine = lambda image, stock_dict, pos_dic: ImageResult.from_stock_dict(image.name, stock_dict, pos_dic)
+        state = SequenceState()
+        runs[cascade] = agent.process_batch(images, "onion .", state=state), state
+
+    (eager, _), (cascaded, state) = runs[False], runs[True]
+    assert [result.to_dict() for result in cascaded] == [result.to_dict() for result in eager]
+    assert (state.depth_computed, state.depth_skipped) == (1, len(shelf_images))
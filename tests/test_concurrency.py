@@ -0,0 +1,40 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from backend_model.planning_agent import PlanningAgent
+from backend_model.results import ImageResult
+
+
+def _key(results):
+    return [[(s.cls, s.index, s.bbox, s.source, round(s.fullness, 6)) for s in result.sections]
+            for result in results]
+
+
+def test_parallel_requests_match_their_serial_run(fake_models, shelf_images):
+    agent = PlanningAgent(lazy=True)
+    agent.refine = lambda image, stock_dict, pos_dic: ImageResult.from_stock_dict(image.name, stock_dict, pos_dic)
+    # Every request starts from a different reference image, so shared state changes the output
+    n = len(shelf_images)
+    sequences = [shelf_images[i:] + shelf_images[:i] for i in range(n)]
+
+    serial = [agent.process_batch(sequence, "onion .") for sequence in sequences]
+    with ThreadPoolExecutor(max_workers=n) as pool:
+        parallel = list(pool.map(lambda sequence: agent.process_batch(sequence, "onion ."), sequences))
+
+    assert [_key(results) for results in parallel] == [_key(results) for results in serial]
+    # The rotations do not all score the same, otherwise the check proves nothing
+    assert len({str(_key(results)) for results in serial}) > 1
+
+
+def test_close_shuts_down_the_refinement_threads(fake_models, shelf_images):
+    agent = PlanningAgent(lazy=True, refine_async=True, refine_workers=2)
+    agent.refine = lambda image, stock_dict, pos_dic: ImageResult.from_stock_dict(image.name, stock_dict, pos_dic)
+    agent.process_batch(shelf_images[:2], "onion .")
+    refiner = agent._refiner
+    assert refiner is not None
+
+    agent.close()
+    assert agent._refiner is None and agent._process_pools == {}
+    assert all(not thread.is_alive() for thread in refiner._threads)
+    # The agent stays usable: the next batch starts a new pool
+    assert len(agent.process_batch(shelf_images[:1], "onion .")) == 1
+    agent.close()
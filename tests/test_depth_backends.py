@@ -0,0 +1,33 @@
+import types
+
+import pytest
+import torch
+
+from backend_model.depth_backends import DEPTH_BACKENDS, MidasBackend
+
+MIDAS_BACKENDS = [name for name, backend in DEPTH_BACKENDS.items() if isinstance(backend, MidasBackend)]
+
+
+@pytest.fixture
+def fake_hub(monkeypatch, tmp_path):
+    # torch.hub.load without the network: models are a dummy module, transforms their names
+    transforms = types.SimpleNamespace(small_transform="small_transform", dpt_transform="dpt_transform")
+    monkeypatch.setattr(torch.hub, "set_dir", lambda path: None)
+    monkeypatch.setattr(torch.hub, "load", lambda repo, name, **kwargs: (
+        transforms if name == "transforms" else torch.nn.Identity()))
+    return str(tmp_path)
+
+
+@pytest.mark.parametrize("name", MIDAS_BACKENDS)
+def test_midas_default_transform_matches_the_baseline(fake_hub, name):
+    # The original DepthModel.load: dpt_transform for ids containing "large", else small_transform
+    baseline = "dpt_transform" if "large" in name.lower() else "small_transform"
+    _, transform = DEPTH_BACKENDS[name].load("cpu", fake_hub)
+    assert transform == baseline
+
+
+@pytest.mark.parametrize("name", MIDAS_BACKENDS)
+def test_native_transform_only_changes_dpt_hybrid(fake_hub, name):
+    _, default = DEPTH_BACKENDS[name].load("cpu", fake_hub)
+    _, native = DEPTH_BACKENDS[name].load("cpu", fake_hub, native_transform=True)
+    assert native == ("dpt_transform" if name == "DPT_Hybrid" else default)
@@ -0,0 +1,52 @@
+import cv2
+import numpy as np
+import pytest
+import torch
+
+from backend_model.roi import RoiDepthMap
+from backend_model.stock_estimation_depth import DepthModel
+from helpers import synthetic_items
+
+
+class _TinyDepth(torch.nn.Module):
+    # Network-resolution output a quarter of the input size, with bicubic overshoot
+    # at sharp edges like a real depth network
+    def forward(self, x):
+        return torch.nn.functional.avg_pool2d(x.mean(1, keepdim=True), 4)[:, 0] * 10
+
+
+@pytest.fixture
+def depth_model():
+    model = DepthModel("MiDaS_small")
+    model.device = "cpu"
+    model.model_depth = _TinyDepth()
+    model.transform = lambda rgb: torch.from_numpy(cv2.resize(rgb, (256, 160))).permute(2, 0, 1)[None].float() / 255
+    return model
+
+
+@pytest.mark.parametrize("normalize", [True, False])
+def test_roi_depth_matches_full_upsampling(depth_model, shelf_images, normalize):
+    full = depth_model.get_depth(shelf_images[0], normalize=normalize)
+    roi = depth_model.get_depth(shelf_images[0], normalize=normalize, roi=True)
+    assert isinstance(roi, RoiDepthMap) and roi.shape == full.shape
+    # The min/max used for normalizing is that of the whole upsampled map
+    assert np.abs(roi.full() - full).max() < 1e-4
+    for y1, y2, x1, x2 in [(0, 1000, 0, 1600), (100, 400, 50, 300), (990, 1000, 1590, 1600), (5, 5, 0, 10)]:
+        assert np.abs(roi[y1:y2, x1:x2] - full[y1:y2, x1:x2]).max(initial=0) < 1e-4
+
+
+def test_roi_depth_scores_like_the_full_map(depth_model, shelf_images):
+    rng = np.random.default_rng(0)
+    items = synthetic_items(rng, 40, 1000, 1600)
+    full = depth_model.get_depth(shelf_images[1])
+    roi = depth_model.get_depth(shelf_images[1], roi=True)
+    expected = depth_model.score_sections(items, full)
+    scored = depth_model.score_sections(items, roi)
+    assert [layers for _, layers in scored] == [layers for _, layers in expected]
+    assert np.allclose([fullness for fullness, _ in scored], [fullness for fullness, _ in expected], atol=1e-3)
+
+
+def test_roi_depth_batch_matches_single_images(depth_model, shelf_images):
+    batch = depth_model.get_depth_batch(shelf_images[:2], roi=True)
+    for image, depth in zip(shelf_images[:2], batch):
+        assert np.abs(depth.full() - depth_model.get_depth(image)).max() < 1e-4
@@ -0,0 +1,89 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from backend_model.decoded_image import DecodedImage
+from backend_model.gemini_model import Gemini
+
+STOCK_DICT = {"onion": [(0.0, 1), (0.0, 1), (50.0, 1)]}
+POS_DIC = {"onion": [0, 1]}
+
+
+def _gemini(base_url, **options):
+    model = Gemini(base_url=base_url, backoff=0.01, **options)
+    model.api_key = "local"
+    return model
+
+
+@pytest.fixture
+def image(shelf_images):
+    return DecodedImage(shelf_images[0])
+
+
+def _sections(image):
+    height, width = image.bgr.shape[:2]
+    return {"onion": [[0.1 * width, 0.2 * height, 0.3 * width, 0.5 * height],
+                      [0.4 * width, 0.2 * height, 0.6 * width, 0.5 * height],
+                      [0.7 * width, 0.2 * height, 0.9 * width, 0.5 * height]]}
+
+
+@pytest.mark.parametrize("payload", ["full", "mosaic"])
+def test_refines_the_requested_positions(fake_server, image, payload):
+    model = _gemini(fake_server.base_url, payload=payload)
+    result = model.stock_estimation(image, POS_DIC, _sections(image), STOCK_DICT)
+    assert result == {"onion": [(50, 1), (60, 1), (50.0, 1)]}
+    assert STOCK_DICT["onion"][0] == (0.0, 1)
+
+
+def test_rate_limited_calls_are_retried(fake_server, image):
+    fake_server.rate_limit_every = 2
+    model = _gemini(fake_server.base_url, max_retries=2)
+    results = [model.stock_estimation(image, {"onion": [i]}, _sections(image), STOCK_DICT) for i in range(3)]
+    assert all(result is not None for result in results)
+    stats = model.stats()
+    # Requests 2 and 4 of 5 were rate limited
+    assert stats["retries"] == 2 and stats["calls"] == 5 and stats["errors"] == 0
+
+
+def test_gives_up_after_max_retries(fake_server, image):
+    fake_server.rate_limit_every = 1
+    model = _gemini(fake_server.base_url, max_retries=2)
+    assert model.stock_estimation(image, POS_DIC, _sections(image), STOCK_DICT) is None
+    stats = model.stats()
+    assert stats["calls"] == 3 and stats["retries"] == 2 and stats["errors"] == 1
+    # The failure is not cached
+    fake_server.rate_limit_every = 0
+    assert model.stock_estimation(image, POS_DIC, _sections(image), STOCK_DICT) is not None
+    assert model.stats()["calls"] == 4
+
+
+def test_answers_are_cached_per_image_and_positions(fake_server, image):
+    model = _gemini(fake_server.base_url)
+    first = model.stock_estimation(image, POS_DIC, _sections(image), STOCK_DICT)
+    assert model.stock_estimation(image, POS_DIC, _sections(image), STOCK_DICT) == first
+    model.stock_estimation(image, {"onion": [0]}, _sections(image), STOCK_DICT)
+    stats = model.stats()
+    assert stats["calls"] == 2 and stats["cache_hits"] == 1
+
+
+def test_concurrent_requests_share_one_call(fake_server, image):
+    fake_server.latency = 0.5
+    model = _gemini(fake_server.base_url)
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        results = list(pool.map(lambda _: model.stock_estimation(image, POS_DIC, _sections(image), STOCK_DICT),
+                                range(4)))
+    assert all(result == results[0] is not None for result in results)
+    stats = model.stats()
+    assert stats["calls"] == 1 and stats["cache_hits"] + stats["in_flight_hits"] == 3
+
+
+@pytest.mark.parametrize("payload", ["full", "mosaic"])
+def test_malformed_fullness_is_skipped_or_clamped(fake_server, image, payload):
+    fake_server.answer = {"onion": ["76%", None], "S1": "76%", "S2": {"value": 60}} if payload == "mosaic" else {
+        "onion": [140, {"value": 60}]}
+    model = _gemini(fake_server.base_url, payload=payload)
+    result = model.stock_estimation(image, POS_DIC, _sections(image), STOCK_DICT)
+    expected = 76.0 if payload == "mosaic" else 100.0
+    # The unparseable answer keeps the depth value
+    assert result == {"onion": [(expected, 1), (0.0, 1), (50.0, 1)]}
+    assert model.stats()["invalid_answers"] == 1
@@ -0,0 +1,27 @@
+import numpy as np
+
+from backend_model.stock_estimation_depth import DepthModel
+from helpers import extract_masks_reference, synthetic_depth, synthetic_segmentation
+
+
+def test_roi_masks_score_like_full_masks():
+    model = DepthModel()
+    rng = np.random.default_rng(0)
+    results = synthetic_segmentation(rng, 30, 300, 400)
+    depth_map = synthetic_depth(rng, 300, 400)
+    depth_map[:, :200] = 0.5
+    reference = extract_masks_reference(results)
+    items = model.extract_masks(results)
+
+    assert [(cls, box) for cls, box, _ in items] == [(cls, box) for cls, box, _ in reference]
+    for (_, _, roi_mask), (_, _, full_mask) in zip(items, reference):
+        assert np.array_equal(roi_mask.full(full_mask.shape), full_mask)
+
+    def scores(items):
+        return [(model.check_has_stock(mask, depth_map, box), model.estimate_fullness(mask, depth_map, box))
+                for _, box, mask in items]
+
+    expected = scores(reference)
+    assert scores(items) == expected
+    # Both stocked and empty sections are compared
+    assert {has_stock for (has_stock, _, _), _ in expected} == {True, False}
@@ -0,0 +1,20 @@
+import numpy as np
+import pytest
+
+from backend_model.detection_model import DetectionModel
+from helpers import nms_reference, synthetic_boxes
+
+
+@pytest.mark.parametrize("n", [0, 1, 2, 50, 500, 2000])
+def test_nms_matches_the_per_box_reference(n):
+    model = DetectionModel()
+    xyxy, scores = synthetic_boxes(np.random.default_rng(n), n)
+    assert model.nms_class_agnostic(xyxy, scores, ["tomato"] * n) == nms_reference(model, xyxy, scores)
+
+
+def test_nms_contained_and_tied_boxes():
+    model = DetectionModel()
+    xyxy = [[0, 0, 100, 100], [10, 10, 50, 50], [0, 0, 100, 100], [200, 200, 200, 260], [300, 0, 400, 100]]
+    scores = [0.8, 0.9, 0.8, 0.5, 0.8]
+    keep = model.nms_class_agnostic(xyxy, scores, ["tomato"] * len(xyxy))
+    assert keep == nms_reference(model, xyxy, scores)
@@ -0,0 +1,95 @@
+import cv2
+import numpy as np
+import pytest
+import torch
+
+pytest.importorskip("onnx")
+pytest.importorskip("onnxruntime")
+
+from backend_model import onnx_export
+from backend_model.decoded_image import DecodedImage
+from backend_model.detection_model import DetectionModel
+from backend_model.onnx_runtime import OnnxRunner, onnx_name
+from backend_model.stock_estimation_depth import DepthModel
+from helpers import max_diff
+
+# Small random networks with the same graph code as the real models, so no
+# weights are downloaded
+
+
+class _TinyDepth(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.net = torch.nn.Sequential(torch.nn.Conv2d(3, 8, 3, padding=1), torch.nn.ReLU(),
+                                       torch.nn.Conv2d(8, 1, 3, padding=1))
+
+    def forward(self, x):
+        return self.net(x)[:, 0]
+
+
+def _image(tmp_path, name, height, width):
+    path = str(tmp_path / name)
+    cv2.imwrite(path, np.random.default_rng(height).integers(0, 255, size=(height, width, 3), dtype=np.uint8))
+    return DecodedImage(path)
+
+
+def test_depth_graph_matches_pytorch(tmp_path):
+    torch.manual_seed(0)
+    model = DepthModel("MiDaS_small")
+    model.device = "cpu"
+    model.model_depth = _TinyDepth().eval()
+    model.transform = lambda rgb: torch.from_numpy(rgb).permute(2, 0, 1)[None].float() / 255
+    exported, other = _image(tmp_path, "a.jpg", 96, 128), _image(tmp_path, "b.jpg", 64, 64)
+    onnx_export.export_depth(model, [exported], str(tmp_path / "onnx"))
+    model.onnx = OnnxRunner(str(tmp_path / "onnx"), onnx_name("depth", model.model_id))
+    assert model.onnx.available() == [(96, 128)]
+
+    batch = torch.cat([model.transform(exported.rgb)] * 2)
+    actual = model.predict(batch)
+    runner, model.onnx = model.onnx, None
+    expected = model.predict(batch)
+    assert actual.shape == expected.shape == (2, 96, 128)
+    assert max_diff(expected, actual) < 1e-4
+
+    # Sizes without an artifact run the PyTorch model
+    model.onnx = runner
+    assert runner.session((64, 64)) is None
+    other_batch = model.transform(other.rgb)
+    with torch.no_grad():
+        assert torch.equal(model.predict(other_batch), model.model_depth(other_batch))
+
+
+def test_detection_graph_matches_pytorch(tmp_path):
+    from transformers import (BertConfig, BertTokenizer, GroundingDinoConfig, GroundingDinoForObjectDetection,
+                              GroundingDinoImageProcessor, GroundingDinoProcessor, SwinConfig)
+
+    torch.manual_seed(0)
+    words = ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]", ".", "potato", "section", "onion", "eggplant",
+             "tomato", "cucumber"]
+    vocab = tmp_path / "vocab.txt"
+    vocab.write_text("\n".join(words + [f"w{i}" for i in range(200)]))
+    config = GroundingDinoConfig(
+        backbone_config=SwinConfig(embed_dim=16, depths=[1, 1, 1, 1], num_heads=[1, 2, 4, 8], out_indices=[2, 3, 4]),
+        text_config=BertConfig(hidden_size=32, num_hidden_layers=1, num_attention_heads=2, intermediate_size=32,
+                               vocab_size=len(words) + 200),
+        d_model=32, encoder_layers=1, decoder_layers=2, encoder_ffn_dim=32, decoder_ffn_dim=32, num_queries=20,
+        encoder_attention_heads=2, decoder_attention_heads=2, use_timm_backbone=False)
+    model = DetectionModel("tiny-grounding-dino")
+    model.device = "cpu"
+    model.processor = GroundingDinoProcessor(
+        GroundingDinoImageProcessor(size={"shortest_edge": 160, "longest_edge": 240}), BertTokenizer(str(vocab)))
+    model.model_dec = GroundingDinoForObjectDetection(config).eval()
+    image = _image(tmp_path, "shelf.jpg", 120, 180)
+
+    onnx_export.export_detection(model, [image], str(tmp_path / "onnx"))
+    model.onnx = OnnxRunner(str(tmp_path / "onnx"), onnx_name("detection", model.model_id))
+    # The exported graph keeps the batch and prompt length dynamic
+    for images, prompt in [([image.rgb], onnx_export.CLASS_NAMES), ([image.rgb] * 2, "tomato . onion .")]:
+        inputs = model.prepare_inputs(images, prompt)
+        assert model.onnx.session(inputs["pixel_values"].shape[-2:]) is not None
+        actual = model.forward(inputs)
+        runner, model.onnx = model.onnx, None
+        expected = model.forward(inputs)
+        model.onnx = runner
+        assert max_diff(expected.logits, actual.logits) < 1e-3
+        assert max_diff(expected.pred_boxes, actual.pred_boxes) < 1e-4
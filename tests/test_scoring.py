@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+
+from backend_model.stock_estimation_depth import DepthModel
+from helpers import synthetic_depth, synthetic_items
+
+
+def _loop(model, items, depth_map, **params):
+    # Per-section scoring as process_image did before score_sections
+    check = {key: params[key] for key in ("min_diff", "min_obj_pixels") if key in params}
+    fullness_params = {key: params[key] for key in ("min_pixels",) if key in params}
+    scored = []
+    for _, box, mask in items:
+        has_stock, _, _ = model.check_has_stock(mask, depth_map, box, **check)
+        if not has_stock:
+            scored.append((0.0, 0))
+        else:
+            fullness, layers = model.estimate_fullness(mask, depth_map, box, **fullness_params)
+            scored.append((float(fullness), int(layers)))
+    return scored
+
+
+@pytest.mark.parametrize("params", [{}, {"min_diff": 0.05, "min_obj_pixels": 50, "min_pixels": 10}])
+def test_score_sections_matches_the_per_section_loop(params):
+    model = DepthModel()
+    rng = np.random.default_rng(0)
+    items = synthetic_items(rng, 60, 600, 800)
+    depth_map = synthetic_depth(rng, 600, 800)
+    expected = _loop(model, items, depth_map, **params)
+    assert model.score_sections(items, depth_map, **params) == expected
+    assert {layers for _, layers in expected} >= {0, 1}
+
+
+def test_score_sections_without_sections():
+    model = DepthModel()
+    assert model.score_sections([], np.zeros((10, 10), dtype=np.float32)) == []
@@ -0,0 +1,50 @@
+import os
+
+import numpy as np
+import pytest
+
+from backend_model.roi import RoiDepthMap
+from backend_model.stage_cache import StageCache
+
+DETECTION = ([[1.0, 2.0, 30.0, 40.0]], ["onion"], [0.9])
+
+
+def _only_file(cache):
+    (name,) = os.listdir(cache.cache_dir)
+    return os.path.join(cache.cache_dir, name)
+
+
+def test_round_trip(tmp_path):
+    cache = StageCache(str(tmp_path))
+    assert cache.get_detection("hash", 0.3) is None
+    cache.put_detection("hash", DETECTION, 0.3)
+    assert cache.get_detection("hash", 0.3) == DETECTION
+    assert cache.get_detection("hash", 0.4) is None
+    depth = RoiDepthMap(np.random.default_rng(0).random((8, 12), dtype=np.float32), (80, 120), normalize=False)
+    cache.put_depth("hash", depth)
+    cached = cache.get_depth("hash")
+    assert cached.shape == depth.shape and np.allclose(cached.prediction, depth.prediction, atol=1e-3)
+    assert cache.stats()["hits"] == 2 and cache.stats()["misses"] == 2
+
+
+@pytest.mark.parametrize("damage", ["evicted", "truncated", "garbage"])
+def test_unreadable_entry_is_a_miss(tmp_path, damage):
+    cache = StageCache(str(tmp_path))
+    cache.put_detection("hash", DETECTION)
+    path = _only_file(cache)
+    if damage == "evicted":
+        # Removed by another worker between the lookup and the load
+        os.remove(path)
+    elif damage == "truncated":
+        with open(path, "r+b") as f:
+            f.truncate(os.path.getsize(path) // 2)
+    else:
+        with open(path, "wb") as f:
+            f.write(b"not an npz file")
+
+    assert cache.get_detection("hash") is None
+    stats = cache.stats()
+    assert stats["hits"] == 0 and stats["misses"] == 1 and stats["files"] == 0 and stats["bytes"] == 0
+    # The entry can be stored again
+    cache.put_detection("hash", DETECTION)
+    assert cache.get_detection("hash") == DETECTION